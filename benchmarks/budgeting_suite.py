@@ -0,0 +1,111 @@
+import argparse
+import datetime
+import json
+import datagen
+import harness
+
+harness.use_service('budgeting_service')
+
+import analytics
+import api
+import balances
+import comparison
+import db
+import forecasting
+import hierarchy
+import snapshots
+from passlib.hash import pbkdf2_sha256
+
+def build_dataset(config, seed):
+    """Replace the seeded sample data with a synthetic dataset of the configured size"""
+    dataset = datagen.budgeting_dataset(config, seed)
+    conn = db.get_db_connection()
+    datagen.load_budgeting(conn, dataset, pbkdf2_sha256.hash(datagen.PASSWORD))
+    conn.close()
+    return dataset
+
+def run(config, seed, iterations):
+    dataset = build_dataset(config, seed)
+    departments = dataset["departments"]
+    username = dataset["users"][0][0]
+    client = api.app.test_client()
+
+    conn = db.get_db_connection()
+    rows = conn.execute('SELECT id, name, parent_id FROM Departments').fetchall()
+    active_year = conn.execute('SELECT id FROM FiscalYears WHERE is_active = 1').fetchone()['id']
+    conn.close()
+
+    tree = hierarchy.build_department_tree(rows)
+    top_level = [dept["id"] for dept in departments if dept["parent_id"] is None]
+    widest = max(top_level, key=lambda dept_id: tree["subtree_size"][dept_id])
+    widest_subtree = hierarchy.get_subtree_ids(tree, widest)
+    deepest = config["depth"]
+
+    # Forecast from halfway through the active year, so both models have data either side
+    active_bounds = next(year for year in forecasting.get_fiscal_years() if year['id'] == active_year)
+    mid_year = active_bounds['start'] + (active_bounds['end'] - active_bounds['start']) / 2
+
+    # The allocation with the most expenditures is the costliest to re-sum
+    conn = db.get_db_connection()
+    busiest = conn.execute('''
+        SELECT allocation_id FROM Expenditures GROUP BY allocation_id ORDER BY COUNT(*) DESC LIMIT 1
+    ''').fetchone()[0]
+    conn.close()
+
+    all_years = [year['id'] for year in forecasting.get_fiscal_years()]
+
+    def compare_all_years(cached=True):
+        if not cached:
+            # Nothing writes during the suite, so the cold runs empty the cache themselves
+            comparison._closed_years["years"].clear()
+        return comparison.pivot_years(comparison.compare_years(all_years, tree))
+
+    def authenticate():
+        response = client.post('/api/authenticate', json={"username": username, "password": datagen.PASSWORD})
+        assert response.status_code == 200
+
+    def list_departments():
+        response = client.get('/api/departments')
+        assert response.status_code == 200
+
+    def overview(dept_id):
+        rollup = analytics.build_rollup(active_year, tree)
+        return analytics.with_total(analytics.category_summary(rollup, dept_id), 'Category', rollup["elapsed_days"])
+
+    # Password hashing dominates authentication, so it gets fewer iterations
+    return {
+        "api_authenticate": harness.measure(authenticate, max(iterations // 5, 5)),
+        "api_departments": harness.measure(list_departments, iterations),
+        "department_tree": harness.measure(lambda: hierarchy.build_department_tree(rows), iterations),
+        "analytics_load": harness.measure(lambda: analytics.load_fiscal_year(active_year), iterations),
+        "analytics_rollup": harness.measure(lambda: analytics.build_rollup(active_year, tree), iterations),
+        "overview_university": harness.measure(lambda: overview(None), iterations),
+        "overview_subtree": harness.measure(lambda: overview(widest), iterations),
+        "overview_leaf": harness.measure(lambda: overview(deepest), iterations),
+        "breakdown_university": harness.measure(
+            lambda: analytics.department_category_breakdown(analytics.build_rollup(active_year, tree)), iterations
+        ),
+        "forecast_year": harness.measure(lambda: forecasting.build_forecast(active_year, mid_year), iterations),
+        "compare_years_cold": harness.measure(lambda: compare_all_years(cached=False), iterations),
+        "compare_years_cached": harness.measure(compare_all_years, iterations),
+        "record_expenditure": harness.measure(
+            lambda: balances.record_expenditure(busiest, 1.0, "Benchmark expenditure", mid_year, policy='soft'), iterations
+        ),
+        "reconcile_balances": harness.measure(balances.reconcile_balances, max(iterations // 5, 5)),
+        "take_snapshot": harness.measure(lambda: snapshots.take_snapshot(active_year), max(iterations // 5, 5)),
+        # Today's state from the latest snapshot, replaying the benchmark's own writes since it
+        "rollup_as_of_today": harness.measure(
+            lambda: snapshots.rollup_as_of(active_year, datetime.date.today(), tree), iterations
+        ),
+        "_dataset": {"widest_subtree": len(widest_subtree)}
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Budgeting service benchmarks")
+    parser.add_argument('--config', required=True, help="dataset sizes as JSON")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    harness.write_results(args.output, run(json.loads(args.config), args.seed, args.iterations))
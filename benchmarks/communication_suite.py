@@ -0,0 +1,51 @@
+import argparse
+import json
+import random
+import datagen
+import harness
+
+harness.use_service('communication_service')
+
+import db
+import hierarchy
+
+def build_dataset(config, seed):
+    """Bulk load a synthetic hierarchy and message history"""
+    dataset = datagen.communication_dataset(config, seed)
+    index = datagen.load_communication(db, hierarchy, dataset)
+    return dataset["departments"], index
+
+def run(config, seed, iterations):
+    departments, index = build_dataset(config, seed)
+    rng = random.Random(seed + 1)
+
+    top = departments[0]["id"]
+    deepest = config["depth"]
+    latest = db.get_message_sequence()
+
+    def inbox(dept_id, after_id=None):
+        return db.get_inbox_messages(dept_id, hierarchy.get_ancestors(index, dept_id), after_id=after_id)
+
+    def send():
+        recipients = rng.sample([dept["id"] for dept in departments], min(3, len(departments)))
+        assert db.create_message(top, recipients, "Benchmark message", datagen.random_text(rng, 40))
+
+    return {
+        "inbox_top_level": harness.measure(lambda: inbox(top), iterations),
+        "inbox_deepest": harness.measure(lambda: inbox(deepest), iterations),
+        "inbox_incremental": harness.measure(lambda: inbox(deepest, after_id=latest - 10), iterations),
+        "unread_count": harness.measure(lambda: db.get_unread_count(deepest), iterations),
+        "search": harness.measure(lambda: db.search_messages("budget review"), iterations),
+        "create_message": harness.measure(send, iterations),
+        "_dataset": {"inbox_deepest_size": len(inbox(deepest))}
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Communication service benchmarks")
+    parser.add_argument('--config', required=True, help="dataset sizes as JSON")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    harness.write_results(args.output, run(json.loads(args.config), args.seed, args.iterations))
@@ -0,0 +1,242 @@
+import argparse
+import datetime
+import os
+import random
+import subprocess
+import sys
+import harness
+
+# Fixed start dates keep generated data identical for a given seed
+FIRST_FISCAL_YEAR = 2000
+FIRST_MESSAGE_TIME = datetime.datetime(2024, 1, 1)
+
+# Zipf exponent for how expenditures concentrate on a few allocations
+EXPENDITURE_SKEW = 1.1
+
+# Share of messages broadcast to a top-level department, reaching its whole subtree
+BROADCAST_SHARE = 0.1
+
+WORDS = ('budget', 'meeting', 'schedule', 'review', 'report', 'semester', 'exam', 'grant',
+         'proposal', 'deadline', 'update', 'request', 'approval', 'faculty', 'students', 'lab')
+
+DEPARTMENT_PREFIXES = ('School', 'Division', 'Department', 'Centre', 'Lab', 'Group', 'Unit', 'Team')
+
+PASSWORD = 'pass123'
+
+def generate_departments(count, depth, seed):
+    """
+    Generate a department tree with ids 1..count. A chain down to the full
+    depth is built first, the rest attach to random parents above the
+    depth limit, so the tree is both deep and wide.
+    Returns a list of {"id", "name", "parent_id"} dicts.
+    """
+    rng = random.Random(seed)
+    departments = []
+    depths = {}
+    parents = []
+
+    for dept_id in range(1, count + 1):
+        if dept_id <= depth:
+            parent_id = dept_id - 1 or None
+        elif rng.random() < 0.05 or not parents:
+            parent_id = None
+        else:
+            parent_id = rng.choice(parents)
+
+        depths[dept_id] = 0 if parent_id is None else depths[parent_id] + 1
+        if depths[dept_id] < depth - 1:
+            parents.append(dept_id)
+
+        prefix = DEPARTMENT_PREFIXES[min(depths[dept_id], len(DEPARTMENT_PREFIXES) - 1)]
+        departments.append({"id": dept_id, "name": f"{prefix} {dept_id}", "parent_id": parent_id})
+
+    return departments
+
+def random_text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+def budgeting_dataset(config, seed):
+    """
+    Generate the rows of a budgeting database:
+    - allocations are unique per (department, category, fiscal year), with
+      log-normally distributed amounts
+    - expenditures follow a Zipf distribution over allocations, so a few
+      allocations carry most of the spending, and bunch up towards the end
+      of each fiscal year
+    """
+    rng = random.Random(seed)
+    departments = generate_departments(config["departments"], config["depth"], seed)
+
+    fiscal_years = [(i + 1, f"{FIRST_FISCAL_YEAR + i}-{FIRST_FISCAL_YEAR + i + 1}",
+                     int(i == config["fiscal_years"] - 1))
+                    for i in range(config["fiscal_years"])]
+    categories = [(i + 1, f"Category {i + 1}") for i in range(config["categories"])]
+
+    # Sample unique cells of the department x category x fiscal year grid
+    grid = len(departments) * len(categories) * len(fiscal_years)
+    allocations = []
+    for allocation_id, cell in enumerate(rng.sample(range(grid), min(config["allocations"], grid)), 1):
+        dept_index, rest = divmod(cell, len(categories) * len(fiscal_years))
+        category_index, year_index = divmod(rest, len(fiscal_years))
+        amount = round(min(rng.lognormvariate(11, 1), 50000000), 2)
+        allocations.append((allocation_id, departments[dept_index]["id"], category_index + 1,
+                            year_index + 1, amount))
+
+    expenditures = []
+    if allocations:
+        popularity = list(range(len(allocations)))
+        rng.shuffle(popularity)
+        weights = [1 / (rank + 1) ** EXPENDITURE_SKEW for rank in popularity]
+        chosen = rng.choices(allocations, weights=weights, k=config["expenditures"])
+
+        for expenditure_id, allocation in enumerate(chosen, 1):
+            year_start = datetime.date(FIRST_FISCAL_YEAR + allocation[3] - 1, 4, 1)
+            day = int(rng.betavariate(2, 1.2) * 364)
+            amount = round(min(rng.lognormvariate(6, 1.5), allocation[4]), 2)
+            expenditures.append((expenditure_id, allocation[0], amount, random_text(rng, 3),
+                                 (year_start + datetime.timedelta(days=day)).isoformat()))
+
+    users = [(f"user{dept['id']}", dept["id"]) for dept in departments[::10]]
+
+    return {
+        "departments": departments,
+        "users": users,
+        "fiscal_years": fiscal_years,
+        "categories": categories,
+        "allocations": allocations,
+        "expenditures": expenditures
+    }
+
+def load_budgeting(conn, dataset, password_hash):
+    """
+    Replace a budgeting database's contents with a generated dataset, in a
+    single transaction with synchronous=OFF. Every user gets the same
+    password hash, since hashing per user would dominate the load time.
+    """
+    conn.execute('PRAGMA synchronous = OFF')
+    with conn:
+        for table in ('AllocationBalances', 'Expenditures', 'Allocations', 'Users', 'BudgetCategories', 'FiscalYears', 'Departments'):
+            conn.execute(f'DELETE FROM {table}')
+
+        conn.executemany('INSERT INTO Departments (id, name, parent_id) VALUES (?, ?, ?)',
+                         [(d["id"], d["name"], d["parent_id"]) for d in dataset["departments"]])
+        conn.executemany('INSERT INTO Users (username, hashed_password, department_id) VALUES (?, ?, ?)',
+                         [(username, password_hash, dept_id) for username, dept_id in dataset["users"]])
+        conn.executemany('INSERT INTO FiscalYears (id, year_name, is_active) VALUES (?, ?, ?)',
+                         dataset["fiscal_years"])
+        conn.executemany('INSERT INTO BudgetCategories (id, name) VALUES (?, ?)', dataset["categories"])
+        conn.executemany('''
+            INSERT INTO Allocations (id, department_id, category_id, fiscal_year_id, amount)
+            VALUES (?, ?, ?, ?, ?)
+        ''', dataset["allocations"])
+        conn.executemany('''
+            INSERT INTO Expenditures (id, allocation_id, amount, description, date)
+            VALUES (?, ?, ?, ?, ?)
+        ''', dataset["expenditures"])
+    conn.execute('PRAGMA synchronous = FULL')
+
+def communication_dataset(config, seed):
+    """
+    Generate the messages of a communication database. Most messages go to
+    a handful of departments; some are broadcast to a top-level department,
+    so they fan out to its whole subtree.
+    """
+    rng = random.Random(seed)
+    departments = generate_departments(config["departments"], config["depth"], seed)
+    dept_ids = [dept["id"] for dept in departments]
+    top_level = [dept["id"] for dept in departments if dept["parent_id"] is None]
+
+    messages = []
+    for message_id in range(1, config["messages"] + 1):
+        count = min(int(rng.paretovariate(1.5)), config["recipients"], len(dept_ids))
+        recipients = set(rng.sample(dept_ids, count))
+        if rng.random() < BROADCAST_SHARE:
+            recipients.add(rng.choice(top_level))
+
+        # Most bodies are short; some are long enough to be compressed
+        body = random_text(rng, rng.choice((20, 40, 400)))
+        timestamp = (FIRST_MESSAGE_TIME + datetime.timedelta(minutes=message_id)).isoformat()
+        messages.append((message_id, rng.choice(dept_ids), sorted(recipients), random_text(rng, 5), body, timestamp))
+
+    return {"departments": departments, "messages": messages}
+
+def load_communication(db, hierarchy, dataset):
+    """
+    Load generated messages through a communication db module, in a single
+    transaction with synchronous=OFF, after syncing the generated hierarchy.
+    Bodies are encoded the way the service stores them.
+    """
+    index = hierarchy.get_hierarchy_index(dataset["departments"])
+    db.sync_department_intervals(index)
+
+    conn = db.get_db_connection()
+    conn.execute('PRAGMA synchronous = OFF')
+    with conn:
+        conn.executemany(
+            'INSERT INTO Messages (id, sender_department_id, subject, body, timestamp) VALUES (?, ?, ?, ?, ?)',
+            [(m[0], m[1], m[3], '', m[5]) for m in dataset["messages"]]
+        )
+        conn.executemany(
+            'INSERT INTO MessageBodies (message_id, encoding, body) VALUES (?, ?, ?)',
+            [(m[0],) + db.encode_body(m[4]) for m in dataset["messages"]]
+        )
+        conn.executemany(
+            'INSERT INTO MessageRecipients (message_id, recipient_department_id) VALUES (?, ?)',
+            [(m[0], dept_id) for m in dataset["messages"] for dept_id in m[2]]
+        )
+        if db.INBOX_DELIVERY_MODE == 'fanout':
+            db.materialise_deliveries(conn)
+        # Counters are recomputed on first read
+        conn.execute('DELETE FROM UnreadCounts')
+    conn.close()
+
+    return index
+
+def generate(service, config, seed):
+    """Generate and load one service's dataset into the database selected by DATA_DIR"""
+    harness.use_service(f"{service}_service")
+    import db
+
+    if service == 'budgeting':
+        from passlib.hash import pbkdf2_sha256
+        conn = db.get_db_connection()
+        load_budgeting(conn, budgeting_dataset(config, seed), pbkdf2_sha256.hash(PASSWORD))
+        conn.close()
+    else:
+        import hierarchy
+        load_communication(db, hierarchy, communication_dataset(config, seed))
+
+    print(f"Generated {service} data in {db.DB_PATH}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate large synthetic university datasets")
+    parser.add_argument('--service', choices=['budgeting', 'communication', 'all'], default='all')
+    parser.add_argument('--data-dir', required=True, help="directory for the generated databases")
+    parser.add_argument('--scale', choices=sorted(harness.SCALES), default='medium')
+    for field in harness.SCALES['small']:
+        parser.add_argument(f'--{field}', type=int, help=f"override the scale's {field}")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    config = dict(harness.SCALES[args.scale])
+    for field in config:
+        if getattr(args, field) is not None:
+            config[field] = getattr(args, field)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    os.environ['DATA_DIR'] = os.path.abspath(args.data_dir)
+
+    if args.service != 'all':
+        generate(args.service, config, args.seed)
+        return
+
+    # Both services use the same module names, so each is generated in its own process
+    for service in ('budgeting', 'communication'):
+        command = [sys.executable, os.path.abspath(__file__), '--service', service,
+                   '--data-dir', args.data_dir, '--seed', str(args.seed), '--scale', args.scale]
+        for field, value in config.items():
+            command += [f'--{field}', str(value)]
+        subprocess.run(command, check=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import json
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Dataset sizes for each scale preset; any field can be overridden on the command line
+SCALES = {
+    "small": {
+        "departments": 100, "depth": 4, "fiscal_years": 3, "categories": 8,
+        "allocations": 2000, "expenditures": 10000, "messages": 2000, "recipients": 3
+    },
+    "medium": {
+        "departments": 1000, "depth": 6, "fiscal_years": 10, "categories": 12,
+        "allocations": 20000, "expenditures": 100000, "messages": 20000, "recipients": 5
+    },
+    "large": {
+        "departments": 5000, "depth": 8, "fiscal_years": 20, "categories": 20,
+        "allocations": 100000, "expenditures": 1000000, "messages": 100000, "recipients": 8
+    }
+}
+
+def use_service(service):
+    """Make a service's app modules importable; both services reuse module names, so one per process"""
+    sys.path.insert(0, os.path.join(ROOT, 'common'))
+    sys.path.insert(0, os.path.join(ROOT, service, 'app'))
+
+def measure(fn, iterations, warmup=3):
+    """Time fn over a number of iterations and summarise the latencies"""
+    for _ in range(warmup):
+        fn()
+
+    timings = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - call_started) * 1000)
+    elapsed = time.perf_counter() - started
+
+    timings.sort()
+    return {
+        "iterations": iterations,
+        "ops_per_sec": iterations / elapsed if elapsed else 0.0,
+        "mean_ms": statistics.mean(timings),
+        "p50_ms": timings[len(timings) // 2],
+        "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    }
+
+def write_results(path, results):
+    """Write a suite's results where the runner expects them"""
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
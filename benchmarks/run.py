@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import harness
+
+SUITES = {
+    "budgeting": "budgeting_suite.py",
+    "communication": "communication_suite.py"
+}
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+def run_suite(name, config, seed, iterations, keep):
+    """Run one suite in its own process against a fresh temporary data directory"""
+    data_dir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    output = os.path.join(data_dir, 'results.json')
+
+    env = dict(os.environ)
+    env.update({
+        "DATA_DIR": data_dir,
+        "LOG_LEVEL": env.get("LOG_LEVEL", "WARNING"),
+        "SLOW_QUERY_MS": env.get("SLOW_QUERY_MS", "1000"),
+        "MESSAGE_DELIVERY": "sync"
+    })
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), SUITES[name])
+    try:
+        subprocess.run([
+            sys.executable, script,
+            '--config', json.dumps(config),
+            '--seed', str(seed),
+            '--iterations', str(iterations),
+            '--output', output
+        ], env=env, check=True)
+
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        if keep:
+            print(f"Kept {name} data in {data_dir}")
+        else:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+def compare(results, baseline, tolerance):
+    """Print each case against the baseline p50 and return the names of regressed cases"""
+    regressions = []
+    print(f"{'case':<40} {'p50 ms':>10} {'p95 ms':>10} {'ops/s':>10} {'baseline':>10} {'change':>8}")
+
+    for suite, cases in results.items():
+        for case, stats in cases.items():
+            if case.startswith('_'):
+                continue
+
+            name = f"{suite}.{case}"
+            previous = baseline.get(suite, {}).get(case)
+            line = f"{name:<40} {stats['p50_ms']:>10.3f} {stats['p95_ms']:>10.3f} {stats['ops_per_sec']:>10.1f}"
+
+            if previous:
+                change = stats['p50_ms'] / previous['p50_ms'] - 1 if previous['p50_ms'] else 0.0
+                flag = '  REGRESSION' if change > tolerance else ''
+                line += f" {previous['p50_ms']:>10.3f} {change:>+8.1%}{flag}"
+                if flag:
+                    regressions.append(name)
+            print(line)
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmark suites and compare against a baseline")
+    parser.add_argument('--scale', choices=sorted(harness.SCALES), default='small')
+    for field in harness.SCALES['small']:
+        parser.add_argument(f'--{field}', type=int, help=f"override the scale's {field}")
+    parser.add_argument('--suite', choices=sorted(SUITES) + ['all'], default='all')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed p50 slowdown before a case counts as a regression")
+    parser.add_argument('--keep', action='store_true', help="keep the generated databases")
+    args = parser.parse_args()
+
+    config = dict(harness.SCALES[args.scale])
+    for field in config:
+        if getattr(args, field) is not None:
+            config[field] = getattr(args, field)
+
+    suites = sorted(SUITES) if args.suite == 'all' else [args.suite]
+    results = {name: run_suite(name, config, args.seed, args.iterations, args.keep) for name in suites}
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    # Baselines are only comparable for the same dataset and seed
+    key = args.scale
+    stored = baselines.get(key)
+    baseline = {}
+    if stored and stored["config"] == config and stored["seed"] == args.seed:
+        baseline = stored["results"]
+    elif stored:
+        print(f"Baseline for '{key}' was recorded with a different dataset; not comparing")
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        merged = dict(baseline)
+        merged.update(results)
+        baselines[key] = {"config": config, "seed": args.seed, "results": merged}
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Saved baseline '{key}' to {args.baseline}")
+
+    if regressions:
+        print(f"{len(regressions)} case(s) regressed by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+import threading
+import numpy as np
+import pandas as pd
+import db
+import metrics
+
+# Fiscal year columns, shared by every session and reloaded when the database changes
+_year_cache = {}
+_cache_lock = threading.Lock()
+
+CACHE_REQUESTS = metrics.counter(
+    'cache_requests_total', 'Cache lookups by cache and result', ['cache', 'result']
+)
+
+MEASURES = ('Allocated', 'Spent', 'Remaining', 'Usage (%)')
+
+def load_fiscal_year(fiscal_year_id):
+    """
+    Fetch a fiscal year's allocation and expenditure columns in one query each,
+    per shard when the database is sharded
+    Returns a dict of NumPy arrays:
+    - allocation_id, department_id, category_id, allocated: one entry per allocation, by allocation_id
+    - expenditure_allocation: index into the allocation arrays for each expenditure
+    - expenditure_amount, expenditure_date: one entry per expenditure
+    - spent, expenditure_count: expenditure totals per allocation
+    and categories, a dict mapping category_id to name
+    """
+    def fetch(conn):
+        conn.row_factory = None
+        allocations = conn.execute('''
+            SELECT id, department_id, category_id, amount
+            FROM Allocations
+            WHERE fiscal_year_id = ?
+            ORDER BY id
+        ''', (fiscal_year_id,)).fetchall()
+        expenditures = conn.execute('''
+            SELECT e.allocation_id, e.amount, e.date
+            FROM Allocations a
+            JOIN Expenditures e ON e.allocation_id = a.id
+            WHERE a.fiscal_year_id = ?
+        ''', (fiscal_year_id,)).fetchall()
+        return allocations, expenditures
+
+    # Shards are read in parallel; their id ranges follow shard order, so the allocations stay sorted
+    results = db.fan_out(fetch)
+    allocations = [row for shard_allocations, _ in results for row in shard_allocations]
+    expenditures = [row for _, shard_expenditures in results for row in shard_expenditures]
+
+    conn = db.get_db_connection()
+    conn.row_factory = None
+    categories = dict(conn.execute('SELECT id, name FROM BudgetCategories').fetchall())
+    conn.close()
+
+    allocation_columns = list(zip(*allocations)) or [(), (), (), ()]
+    allocation_id = np.array(allocation_columns[0], dtype=np.int64)
+    allocated = np.array(allocation_columns[3], dtype=np.float64)
+
+    expenditure_columns = list(zip(*expenditures)) or [(), (), ()]
+    expenditure_amount = np.array(expenditure_columns[1], dtype=np.float64)
+    expenditure_date = np.array([value[:10] for value in expenditure_columns[2]], dtype='datetime64[D]')
+
+    # Allocations are sorted by id, so each expenditure finds its allocation by binary search
+    expenditure_allocation = np.searchsorted(allocation_id, np.array(expenditure_columns[0], dtype=np.int64))
+
+    return {
+        "allocation_id": allocation_id,
+        "department_id": np.array(allocation_columns[1], dtype=np.int64),
+        "category_id": np.array(allocation_columns[2], dtype=np.int64),
+        "allocated": allocated,
+        "expenditure_allocation": expenditure_allocation,
+        "expenditure_amount": expenditure_amount,
+        "expenditure_date": expenditure_date,
+        "spent": np.bincount(expenditure_allocation, weights=expenditure_amount, minlength=len(allocation_id)),
+        "expenditure_count": np.bincount(expenditure_allocation, minlength=len(allocation_id)),
+        "categories": categories
+    }
+
+def get_fiscal_year_data(fiscal_year_id):
+    """Get a fiscal year's columns, reloading them only if the database changed since they were fetched"""
+    version = db.get_data_version()
+    entry = _year_cache.get(fiscal_year_id)
+    if entry is not None and entry["version"] == version:
+        CACHE_REQUESTS.inc(cache='fiscal_year_columns', result='hit')
+        return entry["data"]
+
+    CACHE_REQUESTS.inc(cache='fiscal_year_columns', result='miss')
+    with _cache_lock:
+        entry = _year_cache.get(fiscal_year_id)
+        if entry is None or entry["version"] != version:
+            entry = {"version": version, "data": load_fiscal_year(fiscal_year_id)}
+            _year_cache[fiscal_year_id] = entry
+        return entry["data"]
+
+def tree_arrays(tree):
+    """
+    Lay a department tree out as arrays in preorder
+    Returns department_ids, depths, subtree_sizes and lookup, which maps a
+    department_id to its preorder position (-1 for departments not in the tree)
+    """
+    department_ids = np.array([dept_id for dept_id, _ in tree["preorder"]], dtype=np.int64)
+    lookup = np.full(int(department_ids.max()) + 1 if len(department_ids) else 1, -1, dtype=np.int64)
+    lookup[department_ids] = np.arange(len(department_ids))
+
+    return {
+        "department_ids": department_ids,
+        "depths": np.array([depth for _, depth in tree["preorder"]], dtype=np.int64),
+        "subtree_sizes": np.array([tree["subtree_size"][dept_id] for dept_id in department_ids], dtype=np.int64),
+        "lookup": lookup
+    }
+
+def subtree_sums(matrix, subtree_sizes):
+    """
+    Roll each row of a preorder-ordered matrix up over its subtree. A subtree
+    is a contiguous run of the preorder, so its total is the difference of
+    two prefix sums.
+    """
+    prefix = np.zeros((matrix.shape[0] + 1,) + matrix.shape[1:])
+    np.cumsum(matrix, axis=0, out=prefix[1:])
+    starts = np.arange(matrix.shape[0])
+    return prefix[starts + subtree_sizes] - prefix[starts]
+
+def department_category_matrices(columns, layout, category_ids):
+    """
+    Sum allocated and spent columns into department x category matrices, with
+    departments in preorder and categories in category_ids order. Allocations
+    for departments or categories that no longer exist are left out.
+    """
+    rows = len(layout["department_ids"])
+    width = len(category_ids)
+
+    department_id = columns["department_id"]
+    position = np.full(len(department_id), -1, dtype=np.int64)
+    in_range = department_id < len(layout["lookup"])
+    position[in_range] = layout["lookup"][department_id[in_range]]
+    column = np.minimum(np.searchsorted(category_ids, columns["category_id"]), max(width - 1, 0))
+    valid = (position >= 0) & (width > 0)
+    if width:
+        valid &= category_ids[column] == columns["category_id"]
+
+    cells = position[valid] * width + column[valid]
+    allocated = np.bincount(cells, weights=columns["allocated"][valid], minlength=rows * width).reshape(rows, width)
+    spent = np.bincount(cells, weights=columns["spent"][valid], minlength=rows * width).reshape(rows, width)
+    return allocated, spent
+
+def build_rollup(fiscal_year_id, tree):
+    """
+    Aggregate a fiscal year into department x category matrices, in preorder
+    Returns a dict with the tree arrays, category_ids and category_names, the
+    own allocated and spent matrices, the subtree_allocated and subtree_spent
+    matrices that include all descendants, and elapsed_days, the span of the
+    year's expenditures used for burn rates
+    """
+    data = get_fiscal_year_data(fiscal_year_id)
+    dates = data["expenditure_date"]
+    elapsed_days = int((dates.max() - dates.min()).astype(np.int64)) + 1 if len(dates) else 0
+    return rollup_from_columns(data, data["categories"], tree, elapsed_days)
+
+def rollup_from_columns(columns, categories, tree, elapsed_days):
+    """Build a rollup from department_id, category_id, allocated and spent columns"""
+    layout = tree_arrays(tree)
+    category_ids = np.array(sorted(categories), dtype=np.int64)
+    allocated, spent = department_category_matrices(columns, layout, category_ids)
+
+    rollup = dict(layout)
+    rollup.update({
+        "category_ids": category_ids,
+        "category_names": [categories[category_id] for category_id in category_ids],
+        "allocated": allocated,
+        "spent": spent,
+        "subtree_allocated": subtree_sums(allocated, layout["subtree_sizes"]),
+        "subtree_spent": subtree_sums(spent, layout["subtree_sizes"]),
+        "elapsed_days": elapsed_days,
+        "department_names": tree["department_names"]
+    })
+    return rollup
+
+def scope_rows(rollup, dept_id=None):
+    """Get the preorder slice covering a department's subtree, or the whole university"""
+    if dept_id is None:
+        return slice(0, len(rollup["department_ids"]))
+
+    position = rollup["lookup"][dept_id] if 0 <= dept_id < len(rollup["lookup"]) else -1
+    if position < 0:
+        return slice(0, 0)
+    return slice(position, position + rollup["subtree_sizes"][position])
+
+def add_measures(frame, elapsed_days):
+    """
+    Derive the remaining budget (the variance, negative when overspent),
+    usage, daily burn rate and the days of runway left at that rate
+    """
+    allocated = frame['Allocated'].to_numpy()
+    spent = frame['Spent'].to_numpy()
+    remaining = allocated - spent
+    burn = spent / elapsed_days if elapsed_days else np.zeros(len(frame))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frame['Remaining'] = remaining
+        frame['Usage (%)'] = np.where(allocated > 0, spent / allocated * 100, 0.0)
+        frame['Daily Burn'] = burn
+        frame['Runway (days)'] = np.where((burn > 0) & (remaining > 0), remaining / burn, np.nan)
+    return frame
+
+def category_summary(rollup, dept_id=None):
+    """
+    Allocated and spent per budget category for a department's subtree, or the
+    whole university, leaving out categories without allocations
+    """
+    rows = scope_rows(rollup, dept_id)
+    if dept_id is None:
+        allocated = rollup["allocated"].sum(axis=0)
+        spent = rollup["spent"].sum(axis=0)
+    elif rows.stop > rows.start:
+        allocated = rollup["subtree_allocated"][rows.start]
+        spent = rollup["subtree_spent"][rows.start]
+    else:
+        allocated = spent = np.zeros(len(rollup["category_ids"]))
+
+    frame = pd.DataFrame({
+        'Category': rollup["category_names"],
+        'Allocated': np.round(allocated, 2),
+        'Spent': np.round(spent, 2)
+    })
+    frame = frame[frame['Allocated'] > 0].reset_index(drop=True)
+    return add_measures(frame, rollup["elapsed_days"])
+
+def department_summary(rollup, dept_id=None, include_subtree=True):
+    """
+    Allocated and spent per department, in tree order, for a department's
+    subtree or the whole university. With include_subtree each department's
+    totals include its descendants.
+    """
+    rows = scope_rows(rollup, dept_id)
+    prefix = 'subtree_' if include_subtree else ''
+    department_ids = rollup["department_ids"][rows]
+
+    frame = pd.DataFrame({
+        'Department ID': department_ids,
+        'Department': department_labels(rollup, rows),
+        'Allocated': np.round(rollup[prefix + 'allocated'][rows].sum(axis=1), 2),
+        'Spent': np.round(rollup[prefix + 'spent'][rows].sum(axis=1), 2)
+    })
+    return add_measures(frame, rollup["elapsed_days"])
+
+def department_category_breakdown(rollup, dept_id=None, measure='Spent', include_subtree=True):
+    """
+    Pivot a measure into departments x categories for a department's subtree
+    or the whole university, leaving out categories without allocations
+    """
+    rows = scope_rows(rollup, dept_id)
+    prefix = 'subtree_' if include_subtree else ''
+    allocated = rollup[prefix + 'allocated'][rows]
+    spent = rollup[prefix + 'spent'][rows]
+
+    if measure == 'Allocated':
+        values = allocated
+    elif measure == 'Spent':
+        values = spent
+    elif measure == 'Remaining':
+        values = allocated - spent
+    else:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.where(allocated > 0, spent / allocated * 100, 0.0)
+
+    used = allocated.sum(axis=0) > 0
+    frame = pd.DataFrame(
+        np.round(values[:, used], 2),
+        columns=[name for name, keep in zip(rollup["category_names"], used) if keep]
+    )
+    frame.insert(0, 'Department', department_labels(rollup, rows))
+    return frame
+
+def department_labels(rollup, rows):
+    """Department names indented by depth, for a preorder slice"""
+    names = rollup["department_names"]
+    return [('  ' * depth) + names.get(dept_id, f"Department {dept_id}")
+            for dept_id, depth in zip(rollup["department_ids"][rows].tolist(), rollup["depths"][rows].tolist())]
+
+def with_total(frame, label_column, elapsed_days):
+    """Append a TOTAL row summing the amount columns and recomputing the derived measures"""
+    totals = pd.DataFrame([{
+        label_column: 'TOTAL',
+        'Allocated': frame['Allocated'].sum(),
+        'Spent': frame['Spent'].sum()
+    }])
+    return pd.concat([frame, add_measures(totals, elapsed_days)], ignore_index=True)
+
+def format_amounts(frame):
+    """Format amount and ratio columns for display"""
+    display = frame.copy()
+    for column in ('Allocated', 'Spent', 'Remaining', 'Daily Burn'):
+        if column in display:
+            display[column] = display[column].map('${:,.2f}'.format)
+    if 'Usage (%)' in display:
+        display['Usage (%)'] = display['Usage (%)'].map('{:.1f}%'.format)
+    if 'Runway (days)' in display:
+        display['Runway (days)'] = display['Runway (days)'].map(lambda days: '-' if np.isnan(days) else f"{days:,.0f}")
+    return display
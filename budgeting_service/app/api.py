@@ -1,15 +1,52 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
+import datetime
+import analytics
+import audit
+import comparison
 import db
+import db_writer
+import forecasting
+import hierarchy
+import logs
+import metrics
+import query_stats
+import rollover
+import snapshots
 from passlib.hash import pbkdf2_sha256
 import time
 
 app = Flask(__name__)
 CORS(app)
 
+logger = logs.get_logger('api')
+
 # Track when the service started
 SERVICE_START_TIME = time.time()
 
+REQUEST_LATENCY = metrics.histogram(
+    'http_request_duration_seconds', 'API request latency', ['endpoint', 'method', 'status']
+)
+AUTH_REQUESTS = metrics.counter(
+    'auth_requests_total', 'Authentication requests by outcome', ['outcome']
+)
+
+@app.before_request
+def start_request():
+    # Continue the caller's correlation id so both services' logs can be joined
+    logs.set_correlation_id(request.headers.get(logs.CORRELATION_HEADER))
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def finish_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUEST_LATENCY.observe(
+        time.perf_counter() - g.request_started,
+        endpoint=endpoint, method=request.method, status=response.status_code
+    )
+    response.headers[logs.CORRELATION_HEADER] = logs.get_correlation_id()
+    return response
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -20,6 +57,21 @@ def health_check():
         'uptime_seconds': uptime
     })
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Metrics in the Prometheus text format"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/api/metrics/queries', methods=['GET'])
+def query_metrics():
+    """Per-statement query latency histograms and row counts, plus write lock waits"""
+    return jsonify({
+        'service': 'budgeting',
+        'slow_query_ms': query_stats.SLOW_QUERY_MS,
+        'queries': query_stats.get_query_stats(),
+        'writes': db_writer.get_write_stats()
+    })
+
 @app.route('/api/departments', methods=['GET'])
 def get_departments():
     """Get all departments in a hierarchical structure"""
@@ -33,32 +85,249 @@ def get_departments():
     
     return jsonify(department_list)
 
+def check_credentials(username, password):
+    """Get the user with a username if the password is theirs, else None"""
+    if not isinstance(username, str) or not isinstance(password, str):
+        return None
+    
+    conn = db.get_db_connection()
+    user = conn.execute(
+        'SELECT id, username, hashed_password, department_id FROM Users WHERE username = ?', 
+        (username,)
+    ).fetchone()
+    conn.close()
+    
+    if not user or not pbkdf2_sha256.verify(password, user['hashed_password']):
+        return None
+    return user
+
 @app.route('/api/authenticate', methods=['POST'])
 def authenticate():
     """Authenticate a user with username and password"""
     data = request.get_json()
     
     if not data or 'username' not in data or 'password' not in data:
+        AUTH_REQUESTS.inc(outcome='bad_request')
         return jsonify({'error': 'Username and password required'}), 400
     
     username = data['username']
-    password = data['password']
-    
-    conn = db.get_db_connection()
-    user = conn.execute(
-        'SELECT id, username, hashed_password, department_id FROM Users WHERE username = ?', 
-        (username,)
-    ).fetchone()
-    conn.close()
+    user = check_credentials(username, data['password'])
     
-    if not user or not pbkdf2_sha256.verify(password, user['hashed_password']):
+    if not user:
+        AUTH_REQUESTS.inc(outcome='rejected')
+        logger.info("Rejected login for user %s", username)
         return jsonify({'error': 'Invalid username or password'}), 401
     
+    AUTH_REQUESTS.inc(outcome='success')
     return jsonify({
         'user_id': user['id'],
         'username': user['username'],
         'department_id': user['department_id']
     })
 
+@app.route('/api/forecasts', methods=['POST'])
+def forecasts():
+    """
+    Projected year-end spend for a batch of allocations. Takes an optional
+    fiscal_year_id (default: the active year), allocation_ids (default: all),
+    as_of date (default: today) and overrun_only flag.
+    """
+    data = request.get_json(silent=True) or {}
+    
+    fiscal_year_id = data.get('fiscal_year_id')
+    if fiscal_year_id is None:
+        conn = db.get_db_connection()
+        active = conn.execute('SELECT id FROM FiscalYears WHERE is_active = 1').fetchone()
+        conn.close()
+        if not active:
+            return jsonify({'error': 'No active fiscal year'}), 404
+        fiscal_year_id = active['id']
+    
+    try:
+        as_of = datetime.date.fromisoformat(data['as_of']) if data.get('as_of') else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'as_of must be a YYYY-MM-DD date'}), 400
+    
+    forecast = forecasting.get_forecast(fiscal_year_id, as_of)
+    if forecast is None:
+        return jsonify({'error': 'Fiscal year not found'}), 404
+    
+    frame = forecast['frame']
+    if data.get('allocation_ids') is not None:
+        frame = frame[frame['allocation_id'].isin(data['allocation_ids'])]
+    if data.get('overrun_only'):
+        frame = frame[frame['overrun'] > 0]
+    
+    # NaN is not valid JSON, so a missing seasonal forecast becomes null
+    records = frame.astype(object).where(frame.notna(), None).to_dict('records')
+    return jsonify({
+        'fiscal_year_id': fiscal_year_id,
+        'year_start': forecast['year_start'].isoformat(),
+        'year_end': forecast['year_end'].isoformat(),
+        'as_of': forecast['as_of'].isoformat(),
+        'forecasts': records
+    })
+
+@app.route('/api/fiscal-years/rollover', methods=['POST'])
+def fiscal_year_rollover():
+    """
+    Open a new fiscal year with a copy of another year's allocations. Takes
+    the caller's username and password, source_fiscal_year_id, year_name,
+    optional adjustments ({category_id: percent}), activate (default true)
+    and dry_run to preview without writing.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    if 'username' not in data or 'password' not in data:
+        return jsonify({'error': 'Username and password required'}), 400
+    
+    user = check_credentials(data['username'], data['password'])
+    if not user:
+        logger.info("Rejected rollover for user %s", data['username'])
+        return jsonify({'error': 'Invalid username or password'}), 401
+    
+    if data.get('source_fiscal_year_id') is None or not data.get('year_name'):
+        return jsonify({'error': 'source_fiscal_year_id and year_name are required'}), 400
+    if not isinstance(data['year_name'], str):
+        return jsonify({'error': 'year_name must be a string'}), 400
+    if not isinstance(data.get('adjustments') or {}, dict):
+        return jsonify({'error': 'adjustments must be an object mapping category_id to percent'}), 400
+    if not all(isinstance(data.get(flag, False), bool) for flag in ('activate', 'dry_run')):
+        return jsonify({'error': 'activate and dry_run must be true or false'}), 400
+    
+    # Recorded as the actor of the new year's allocations in the audit log
+    db.set_actor(user['username'])
+    try:
+        result = rollover.roll_over(
+            int(data['source_fiscal_year_id']),
+            data['year_name'],
+            adjustments=data.get('adjustments'),
+            activate=data.get('activate', True),
+            dry_run=data.get('dry_run', False)
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(result), 200 if result['dry_run'] else 201
+
+@app.route('/api/comparison', methods=['GET'])
+def year_comparison():
+    """
+    Allocated, spent and usage aligned across fiscal years. Takes
+    fiscal_year_ids (comma separated, default: all), an optional department_id
+    to limit the comparison to its subtree, and by=category or by=department.
+    """
+    by = request.args.get('by', 'category')
+    if by not in ('category', 'department'):
+        return jsonify({'error': 'by must be category or department'}), 400
+    
+    try:
+        fiscal_year_ids = [int(value) for value in request.args['fiscal_year_ids'].split(',') if value] \
+            if request.args.get('fiscal_year_ids') else None
+        department_id = request.args.get('department_id', type=int)
+    except ValueError:
+        return jsonify({'error': 'fiscal_year_ids must be comma separated integers'}), 400
+    
+    conn = db.get_db_connection()
+    departments = conn.execute('SELECT id, name, parent_id FROM Departments').fetchall()
+    if fiscal_year_ids is None:
+        fiscal_year_ids = [row['id'] for row in conn.execute('SELECT id FROM FiscalYears').fetchall()]
+    conn.close()
+    
+    tree = hierarchy.build_department_tree(departments)
+    if department_id is not None and department_id not in tree["position"]:
+        return jsonify({'error': 'Department not found'}), 404
+    
+    frame = comparison.compare_years(fiscal_year_ids, tree, department_id, by)
+    return jsonify({
+        'fiscal_years': list(dict.fromkeys(frame['Fiscal Year'])),
+        'department_id': department_id,
+        'by': by,
+        'rows': frame.to_dict('records')
+    })
+
+@app.route('/api/audit', methods=['GET'])
+def audit_log():
+    """
+    Audit entries, newest first. Takes optional since and until ISO
+    timestamps, table, actor and limit (default 100, at most 1000).
+    """
+    table_name = request.args.get('table')
+    if table_name and table_name not in db.AUDITED_TABLES:
+        return jsonify({'error': f"table must be one of {', '.join(db.AUDITED_TABLES)}"}), 400
+    
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
+    
+    limit = min(limit, 1000)
+    return jsonify(audit.get_changes(
+        since=request.args.get('since'),
+        until=request.args.get('until'),
+        table_name=table_name,
+        actor=request.args.get('actor'),
+        limit=limit
+    ))
+
+@app.route('/api/audit/<table_name>/<int:entity_id>', methods=['GET'])
+def audit_history(table_name, entity_id):
+    """Every change to one row of an audited table, oldest first"""
+    if table_name not in db.AUDITED_TABLES:
+        return jsonify({'error': f"table must be one of {', '.join(db.AUDITED_TABLES)}"}), 400
+    return jsonify(audit.get_entity_history(table_name, entity_id))
+
+@app.route('/api/audit/verify', methods=['GET'])
+def audit_verify():
+    """Check the audit log's hash chain"""
+    result = audit.verify_chain()
+    return jsonify(result), 200 if result['first_invalid_id'] is None else 409
+
+@app.route('/api/budget/as-of', methods=['GET'])
+def budget_as_of():
+    """
+    Allocated and spent per category, and per department, for a fiscal year
+    as it stood at the end of a date. Takes fiscal_year_id, date (YYYY-MM-DD)
+    and an optional department_id to limit the summary to its subtree.
+    """
+    fiscal_year_id = request.args.get('fiscal_year_id', type=int)
+    try:
+        as_of = datetime.date.fromisoformat(request.args.get('date', ''))
+    except ValueError:
+        return jsonify({'error': 'date must be YYYY-MM-DD'}), 400
+    if fiscal_year_id is None:
+        return jsonify({'error': 'fiscal_year_id is required'}), 400
+    department_id = request.args.get('department_id', type=int)
+    
+    conn = db.get_db_connection()
+    year = conn.execute('SELECT id FROM FiscalYears WHERE id = ?', (fiscal_year_id,)).fetchone()
+    departments = conn.execute('SELECT id, name, parent_id FROM Departments').fetchall()
+    conn.close()
+    
+    if year is None:
+        return jsonify({'error': 'Fiscal year not found'}), 404
+    tree = hierarchy.build_department_tree(departments)
+    if department_id is not None and department_id not in tree["position"]:
+        return jsonify({'error': 'Department not found'}), 404
+    
+    rollup = snapshots.rollup_as_of(fiscal_year_id, as_of, tree)
+    return jsonify({
+        'fiscal_year_id': fiscal_year_id,
+        'date': as_of.isoformat(),
+        'department_id': department_id,
+        'categories': analytics.category_summary(rollup, department_id).to_dict('records'),
+        'departments': analytics.department_summary(rollup, department_id).to_dict('records')
+    })
+
+@app.route('/api/allocations/<int:allocation_id>/versions', methods=['GET'])
+def allocation_versions(allocation_id):
+    """Every version of an allocation, oldest first"""
+    versions = snapshots.get_allocation_versions(allocation_id)
+    if not versions:
+        return jsonify({'error': 'Allocation not found'}), 404
+    return jsonify(versions)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000) 
\ No newline at end of file
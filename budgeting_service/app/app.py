@@ -1,8 +1,15 @@
 import streamlit as st
 import pandas as pd
 from datetime import datetime
+import analytics
+import balances
+import comparison
 import db
-import sqlite3
+import forecasting
+import hierarchy
+import rollover
+import snapshots
+import storage
 
 # Set page config
 st.set_page_config(page_title="University Budgeting System", layout="wide")
@@ -81,22 +88,23 @@ def get_active_fiscal_year():
     conn.close()
     return fiscal_year
 
+# Helper function to build the department tree index once per page
+def get_department_tree():
+    return hierarchy.build_department_tree(get_departments())
+
 # Helper function to format departments as a hierarchical tree for display
-def format_department_hierarchy(departments, parent_id=None, level=0):
-    formatted = []
-    for dept in departments:
-        if dept['parent_id'] == parent_id:
-            formatted.append({
-                'id': dept['id'],
-                'name': ('  ' * level) + dept['name'],
-                'parent_id': dept['parent_id']
-            })
-            # Add children recursively
-            formatted.extend(format_department_hierarchy(departments, dept['id'], level + 1))
-    return formatted
+def format_department_hierarchy(tree):
+    return [{
+        'id': dept_id,
+        'name': ('  ' * depth) + tree["department_names"][dept_id],
+        'parent_id': tree["parent_mapping"][dept_id]
+    } for dept_id, depth in tree["preorder"]]
 
 # Main application
 def main_app():
+    # Writes made during this run are recorded in the audit log under this user
+    db.set_actor(st.session_state.username)
+    
     # Sidebar with navigation
     st.sidebar.title(f"Welcome, {st.session_state.username}")
     
@@ -109,7 +117,7 @@ def main_app():
     page = st.sidebar.selectbox(
         "Navigate to",
         ["Department Management", "Fiscal Years", "Budget Categories", 
-         "Allocations", "Expenditures", "Budget Overview"]
+         "Allocations", "Expenditures", "Budget Overview", "Year Comparison"]
     )
     
     if page == "Department Management":
@@ -124,6 +132,8 @@ def main_app():
         expenditure_page()
     elif page == "Budget Overview":
         budget_overview_page()
+    elif page == "Year Comparison":
+        year_comparison_page()
 
 # Department Management page
 def department_page():
@@ -135,38 +145,27 @@ def department_page():
             name = st.text_input("Department Name")
             
             # Get departments for parent selection
-            departments = get_departments()
-            formatted_depts = format_department_hierarchy(departments)
+            tree = get_department_tree()
             
-            dept_options = ["None"] + [d['name'] for d in formatted_depts]
-            selected_parent = st.selectbox("Parent Department", dept_options)
+            parent_id = st.selectbox(
+                "Parent Department",
+                [None] + hierarchy.department_options(tree),
+                format_func=lambda dept_id: "None" if dept_id is None else hierarchy.format_department_label(tree, dept_id)
+            )
             
             submit = st.form_submit_button("Add Department")
             
             if submit and name:
-                parent_id = None
-                if selected_parent != "None":
-                    # Extract the actual department name (without the indentation spaces)
-                    selected_name = selected_parent.strip()
-                    for dept in departments:
-                        if dept['name'] == selected_name:
-                            parent_id = dept['id']
-                            break
-                
-                conn = db.get_db_connection()
-                conn.execute(
+                db.run_write(lambda conn: conn.execute(
                     'INSERT INTO Departments (name, parent_id) VALUES (?, ?)',
                     (name, parent_id)
-                )
-                conn.commit()
-                conn.close()
+                ))
                 st.success(f"Department '{name}' added successfully!")
                 st.experimental_rerun()
     
     # View departments
     st.subheader("Department Hierarchy")
-    departments = get_departments()
-    formatted_depts = format_department_hierarchy(departments)
+    formatted_depts = format_department_hierarchy(get_department_tree())
     
     if formatted_depts:
         df = pd.DataFrame(formatted_depts)
@@ -187,28 +186,77 @@ def fiscal_year_page():
             submit = st.form_submit_button("Add Fiscal Year")
             
             if submit and year_name:
-                conn = db.get_db_connection()
+                def add_fiscal_year(conn):
+                    fiscal_year_id = conn.execute(
+                        'INSERT INTO FiscalYears (year_name, is_active) VALUES (?, 0) RETURNING id', (year_name,)
+                    ).fetchone()[0]
+                    # Switched the same way as a rollover, so only one year is ever active
+                    if is_active:
+                        rollover.set_active_fiscal_year(conn, fiscal_year_id)
                 
-                # If setting as active, deactivate all other fiscal years
-                if is_active:
-                    conn.execute('UPDATE FiscalYears SET is_active = 0')
-                
-                conn.execute(
-                    'INSERT INTO FiscalYears (year_name, is_active) VALUES (?, ?)',
-                    (year_name, 1 if is_active else 0)
-                )
-                conn.commit()
-                conn.close()
+                db.run_write(add_fiscal_year)
                 st.success(f"Fiscal Year '{year_name}' added successfully!")
                 st.experimental_rerun()
     
-    # View and manage fiscal years
-    st.subheader("Fiscal Years")
-    
     conn = db.get_db_connection()
     fiscal_years = conn.execute('SELECT id, year_name, is_active FROM FiscalYears').fetchall()
+    categories = conn.execute('SELECT id, name FROM BudgetCategories ORDER BY name').fetchall()
     conn.close()
     
+    # Open a new year with a copy of an existing year's allocations
+    if fiscal_years:
+        with st.expander("Roll Over Fiscal Year"):
+            with st.form("rollover_form"):
+                year_names = {fy['id']: fy['year_name'] for fy in fiscal_years}
+                active_ids = [fy['id'] for fy in fiscal_years if fy['is_active']]
+                source_id = st.selectbox(
+                    "Copy Allocations From",
+                    list(year_names),
+                    index=list(year_names).index(active_ids[0]) if active_ids else len(year_names) - 1,
+                    format_func=lambda fiscal_year_id: year_names[fiscal_year_id]
+                )
+                new_year_name = st.text_input("New Fiscal Year (e.g., 2025-2026)")
+                activate = st.checkbox("Set as Active", value=True)
+                
+                st.write("Adjustment per category (%)")
+                columns = st.columns(3)
+                adjustments = {}
+                for i, category in enumerate(categories):
+                    with columns[i % 3]:
+                        adjustments[category['id']] = st.number_input(
+                            category['name'], value=0.0, min_value=-100.0, step=1.0, key=f"rollover_{category['id']}"
+                        )
+                
+                col1, col2 = st.columns(2)
+                with col1:
+                    preview = st.form_submit_button("Preview")
+                with col2:
+                    submit = st.form_submit_button("Roll Over")
+            
+            if (preview or submit) and new_year_name:
+                adjustments = {category_id: percent for category_id, percent in adjustments.items() if percent}
+                try:
+                    result = rollover.roll_over(source_id, new_year_name, adjustments, activate, dry_run=preview)
+                except ValueError as e:
+                    st.error(str(e))
+                else:
+                    if submit:
+                        st.success(f"Fiscal Year '{new_year_name}' opened with {result['allocations']:,} allocations!")
+                        st.experimental_rerun()
+                    
+                    st.info(f"{result['allocations']:,} allocations totalling ${result['new_total']:,.2f} "
+                            f"(currently ${result['source_total']:,.2f}) would be copied into '{new_year_name}'.")
+                    st.dataframe(pd.DataFrame([{
+                        'Category': category['category'],
+                        'Allocations': category['allocations'],
+                        'Adjustment (%)': category['adjustment_percent'],
+                        'Current': f"${category['source_amount']:,.2f}",
+                        'New': f"${category['amount']:,.2f}"
+                    } for category in result['categories']]), hide_index=True)
+    
+    # View and manage fiscal years
+    st.subheader("Fiscal Years")
+    
     if fiscal_years:
         for fy in fiscal_years:
             col1, col2 = st.columns([3, 1])
@@ -219,11 +267,7 @@ def fiscal_year_page():
             with col2:
                 if not fy['is_active']:
                     if st.button(f"Set Active", key=f"activate_{fy['id']}"):
-                        conn = db.get_db_connection()
-                        conn.execute('UPDATE FiscalYears SET is_active = 0')
-                        conn.execute('UPDATE FiscalYears SET is_active = 1 WHERE id = ?', (fy['id'],))
-                        conn.commit()
-                        conn.close()
+                        db.run_write(lambda conn, fiscal_year_id=fy['id']: rollover.set_active_fiscal_year(conn, fiscal_year_id))
                         st.success(f"Fiscal Year '{fy['year_name']}' set as active!")
                         st.experimental_rerun()
     else:
@@ -240,16 +284,14 @@ def budget_category_page():
             submit = st.form_submit_button("Add Category")
             
             if submit and name:
-                conn = db.get_db_connection()
                 try:
-                    conn.execute('INSERT INTO BudgetCategories (name) VALUES (?)', (name,))
-                    conn.commit()
+                    db.run_write(lambda conn: conn.execute(
+                        'INSERT INTO BudgetCategories (name) VALUES (?)', (name,)
+                    ))
                     st.success(f"Category '{name}' added successfully!")
                     st.experimental_rerun()
-                except sqlite3.IntegrityError:
+                except storage.INTEGRITY_ERRORS:
                     st.error(f"Category '{name}' already exists!")
-                finally:
-                    conn.close()
     
     # View categories
     st.subheader("Existing Categories")
@@ -280,17 +322,12 @@ def allocation_page():
     with st.expander("Add New Allocation"):
         with st.form("add_allocation_form"):
             # Get departments
-            departments = get_departments()
-            formatted_depts = format_department_hierarchy(departments)
-            dept_options = [d['name'] for d in formatted_depts]
-            selected_dept = st.selectbox("Department", dept_options)
-            
-            # Get the actual department ID
-            dept_id = None
-            for dept in departments:
-                if dept['name'] == selected_dept.strip():
-                    dept_id = dept['id']
-                    break
+            tree = get_department_tree()
+            dept_id = st.selectbox(
+                "Department",
+                hierarchy.department_options(tree),
+                format_func=lambda dept_id: hierarchy.format_department_label(tree, dept_id)
+            )
             
             # Get budget categories
             conn = db.get_db_connection()
@@ -312,34 +349,28 @@ def allocation_page():
             submit = st.form_submit_button("Add Allocation")
             
             if submit and dept_id and category_id and amount > 0:
-                conn = db.get_db_connection()
-                try:
-                    conn.execute('''
-                        INSERT INTO Allocations 
-                        (department_id, category_id, fiscal_year_id, amount) 
-                        VALUES (?, ?, ?, ?)
-                    ''', (dept_id, category_id, active_fiscal_year['id'], amount))
-                    conn.commit()
-                    st.success("Allocation added successfully!")
-                    st.experimental_rerun()
-                except sqlite3.IntegrityError:
-                    # Update existing allocation
-                    conn.execute('''
-                        UPDATE Allocations 
-                        SET amount = ?
-                        WHERE department_id = ? AND category_id = ? AND fiscal_year_id = ?
-                    ''', (amount, dept_id, category_id, active_fiscal_year['id']))
-                    conn.commit()
-                    st.success("Allocation updated successfully!")
-                    st.experimental_rerun()
-                finally:
-                    conn.close()
+                # An existing allocation is updated in whichever shard holds it,
+                # which for one written before sharding is the main database
+                existing_id = db.find_allocation(dept_id, category_id, active_fiscal_year['id'])
+                shard = db.shard_for_id(existing_id) if existing_id else db.shard_for_department(dept_id)
+                outcome = "updated" if existing_id else "added"
+                
+                # One upsert rather than an insert that falls back to an update, since a failed
+                # statement aborts the whole transaction on PostgreSQL
+                def save_allocation(conn):
+                    conn.execute(storage.upsert(
+                        'Allocations', ('department_id', 'category_id', 'fiscal_year_id', 'amount'),
+                        ('department_id', 'category_id', 'fiscal_year_id')
+                    ), (dept_id, category_id, active_fiscal_year['id'], amount))
+                
+                db.run_write(save_allocation, shard=shard)
+                st.success(f"Allocation {outcome} successfully!")
+                st.experimental_rerun()
     
     # View current allocations
     st.subheader("Current Allocations")
     
-    conn = db.get_db_connection()
-    allocations = conn.execute('''
+    allocations = [row for rows in db.fan_out(lambda conn: conn.execute('''
         SELECT 
             a.id, 
             d.name AS department, 
@@ -349,8 +380,7 @@ def allocation_page():
         JOIN Departments d ON a.department_id = d.id
         JOIN BudgetCategories c ON a.category_id = c.id
         WHERE a.fiscal_year_id = ?
-    ''', (active_fiscal_year['id'],)).fetchall()
-    conn.close()
+    ''', (active_fiscal_year['id'],)).fetchall()) for row in rows]
     
     if allocations:
         # Convert to DataFrame
@@ -382,17 +412,12 @@ def expenditure_page():
     with st.expander("Add New Expenditure"):
         with st.form("add_expenditure_form"):
             # Get departments
-            departments = get_departments()
-            formatted_depts = format_department_hierarchy(departments)
-            dept_options = [d['name'] for d in formatted_depts]
-            selected_dept = st.selectbox("Department", dept_options)
-            
-            # Get the actual department ID
-            dept_id = None
-            for dept in departments:
-                if dept['name'] == selected_dept.strip():
-                    dept_id = dept['id']
-                    break
+            tree = get_department_tree()
+            dept_id = st.selectbox(
+                "Department",
+                hierarchy.department_options(tree),
+                format_func=lambda dept_id: hierarchy.format_department_label(tree, dept_id)
+            )
             
             # Get budget categories
             conn = db.get_db_connection()
@@ -410,19 +435,17 @@ def expenditure_page():
                     break
             
             # Get allocation ID if exists
-            conn = db.get_db_connection()
-            allocation = conn.execute('''
-                SELECT id FROM Allocations 
-                WHERE department_id = ? AND category_id = ? AND fiscal_year_id = ?
-            ''', (dept_id, category_id, active_fiscal_year['id'])).fetchone()
-            conn.close()
+            allocation_id = db.find_allocation(dept_id, category_id, active_fiscal_year['id'])
             
-            if not allocation:
+            if not allocation_id:
                 st.warning("No allocation exists for this department and category. Please create an allocation first.")
                 submit_disabled = True
             else:
                 submit_disabled = False
-                allocation_id = allocation['id']
+                
+                # Running balance, kept up to date with every expenditure
+                balance = balances.get_balance(allocation_id)
+                st.caption(f"Remaining balance: ${balance['remaining']:,.2f} of ${balance['allocated']:,.2f}")
             
             amount = st.number_input("Amount", min_value=0.0, format="%f")
             description = st.text_area("Description")
@@ -431,38 +454,42 @@ def expenditure_page():
             submit = st.form_submit_button("Record Expenditure", disabled=submit_disabled)
             
             if submit and amount > 0 and description and not submit_disabled:
-                conn = db.get_db_connection()
-                conn.execute('''
-                    INSERT INTO Expenditures 
-                    (allocation_id, amount, description, date) 
-                    VALUES (?, ?, ?, ?)
-                ''', (allocation_id, amount, description, date))
-                conn.commit()
-                conn.close()
-                st.success("Expenditure recorded successfully!")
-                st.experimental_rerun()
+                # The balance is checked again in the transaction that records the expenditure
+                try:
+                    result = balances.record_expenditure(allocation_id, amount, description, date)
+                except balances.OverspendError as e:
+                    st.error(f"Expenditure rejected: remaining balance is ${e.remaining:,.2f}")
+                else:
+                    if result["overspent"]:
+                        st.warning(f"Expenditure recorded, but the allocation is now overspent by ${-result['remaining']:,.2f}")
+                    else:
+                        st.success("Expenditure recorded successfully!")
+                        st.experimental_rerun()
     
     # View expenditures
     st.subheader("Recent Expenditures")
     
-    conn = db.get_db_connection()
-    expenditures = conn.execute('''
-        SELECT 
-            e.id,
-            d.name AS department,
-            c.name AS category,
-            e.amount,
-            e.description,
-            e.date
-        FROM Expenditures e
-        JOIN Allocations a ON e.allocation_id = a.id
-        JOIN Departments d ON a.department_id = d.id
-        JOIN BudgetCategories c ON a.category_id = c.id
-        WHERE a.fiscal_year_id = ?
-        ORDER BY e.date DESC
-        LIMIT 20
-    ''', (active_fiscal_year['id'],)).fetchall()
-    conn.close()
+    def recent_expenditures(conn):
+        return conn.execute('''
+            SELECT 
+                e.id,
+                d.name AS department,
+                c.name AS category,
+                e.amount,
+                e.description,
+                e.date
+            FROM Expenditures e
+            JOIN Allocations a ON e.allocation_id = a.id
+            JOIN Departments d ON a.department_id = d.id
+            JOIN BudgetCategories c ON a.category_id = c.id
+            WHERE a.fiscal_year_id = ?
+            ORDER BY e.date DESC
+            LIMIT 20
+        ''', (active_fiscal_year['id'],)).fetchall()
+    
+    # The 20 most recent across every shard
+    expenditures = sorted((row for rows in db.fan_out(recent_expenditures) for row in rows),
+                          key=lambda e: e['date'], reverse=True)[:20]
     
     if expenditures:
         # Convert to DataFrame
@@ -493,123 +520,146 @@ def budget_overview_page():
     st.subheader(f"Budget Overview for {active_fiscal_year['year_name']}")
     
     # Get departments
-    departments = get_departments()
-    formatted_depts = format_department_hierarchy(departments)
-    dept_options = ["All Departments"] + [d['name'] for d in formatted_depts]
-    selected_dept = st.selectbox("Select Department", dept_options)
-    
-    # Calculate budget summary
-    if selected_dept == "All Departments":
-        # University-wide budget summary
-        conn = db.get_db_connection()
-        summary = conn.execute('''
-            SELECT 
-                c.name AS category,
-                SUM(a.amount) AS allocated,
-                COALESCE(SUM(e.amount), 0) AS spent
-            FROM BudgetCategories c
-            LEFT JOIN Allocations a ON c.id = a.category_id AND a.fiscal_year_id = ?
-            LEFT JOIN Expenditures e ON a.id = e.allocation_id
-            GROUP BY c.name
-        ''', (active_fiscal_year['id'],)).fetchall()
-        conn.close()
-        
+    tree = get_department_tree()
+    selected_dept = st.selectbox(
+        "Select Department",
+        [None] + hierarchy.department_options(tree),
+        format_func=lambda dept_id: "All Departments" if dept_id is None else hierarchy.format_department_label(tree, dept_id)
+    )
+    
+    today = datetime.now().date()
+    as_of = st.date_input("As of", value=today, max_value=today)
+    historical = as_of < today
+    
+    # Roll the fiscal year up over the department tree in one pass, rebuilding
+    # past dates from the nearest snapshot and the audit log
+    if historical:
+        rollup = snapshots.rollup_as_of(active_fiscal_year['id'], as_of, tree)
+    else:
+        rollup = analytics.build_rollup(active_fiscal_year['id'], tree)
+    summary = analytics.category_summary(rollup, selected_dept)
+    
+    if selected_dept is None:
         title = "University-wide Budget Summary"
     else:
-        # Department-specific budget summary
-        # Get the department ID
-        dept_id = None
-        for dept in departments:
-            if dept['name'] == selected_dept.strip():
-                dept_id = dept['id']
-                break
-        
-        conn = db.get_db_connection()
-        
-        # Get all child departments (recursive)
-        all_depts = [dept_id]
-        
-        def get_child_departments(parent_id):
-            children = conn.execute(
-                'SELECT id FROM Departments WHERE parent_id = ?', 
-                (parent_id,)
-            ).fetchall()
-            
-            child_ids = [c['id'] for c in children]
-            all_depts.extend(child_ids)
-            
-            for child_id in child_ids:
-                get_child_departments(child_id)
-        
-        get_child_departments(dept_id)
-        
-        # Get budget summary including all child departments
-        placeholders = ', '.join(['?'] * len(all_depts))
-        query = f'''
-            SELECT 
-                c.name AS category,
-                SUM(a.amount) AS allocated,
-                COALESCE(SUM(e.amount), 0) AS spent
-            FROM BudgetCategories c
-            LEFT JOIN Allocations a ON c.id = a.category_id AND a.fiscal_year_id = ? AND a.department_id IN ({placeholders})
-            LEFT JOIN Expenditures e ON a.id = e.allocation_id
-            GROUP BY c.name
-        '''
-        
-        params = [active_fiscal_year['id']] + all_depts
-        summary = conn.execute(query, params).fetchall()
-        conn.close()
-        
-        title = f"Budget Summary for {selected_dept}"
+        # Totals include the department and all of its child departments
+        title = f"Budget Summary for {hierarchy.get_department_name(tree, selected_dept)}"
+    
+    if historical:
+        title += f" as of {as_of.isoformat()}"
     
     # Display summary
     st.subheader(title)
     
-    if summary:
-        summary_data = []
-        total_allocated = 0
-        total_spent = 0
-        
-        for s in summary:
-            allocated = s['allocated'] or 0
-            spent = s['spent'] or 0
-            remaining = allocated - spent
-            
-            total_allocated += allocated
-            total_spent += spent
-            
-            if allocated > 0:  # Only show categories with allocations
-                summary_data.append({
-                    'Category': s['category'],
-                    'Allocated': f"${allocated:,.2f}",
-                    'Spent': f"${spent:,.2f}",
-                    'Remaining': f"${remaining:,.2f}",
-                    'Usage (%)': f"{(spent / allocated * 100) if allocated > 0 else 0:.1f}%"
-                })
-        
-        # Add total row
-        summary_data.append({
-            'Category': 'TOTAL',
-            'Allocated': f"${total_allocated:,.2f}",
-            'Spent': f"${total_spent:,.2f}",
-            'Remaining': f"${(total_allocated - total_spent):,.2f}",
-            'Usage (%)': f"{(total_spent / total_allocated * 100) if total_allocated > 0 else 0:.1f}%"
-        })
-        
-        df = pd.DataFrame(summary_data)
-        st.dataframe(df, hide_index=True)
+    if not summary.empty:
+        summary = analytics.with_total(summary, 'Category', rollup["elapsed_days"])
+        st.dataframe(analytics.format_amounts(summary), hide_index=True)
         
         # Budget usage visualization
         st.subheader("Budget Usage")
         
-        progress = total_spent / total_allocated if total_allocated > 0 else 0
+        total = summary.iloc[-1]
+        progress = total['Spent'] / total['Allocated'] if total['Allocated'] > 0 else 0
         st.progress(min(progress, 1.0))
         st.write(f"Overall Budget Usage: {progress * 100:.1f}%")
+        
+        # Year-end projections for the same scope, only for the current state
+        if not historical:
+            st.subheader("Spend Forecast")
+            forecast = forecasting.get_forecast(active_fiscal_year['id'])
+            scope = None if selected_dept is None else hierarchy.get_subtree_ids(tree, selected_dept)
+            overruns = forecasting.projected_overruns(forecast, scope)
+        
+            projected = forecast['frame']
+            if scope is not None:
+                projected = projected[projected['department_id'].isin(scope)]
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Projected Year-end Spend", f"${projected['forecast'].sum():,.2f}")
+            col2.metric("Allocations Projected to Overrun", f"{len(overruns):,}")
+            col3.metric("Projected Overrun", f"${overruns['overrun'].sum():,.2f}")
+            st.caption(f"Projected from spending up to {forecast['as_of'].isoformat()} "
+                       f"(fiscal year {forecast['year_start'].isoformat()} to {forecast['year_end'].isoformat()})")
+        
+            if not overruns.empty:
+                category_names = dict(zip(rollup["category_ids"].tolist(), rollup["category_names"]))
+                st.dataframe(analytics.format_amounts(pd.DataFrame({
+                    'Department': [hierarchy.get_department_name(tree, dept_id) for dept_id in overruns['department_id']],
+                    'Category': overruns['category_id'].map(category_names),
+                    'Allocated': overruns['allocated'],
+                    'Spent': overruns['spent'],
+                    'Forecast': overruns['forecast'].map('${:,.2f}'.format),
+                    'Overrun': overruns['overrun'].map('${:,.2f}'.format),
+                    'Model': overruns['model']
+                })), hide_index=True)
+        
+        # Department x category breakdown
+        st.subheader("Department Breakdown")
+        col1, col2 = st.columns(2)
+        with col1:
+            view = st.selectbox("View", ["Totals"] + list(analytics.MEASURES))
+        with col2:
+            include_subtree = st.checkbox("Include sub-departments", value=True)
+        
+        if view == "Totals":
+            departments = analytics.department_summary(rollup, selected_dept, include_subtree)
+            st.dataframe(analytics.format_amounts(departments.drop(columns=['Department ID'])), hide_index=True)
+        else:
+            breakdown = analytics.department_category_breakdown(rollup, selected_dept, view, include_subtree)
+            st.dataframe(breakdown, hide_index=True)
     else:
         st.info("No budget data available for the selected criteria.")
 
+# Year Comparison page
+def year_comparison_page():
+    st.title("Year Comparison")
+    
+    conn = db.get_db_connection()
+    fiscal_years = conn.execute('SELECT id, year_name FROM FiscalYears ORDER BY year_name').fetchall()
+    conn.close()
+    
+    if not fiscal_years:
+        st.warning("No fiscal years found. Please add fiscal years first.")
+        return
+    
+    year_names = {fy['id']: fy['year_name'] for fy in fiscal_years}
+    selected_years = st.multiselect(
+        "Fiscal Years",
+        list(year_names),
+        default=list(year_names)[-3:],
+        format_func=lambda fiscal_year_id: year_names[fiscal_year_id]
+    )
+    
+    tree = get_department_tree()
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        selected_dept = st.selectbox(
+            "Department",
+            [None] + hierarchy.department_options(tree),
+            format_func=lambda dept_id: "All Departments" if dept_id is None else hierarchy.format_department_label(tree, dept_id)
+        )
+    with col2:
+        group_by = st.selectbox("Group By", ["Category", "Department"])
+    with col3:
+        measure = st.selectbox("Measure", ["Spent", "Allocated", "Usage (%)"])
+    
+    if not selected_years:
+        st.info("Select at least one fiscal year to compare.")
+        return
+    
+    # One grouped query covers every selected year that is not already cached
+    frame = comparison.compare_years(selected_years, tree, selected_dept, group_by.lower())
+    if frame.empty:
+        st.info("No budget data available for the selected criteria.")
+        return
+    
+    wide = comparison.pivot_years(frame, measure)
+    st.dataframe(wide, hide_index=True)
+    
+    # Chart each group's measure across the years
+    st.bar_chart(wide.set_index(wide.columns[0])[list(dict.fromkeys(frame['Fiscal Year']))])
+
 # Main application flow
 if st.session_state.authenticated:
     main_app()
 else:
-    login_page()
\ No newline at end of file
+    login_page()
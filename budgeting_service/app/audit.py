@@ -0,0 +1,117 @@
+import argparse
+import json
+import db
+import logs
+import storage
+
+logger = logs.get_logger(__name__)
+
+# Entries read per query while verifying the chain
+VERIFY_BATCH = 5000
+
+def entry_dict(row):
+    """Convert an AuditLog row to a dict with its values decoded"""
+    entry = dict(row)
+    for key in ('old_values', 'new_values'):
+        entry[key] = json.loads(entry[key]) if entry[key] else None
+    return entry
+
+def get_entity_history(table_name, entity_id):
+    """Get every change to one row of an audited table, oldest first"""
+    shard = db.shard_for_id(entity_id) if table_name in db.SHARDED_TABLES else 0
+    conn = db.get_db_connection(shard)
+    rows = conn.execute('''
+        SELECT * FROM AuditLog
+        WHERE table_name = ? AND entity_id = ?
+        ORDER BY id
+    ''', (table_name, entity_id)).fetchall()
+    conn.close()
+    return [entry_dict(row) for row in rows]
+
+def get_changes(since=None, until=None, table_name=None, actor=None, limit=100):
+    """
+    Get audit entries in a time range (ISO timestamps, until exclusive),
+    optionally for one table or actor, newest first. Each shard has its own
+    audit log; their entries are merged. Raises ValueError if limit is
+    below 1.
+    """
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+
+    conditions = []
+    params = []
+    if since:
+        conditions.append('changed_at >= ?')
+        params.append(since)
+    if until:
+        conditions.append('changed_at < ?')
+        params.append(until)
+    if table_name:
+        conditions.append('table_name = ?')
+        params.append(table_name)
+    if actor:
+        conditions.append('actor = ?')
+        params.append(actor)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    rows = db.fan_out(lambda conn: conn.execute(f'''
+        SELECT * FROM AuditLog
+        {where}
+        ORDER BY id DESC
+        LIMIT ?
+    ''', params + [limit]).fetchall())
+
+    # Every shard numbers its own entries, so the shards' newest are merged by time
+    entries = [entry_dict(row) for shard_rows in rows for row in shard_rows]
+    if len(rows) > 1:
+        entries.sort(key=lambda entry: entry['changed_at'], reverse=True)
+    return entries[:limit]
+
+def verify_chain():
+    """
+    Recompute every entry's hash from its fields and the previous entry's
+    hash, checking each shard's chain separately
+    Returns a dict with the number of entries checked and the id and shard of
+    the first entry that does not match (None if every chain is intact)
+    """
+    results = db.map_shards(verify_shard_chain)
+    broken = next((result for result in results if result["first_invalid_id"] is not None), None)
+    return {
+        "checked": sum(result["checked"] for result in results),
+        "first_invalid_id": broken["first_invalid_id"] if broken else None,
+        "shard": broken["shard"] if broken else None
+    }
+
+def verify_shard_chain(shard):
+    """Verify one shard's audit log, stopping at the first entry that does not match"""
+    conn = db.get_db_connection(shard)
+    previous_hash = None
+    checked = 0
+    # Entries are streamed in batches rather than read into memory at once
+    rows = storage.stream(conn, 'SELECT * FROM AuditLog ORDER BY id', size=VERIFY_BATCH)
+
+    try:
+        for row in rows:
+            expected = db.audit_hash(
+                previous_hash, row['changed_at'], row['actor'], row['correlation_id'], row['table_name'],
+                row['entity_id'], row['action'], row['old_values'], row['new_values']
+            )
+            if row['hash'] != expected:
+                logger.error("Audit chain broken", extra={"audit_id": row['id'], "shard": shard})
+                return {"checked": checked, "first_invalid_id": row['id'], "shard": shard}
+
+            previous_hash = row['hash']
+            checked += 1
+        return {"checked": checked, "first_invalid_id": None, "shard": shard}
+    finally:
+        rows.close()
+        conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Verify the budgeting audit log's hash chain")
+    parser.parse_args()
+
+    result = verify_chain()
+    print(json.dumps(result))
+    if result["first_invalid_id"] is not None:
+        raise SystemExit(1)
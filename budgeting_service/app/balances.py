@@ -0,0 +1,191 @@
+import argparse
+import os
+import time
+import db
+import logs
+
+logger = logs.get_logger(__name__)
+
+# "hard" rejects expenditures beyond the limit, "soft" records them and flags the overspend
+OVERSPEND_POLICY = os.environ.get('OVERSPEND_POLICY', 'hard')
+
+# Headroom above the allocated amount before an expenditure counts as overspending
+OVERSPEND_ALLOWANCE_PERCENT = float(os.environ.get('OVERSPEND_ALLOWANCE_PERCENT', '0'))
+
+# Running balances drift from the raw sums by float rounding; larger gaps are mismatches
+RECONCILE_TOLERANCE = 0.005
+
+class OverspendError(ValueError):
+    """An expenditure would take an allocation past its hard overspend limit"""
+
+    def __init__(self, allocation_id, amount, remaining):
+        super().__init__(
+            f"Expenditure of {amount:,.2f} exceeds the remaining balance of {remaining:,.2f} "
+            f"for allocation {allocation_id}"
+        )
+        self.allocation_id = allocation_id
+        self.amount = amount
+        self.remaining = remaining
+
+def spending_limit(allocated):
+    """The most an allocation may spend before the overspend policy applies"""
+    return allocated * (1 + OVERSPEND_ALLOWANCE_PERCENT / 100)
+
+def load_balance(conn, allocation_id):
+    """
+    Get an allocation's amount and running spent total inside a write job,
+    creating the balance row from the raw expenditure sum on first use
+    Returns (allocated, spent), or None if the allocation does not exist
+    """
+    row = conn.execute('''
+        SELECT a.amount, b.spent
+        FROM Allocations a
+        LEFT JOIN AllocationBalances b ON b.allocation_id = a.id
+        WHERE a.id = ?
+    ''', (allocation_id,)).fetchone()
+    if row is None:
+        return None
+    if row['spent'] is not None:
+        return row['amount'], row['spent']
+
+    conn.execute('''
+        INSERT INTO AllocationBalances (allocation_id, spent, expenditure_count)
+        SELECT ?, COALESCE(SUM(amount), 0), COUNT(*) FROM Expenditures WHERE allocation_id = ?
+    ''', (allocation_id, allocation_id))
+    spent = conn.execute(
+        'SELECT spent FROM AllocationBalances WHERE allocation_id = ?', (allocation_id,)
+    ).fetchone()['spent']
+    return row['amount'], spent
+
+def record_expenditure(allocation_id, amount, description, date, policy=None):
+    """
+    Record an expenditure and update its allocation's running balance in the
+    same write transaction, applying the overspend policy to the balance read
+    in that transaction. Raises OverspendError under the hard policy.
+    Returns a dict with expenditure_id, remaining and overspent (True when a
+    soft policy let the expenditure past the limit).
+    """
+    policy = policy or OVERSPEND_POLICY
+
+    def insert_expenditure(conn):
+        balance = load_balance(conn, allocation_id)
+        if balance is None:
+            raise ValueError(f"Allocation {allocation_id} does not exist")
+
+        allocated, spent = balance
+        overspent = spent + amount > spending_limit(allocated) + RECONCILE_TOLERANCE
+        if overspent and policy == 'hard':
+            raise OverspendError(allocation_id, amount, allocated - spent)
+
+        expenditure_id = conn.execute('''
+            INSERT INTO Expenditures
+            (allocation_id, amount, description, date)
+            VALUES (?, ?, ?, ?)
+            RETURNING id
+        ''', (allocation_id, amount, description, date)).fetchone()[0]
+        conn.execute('''
+            UPDATE AllocationBalances
+            SET spent = spent + ?, expenditure_count = expenditure_count + 1
+            WHERE allocation_id = ?
+        ''', (amount, allocation_id))
+
+        return {
+            "expenditure_id": expenditure_id,
+            "remaining": allocated - spent - amount,
+            "overspent": overspent
+        }
+
+    try:
+        result = db.run_write(insert_expenditure, shard=db.shard_for_id(allocation_id))
+    except OverspendError as e:
+        logger.info("Rejected overspend", extra={"allocation_id": allocation_id, "amount": amount,
+                                                 "remaining": e.remaining})
+        raise
+
+    if result["overspent"]:
+        logger.warning("Allocation overspent", extra={"allocation_id": allocation_id, "amount": amount,
+                                                      "remaining": result["remaining"]})
+    return result
+
+def get_balance(allocation_id):
+    """
+    Get an allocation's allocated, spent and remaining amounts from its running
+    balance, falling back to the raw sum if it has none yet
+    """
+    conn = db.get_db_connection(db.shard_for_id(allocation_id))
+    row = conn.execute('''
+        SELECT
+            a.amount AS allocated,
+            COALESCE(b.spent, (SELECT COALESCE(SUM(e.amount), 0) FROM Expenditures e WHERE e.allocation_id = a.id)) AS spent
+        FROM Allocations a
+        LEFT JOIN AllocationBalances b ON b.allocation_id = a.id
+        WHERE a.id = ?
+    ''', (allocation_id,)).fetchone()
+    conn.close()
+
+    if row is None:
+        return None
+    return {"allocated": row['allocated'], "spent": row['spent'], "remaining": row['allocated'] - row['spent']}
+
+def find_mismatches(conn):
+    """Compare every running balance with the raw sums of its expenditures in one grouped query"""
+    return conn.execute('''
+        SELECT b.allocation_id, b.spent, b.expenditure_count,
+               COALESCE(e.spent, 0) AS actual_spent, COALESCE(e.expenditure_count, 0) AS actual_count
+        FROM AllocationBalances b
+        LEFT JOIN (
+            SELECT allocation_id, SUM(amount) AS spent, COUNT(*) AS expenditure_count
+            FROM Expenditures
+            GROUP BY allocation_id
+        ) e ON e.allocation_id = b.allocation_id
+        WHERE ABS(b.spent - COALESCE(e.spent, 0)) > ? OR b.expenditure_count <> COALESCE(e.expenditure_count, 0)
+    ''', (RECONCILE_TOLERANCE,)).fetchall()
+
+def reconcile_balances(repair=False):
+    """
+    Verify running balances against the raw expenditure sums. With repair,
+    mismatched balances are recomputed in a write transaction, which also
+    checks them again so concurrent expenditures are not overwritten.
+    Returns the mismatches found as dicts.
+    """
+    def reconcile_shard(shard):
+        conn = db.get_db_connection(shard)
+        mismatches = [dict(row) for row in find_mismatches(conn)]
+        conn.close()
+
+        for mismatch in mismatches:
+            logger.warning("Allocation balance mismatch", extra=mismatch)
+
+        if repair and mismatches:
+            def repair_balances(conn):
+                allocation_ids = [row['allocation_id'] for row in find_mismatches(conn)]
+                conn.executemany('''
+                    UPDATE AllocationBalances
+                    SET spent = (SELECT COALESCE(SUM(amount), 0) FROM Expenditures WHERE allocation_id = ?),
+                        expenditure_count = (SELECT COUNT(*) FROM Expenditures WHERE allocation_id = ?)
+                    WHERE allocation_id = ?
+                ''', [(allocation_id, allocation_id, allocation_id) for allocation_id in allocation_ids])
+                return len(allocation_ids)
+
+            repaired = db.run_write(repair_balances, shard=shard)
+            logger.info("Repaired allocation balances", extra={"repaired": repaired, "shard": shard})
+        return mismatches
+
+    # Each shard keeps the balances of its own allocations
+    mismatches = [mismatch for shard_mismatches in db.map_shards(reconcile_shard) for mismatch in shard_mismatches]
+
+    logger.info("Balance reconciliation finished", extra={"mismatches": len(mismatches)})
+    return mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Verify allocation running balances against expenditures")
+    parser.add_argument('--repair', action='store_true', help="recompute mismatched balances")
+    parser.add_argument('--every', type=int, default=0,
+                        help="repeat every N seconds instead of running once")
+    args = parser.parse_args()
+
+    while True:
+        reconcile_balances(args.repair)
+        if not args.every:
+            break
+        time.sleep(args.every)
@@ -0,0 +1,232 @@
+import threading
+import numpy as np
+import pandas as pd
+import analytics
+import db
+import forecasting
+import hierarchy
+import storage
+
+# Totals of closed fiscal years, kept until an AuditLog entry in some shard touches the
+# year, with every shard's last AuditLog id as of the latest check. The log is in the
+# database, so a write from any process evicts the years it changed.
+_closed_years = {"audit_ids": {}, "years": {}}
+_cache_lock = threading.Lock()
+
+# Fiscal years changed by AuditLog entries after an id: allocations by their old and new
+# year, expenditures by their allocation's
+TOUCHED_YEARS_SQL = f'''
+    SELECT {storage.json_value('new_values', 'fiscal_year_id')}
+    FROM AuditLog
+    WHERE id > :audit_id AND table_name = 'Allocations'
+    UNION
+    SELECT {storage.json_value('old_values', 'fiscal_year_id')}
+    FROM AuditLog
+    WHERE id > :audit_id AND table_name = 'Allocations'
+    UNION
+    SELECT v.fiscal_year_id
+    FROM AuditLog l
+    JOIN AllocationVersions v
+      ON v.allocation_id = {storage.json_value('COALESCE(l.new_values, l.old_values)', 'allocation_id')}
+    WHERE l.id > :audit_id AND l.table_name = 'Expenditures'
+'''
+
+def fetch_year_columns(fiscal_year_ids):
+    """
+    Fetch allocated and spent per allocation for several fiscal years in one
+    grouped query per shard
+    Returns a dict mapping each fiscal_year_id to NumPy columns department_id,
+    category_id, allocated and spent
+    """
+    placeholders = ', '.join(['?'] * len(fiscal_year_ids))
+
+    def fetch(conn):
+        conn.row_factory = None
+        return conn.execute(f'''
+            SELECT a.fiscal_year_id, a.department_id, a.category_id, a.amount, COALESCE(SUM(e.amount), 0)
+            FROM Allocations a
+            LEFT JOIN Expenditures e ON e.allocation_id = a.id
+            WHERE a.fiscal_year_id IN ({placeholders})
+            GROUP BY a.id
+        ''', list(fiscal_year_ids)).fetchall()
+
+    rows = [row for shard_rows in db.fan_out(fetch) for row in shard_rows]
+    columns = list(zip(*rows)) or [(), (), (), (), ()]
+    year = np.array(columns[0], dtype=np.int64)
+
+    # Sort by year, keeping each shard's rows in id order within it
+    order = np.argsort(year, kind='stable')
+    year = year[order]
+    department_id = np.array(columns[1], dtype=np.int64)[order]
+    category_id = np.array(columns[2], dtype=np.int64)[order]
+    allocated = np.array(columns[3], dtype=np.float64)[order]
+    spent = np.array(columns[4], dtype=np.float64)[order]
+
+    # Rows are ordered by year, so each year is one contiguous slice
+    result = {}
+    for fiscal_year_id in fiscal_year_ids:
+        start, end = np.searchsorted(year, [fiscal_year_id, fiscal_year_id + 1])
+        result[fiscal_year_id] = {
+            "department_id": department_id[start:end],
+            "category_id": category_id[start:end],
+            "allocated": allocated[start:end],
+            "spent": spent[start:end]
+        }
+    return result
+
+def touched_years(audit_ids, scan=True):
+    """
+    Read every shard's last AuditLog id and, with scan, the fiscal years
+    changed by its entries after audit_ids[shard] (all of them for a shard
+    not in audit_ids)
+    Returns a list of (shard, last AuditLog id, set of fiscal_year_ids)
+    """
+    def check(shard):
+        conn = db.get_db_connection(shard)
+        conn.row_factory = None
+        try:
+            storage.begin_read(conn)
+            audit_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM AuditLog').fetchone()[0]
+            since = audit_ids.get(shard, 0)
+            rows = []
+            if scan and audit_id > since:
+                rows = conn.execute(TOUCHED_YEARS_SQL, {"audit_id": since}).fetchall()
+            conn.commit()
+        finally:
+            conn.close()
+        return shard, audit_id, {int(row[0]) for row in rows if row[0] is not None}
+
+    return db.map_shards(check)
+
+def check_closed_years():
+    """Evict cached years that AuditLog entries written since the last check changed"""
+    with _cache_lock:
+        # With nothing cached there is nothing to evict, so only the ids are read
+        changes = touched_years(_closed_years["audit_ids"], scan=bool(_closed_years["years"]))
+        for shard, audit_id, fiscal_year_ids in changes:
+            for fiscal_year_id in fiscal_year_ids:
+                _closed_years["years"].pop(fiscal_year_id, None)
+            _closed_years["audit_ids"][shard] = audit_id
+
+def get_year_columns(years):
+    """
+    Get the columns for a list of fiscal years, fetching every year that is
+    not cached in the same query. Only closed years are cached; the active
+    year is fetched on every request.
+    """
+    # Checked before fetching, so entries written during the fetch are checked next time
+    check_closed_years()
+
+    result = {}
+    missing = []
+    for year in years:
+        cached = None if year['is_active'] else _closed_years["years"].get(year['id'])
+        if cached is not None:
+            analytics.CACHE_REQUESTS.inc(cache='closed_year_totals', result='hit')
+            result[year['id']] = cached
+        else:
+            analytics.CACHE_REQUESTS.inc(cache='closed_year_totals', result='miss')
+            missing.append(year)
+
+    if missing:
+        with _cache_lock:
+            checked = dict(_closed_years["audit_ids"])
+        fetched = fetch_year_columns([year['id'] for year in missing])
+        with _cache_lock:
+            # A check since may have passed over a change the fetch read from before it
+            if _closed_years["audit_ids"] == checked:
+                for year in missing:
+                    if not year['is_active']:
+                        _closed_years["years"][year['id']] = fetched[year['id']]
+        result.update(fetched)
+    return result
+
+def get_categories():
+    """Get budget categories as a dict mapping category_id to name"""
+    conn = db.get_db_connection()
+    categories = dict(conn.execute('SELECT id, name FROM BudgetCategories').fetchall())
+    conn.close()
+    return categories
+
+def department_labels(tree, dept_ids):
+    """Department names, with the ID added where two departments share a name"""
+    names = [hierarchy.get_department_name(tree, dept_id) for dept_id in dept_ids]
+    return [f"{name} (#{dept_id})" if names.count(name) > 1 else name for name, dept_id in zip(names, dept_ids)]
+
+def compare_years(fiscal_year_ids, tree, dept_id=None, by='category'):
+    """
+    Align allocated and spent across fiscal years for a department's subtree,
+    or the whole university, grouped by category or by department. Grouped by
+    department, the rows are the department and its direct children (the
+    top-level departments for the whole university), each with its subtree
+    totals.
+    Returns a long frame with Fiscal Year, the group label, Allocated, Spent
+    and Usage (%), with years oldest first
+    """
+    years = [year for year in forecasting.get_fiscal_years() if year['id'] in set(fiscal_year_ids)]
+    columns = get_year_columns(years)
+    categories = get_categories()
+
+    layout = analytics.tree_arrays(tree)
+    category_ids = np.array(sorted(categories), dtype=np.int64)
+    rows = analytics.scope_rows(layout, dept_id)
+
+    if by == 'department':
+        group = 'Department'
+        members = ([dept_id] if dept_id is not None else []) + tree["children_mapping"].get(dept_id, [])
+        members = [member for member in members if member in tree["position"]]
+        positions = [tree["position"][member] for member in members]
+        labels = department_labels(tree, members)
+    else:
+        group = 'Category'
+        labels = [categories[category_id] for category_id in category_ids]
+
+    frames = []
+    for year in years:
+        allocated, spent = analytics.department_category_matrices(columns[year['id']], layout, category_ids)
+        if by == 'department':
+            allocated = analytics.subtree_sums(allocated.sum(axis=1), layout["subtree_sizes"])[positions]
+            spent = analytics.subtree_sums(spent.sum(axis=1), layout["subtree_sizes"])[positions]
+        else:
+            allocated = allocated[rows].sum(axis=0)
+            spent = spent[rows].sum(axis=0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            usage = np.where(allocated > 0, spent / allocated * 100, 0.0)
+        frames.append(pd.DataFrame({
+            'Fiscal Year': year['year_name'],
+            group: labels,
+            'Allocated': np.round(allocated, 2),
+            'Spent': np.round(spent, 2),
+            'Usage (%)': np.round(usage, 1)
+        }))
+
+    if not frames:
+        return pd.DataFrame(columns=['Fiscal Year', group, 'Allocated', 'Spent', 'Usage (%)'])
+
+    frame = pd.concat(frames, ignore_index=True)
+
+    # Leave out groups with nothing allocated in any of the years
+    active = frame.groupby(group, sort=False)['Allocated'].transform('sum') > 0
+    return frame[active].reset_index(drop=True)
+
+def pivot_years(frame, measure='Spent'):
+    """
+    Pivot a comparison into one column per fiscal year, oldest first, plus the
+    change from the previous year to the latest one
+    """
+    group = frame.columns[1]
+    years = list(dict.fromkeys(frame['Fiscal Year']))
+    wide = frame.pivot(index=group, columns='Fiscal Year', values=measure)
+    wide = wide.reindex(index=list(dict.fromkeys(frame[group])), columns=years).fillna(0)
+
+    if len(years) > 1:
+        previous, latest = wide[years[-2]], wide[years[-1]]
+        if measure == 'Usage (%)':
+            wide['Change (pts)'] = (latest - previous).round(1)
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                wide['Change (%)'] = np.where(previous != 0, (latest - previous) / previous.abs() * 100, np.nan).round(1)
+
+    wide.columns.name = None
+    return wide.reset_index()
@@ -1,26 +1,618 @@
+import concurrent.futures
+import contextvars
+import hashlib
 import sqlite3
 import os
 import pathlib
+import threading
 from passlib.hash import pbkdf2_sha256
+import db_writer
+import logs
+import query_stats
+import storage
+
+logger = logs.get_logger(__name__)
 
 # Ensure data directory exists
-data_dir = os.path.join(os.path.dirname(__file__), '..', 'data')
+data_dir = os.environ.get('DATA_DIR', os.path.join(os.path.dirname(__file__), '..', 'data'))
 os.makedirs(data_dir, exist_ok=True)
 
 DB_PATH = os.path.join(data_dir, 'budgeting.db')
 
-def get_db_connection():
-    """Get a connection to the SQLite database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Optional sharding. With DB_SHARDING=department each top-level department's
+# allocations, expenditures and their history are kept in a database file of
+# its own under SHARD_DIR, with its own writer, so faculties write concurrently.
+# The main database keeps the other tables and any rows written before sharding
+# was turned on, and counts as shard 0.
+DB_SHARDING = os.environ.get('DB_SHARDING', 'off')
+SHARD_DIR = os.environ.get('SHARD_DIR', os.path.join(data_dir, 'shards'))
 
-def init_db():
-    """Initialize the database with required tables"""
-    # Check if database exists
-    db_exists = pathlib.Path(DB_PATH).exists()
+# Threads reading shards in parallel for university-wide queries
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', '8'))
+
+# Shards are files of their own, so they need the SQLite backend
+if DB_SHARDING == 'department' and storage.DB_BACKEND != 'sqlite':
+    raise ValueError("DB_SHARDING=department needs DB_BACKEND=sqlite")
+
+# Each shard hands out allocation and expenditure IDs from its own range, so an
+# ID divided by the span is the shard holding the row. IDs stay below 2**53,
+# which allows top-level department IDs up to MAX_SHARD (9006).
+SHARD_ID_SPAN = 10 ** 12
+MAX_SHARD = 2 ** 53 // SHARD_ID_SPAN - 1
+
+# Audited tables whose rows, and audit entries, live in the shards
+SHARDED_TABLES = ('Allocations', 'Expenditures')
+
+# Columns recorded in the audit log for every insert, update and delete
+AUDITED_TABLES = {
+    'Departments': ('id', 'name', 'parent_id'),
+    'FiscalYears': ('id', 'year_name', 'is_active'),
+    'BudgetCategories': ('id', 'name'),
+    'Allocations': ('id', 'department_id', 'category_id', 'fiscal_year_id', 'amount'),
+    'Expenditures': ('id', 'allocation_id', 'amount', 'description', 'date')
+}
+
+# Timestamps in AuditLog and AllocationVersions are UTC ISO 8601 with milliseconds.
+# Allocations that predate versioning count as valid from the epoch.
+VERSIONS_EPOCH = '0001-01-01T00:00:00.000Z'
+
+# Tables holding each department's budget data and its history. With sharding
+# every shard has them too, while the other tables stay in the main database.
+DEPARTMENT_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS Allocations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        department_id INTEGER NOT NULL,
+        category_id INTEGER NOT NULL,
+        fiscal_year_id INTEGER NOT NULL,
+        amount DECIMAL(15, 2) NOT NULL,
+        FOREIGN KEY (department_id) REFERENCES Departments (id),
+        FOREIGN KEY (category_id) REFERENCES BudgetCategories (id),
+        FOREIGN KEY (fiscal_year_id) REFERENCES FiscalYears (id),
+        UNIQUE(department_id, category_id, fiscal_year_id)
+    );
     
-    conn = get_db_connection()
+    CREATE TABLE IF NOT EXISTS Expenditures (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        allocation_id INTEGER NOT NULL,
+        amount DECIMAL(15, 2) NOT NULL,
+        description TEXT NOT NULL,
+        date DATE NOT NULL,
+        FOREIGN KEY (allocation_id) REFERENCES Allocations (id)
+    );
+    
+    -- Running spent total per allocation, kept in step with Expenditures by
+    -- balances.record_expenditure and created from the raw sum on first use
+    CREATE TABLE IF NOT EXISTS AllocationBalances (
+        allocation_id INTEGER PRIMARY KEY,
+        spent REAL NOT NULL DEFAULT 0,
+        expenditure_count INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (allocation_id) REFERENCES Allocations (id)
+    );
+    
+    -- Append-only record of every change to the budgeting tables. Each entry's
+    -- hash covers the previous entry's hash, so edits to the log are detectable.
+    CREATE TABLE IF NOT EXISTS AuditLog (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        changed_at TEXT NOT NULL,
+        actor TEXT,
+        correlation_id TEXT,
+        table_name TEXT NOT NULL,
+        entity_id INTEGER NOT NULL,
+        action TEXT NOT NULL,
+        old_values TEXT,
+        new_values TEXT,
+        hash TEXT NOT NULL
+    );
+    
+    CREATE INDEX IF NOT EXISTS idx_audit_log_changed_at ON AuditLog (changed_at);
+    CREATE INDEX IF NOT EXISTS idx_audit_log_entity ON AuditLog (table_name, entity_id);
+    
+    CREATE TRIGGER IF NOT EXISTS audit_log_no_update BEFORE UPDATE ON AuditLog
+    BEGIN
+        SELECT RAISE(ABORT, 'AuditLog is append-only');
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS audit_log_no_delete BEFORE DELETE ON AuditLog
+    BEGIN
+        SELECT RAISE(ABORT, 'AuditLog is append-only');
+    END;
+    
+    -- Every version of every allocation, valid from when it was written until
+    -- it was replaced or deleted (valid_to NULL while current). Allocations
+    -- that predate versioning are valid from VERSIONS_EPOCH.
+    CREATE TABLE IF NOT EXISTS AllocationVersions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        allocation_id INTEGER NOT NULL,
+        department_id INTEGER NOT NULL,
+        category_id INTEGER NOT NULL,
+        fiscal_year_id INTEGER NOT NULL,
+        amount DECIMAL(15, 2) NOT NULL,
+        valid_from TEXT NOT NULL,
+        valid_to TEXT
+    );
+    
+    CREATE INDEX IF NOT EXISTS idx_allocation_versions_allocation
+        ON AllocationVersions (allocation_id, valid_from);
+    CREATE INDEX IF NOT EXISTS idx_allocation_versions_year
+        ON AllocationVersions (fiscal_year_id, valid_from);
+    
+    CREATE TRIGGER IF NOT EXISTS allocation_versions_insert AFTER INSERT ON Allocations
+    BEGIN
+        INSERT INTO AllocationVersions
+        (allocation_id, department_id, category_id, fiscal_year_id, amount, valid_from)
+        VALUES (NEW.id, NEW.department_id, NEW.category_id, NEW.fiscal_year_id, NEW.amount,
+                strftime('%Y-%m-%dT%H:%M:%fZ', 'now'));
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS allocation_versions_update AFTER UPDATE ON Allocations
+    WHEN OLD.amount IS NOT NEW.amount OR OLD.department_id IS NOT NEW.department_id
+      OR OLD.category_id IS NOT NEW.category_id OR OLD.fiscal_year_id IS NOT NEW.fiscal_year_id
+    BEGIN
+        UPDATE AllocationVersions SET valid_to = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+        WHERE allocation_id = OLD.id AND valid_to IS NULL;
+        INSERT INTO AllocationVersions
+        (allocation_id, department_id, category_id, fiscal_year_id, amount, valid_from)
+        VALUES (NEW.id, NEW.department_id, NEW.category_id, NEW.fiscal_year_id, NEW.amount,
+                strftime('%Y-%m-%dT%H:%M:%fZ', 'now'));
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS allocation_versions_delete AFTER DELETE ON Allocations
+    BEGIN
+        UPDATE AllocationVersions SET valid_to = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+        WHERE allocation_id = OLD.id AND valid_to IS NULL;
+    END;
+    
+    -- Compressed department x category totals of a fiscal year as of an
+    -- AuditLog entry, the starting points for point-in-time summaries
+    CREATE TABLE IF NOT EXISTS RollupSnapshots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        fiscal_year_id INTEGER NOT NULL,
+        audit_id INTEGER NOT NULL,
+        taken_at TEXT NOT NULL,
+        cells INTEGER NOT NULL,
+        data BLOB NOT NULL
+    );
+    
+    CREATE INDEX IF NOT EXISTS idx_rollup_snapshots_year ON RollupSnapshots (fiscal_year_id, taken_at);
+    
+    -- Analytics fetch a fiscal year's allocations and their expenditures in bulk
+    CREATE INDEX IF NOT EXISTS idx_allocations_fiscal_year ON Allocations (fiscal_year_id);
+    CREATE INDEX IF NOT EXISTS idx_expenditures_allocation ON Expenditures (allocation_id);
+'''
+
+# The same tables for DB_BACKEND=postgres (PostgreSQL 14 or later). Dates and
+# timestamps are TEXT, as in SQLite, so every page gets the same values back.
+POSTGRES_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS Departments (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        name TEXT NOT NULL,
+        parent_id BIGINT NULL REFERENCES Departments (id)
+    );
+    
+    CREATE TABLE IF NOT EXISTS Users (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        username TEXT NOT NULL UNIQUE,
+        hashed_password TEXT NOT NULL,
+        department_id BIGINT NOT NULL REFERENCES Departments (id)
+    );
+    
+    CREATE TABLE IF NOT EXISTS FiscalYears (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        year_name TEXT NOT NULL UNIQUE,
+        is_active INTEGER NOT NULL DEFAULT 0
+    );
+    
+    CREATE TABLE IF NOT EXISTS BudgetCategories (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    );
+    
+    CREATE TABLE IF NOT EXISTS Allocations (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        department_id BIGINT NOT NULL REFERENCES Departments (id),
+        category_id BIGINT NOT NULL REFERENCES BudgetCategories (id),
+        fiscal_year_id BIGINT NOT NULL REFERENCES FiscalYears (id),
+        amount NUMERIC(15, 2) NOT NULL,
+        UNIQUE (department_id, category_id, fiscal_year_id)
+    );
+    
+    CREATE TABLE IF NOT EXISTS Expenditures (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        allocation_id BIGINT NOT NULL REFERENCES Allocations (id),
+        amount NUMERIC(15, 2) NOT NULL,
+        description TEXT NOT NULL,
+        date TEXT NOT NULL
+    );
+    
+    CREATE TABLE IF NOT EXISTS AllocationBalances (
+        allocation_id BIGINT PRIMARY KEY REFERENCES Allocations (id),
+        spent DOUBLE PRECISION NOT NULL DEFAULT 0,
+        expenditure_count INTEGER NOT NULL DEFAULT 0
+    );
+    
+    CREATE TABLE IF NOT EXISTS AuditLog (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        changed_at TEXT NOT NULL,
+        actor TEXT,
+        correlation_id TEXT,
+        table_name TEXT NOT NULL,
+        entity_id BIGINT NOT NULL,
+        action TEXT NOT NULL,
+        old_values TEXT,
+        new_values TEXT,
+        hash TEXT NOT NULL
+    );
+    
+    CREATE INDEX IF NOT EXISTS idx_audit_log_changed_at ON AuditLog (changed_at);
+    CREATE INDEX IF NOT EXISTS idx_audit_log_entity ON AuditLog (table_name, entity_id);
+    
+    CREATE OR REPLACE FUNCTION audit_log_append_only() RETURNS trigger AS $$
+    BEGIN
+        RAISE EXCEPTION 'AuditLog is append-only';
+    END;
+    $$ LANGUAGE plpgsql;
+    
+    CREATE OR REPLACE TRIGGER audit_log_no_change BEFORE UPDATE OR DELETE ON AuditLog
+    FOR EACH ROW EXECUTE FUNCTION audit_log_append_only();
+    
+    CREATE TABLE IF NOT EXISTS AllocationVersions (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        allocation_id BIGINT NOT NULL,
+        department_id BIGINT NOT NULL,
+        category_id BIGINT NOT NULL,
+        fiscal_year_id BIGINT NOT NULL,
+        amount NUMERIC(15, 2) NOT NULL,
+        valid_from TEXT NOT NULL,
+        valid_to TEXT
+    );
+    
+    CREATE INDEX IF NOT EXISTS idx_allocation_versions_allocation
+        ON AllocationVersions (allocation_id, valid_from);
+    CREATE INDEX IF NOT EXISTS idx_allocation_versions_year
+        ON AllocationVersions (fiscal_year_id, valid_from);
+    
+    CREATE OR REPLACE FUNCTION allocation_versions() RETURNS trigger AS $$
+    DECLARE
+        changed_at TEXT := to_char(statement_timestamp() AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.MS"Z"');
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN
+            UPDATE AllocationVersions SET valid_to = changed_at
+            WHERE allocation_id = OLD.id AND valid_to IS NULL;
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            INSERT INTO AllocationVersions
+            (allocation_id, department_id, category_id, fiscal_year_id, amount, valid_from)
+            VALUES (NEW.id, NEW.department_id, NEW.category_id, NEW.fiscal_year_id, NEW.amount, changed_at);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    
+    CREATE OR REPLACE TRIGGER allocation_versions_insert AFTER INSERT ON Allocations
+    FOR EACH ROW EXECUTE FUNCTION allocation_versions();
+    
+    CREATE OR REPLACE TRIGGER allocation_versions_update AFTER UPDATE ON Allocations
+    FOR EACH ROW WHEN (OLD.amount IS DISTINCT FROM NEW.amount OR OLD.department_id IS DISTINCT FROM NEW.department_id
+      OR OLD.category_id IS DISTINCT FROM NEW.category_id OR OLD.fiscal_year_id IS DISTINCT FROM NEW.fiscal_year_id)
+    EXECUTE FUNCTION allocation_versions();
+    
+    CREATE OR REPLACE TRIGGER allocation_versions_delete AFTER DELETE ON Allocations
+    FOR EACH ROW EXECUTE FUNCTION allocation_versions();
+    
+    CREATE TABLE IF NOT EXISTS RollupSnapshots (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        fiscal_year_id BIGINT NOT NULL,
+        audit_id BIGINT NOT NULL,
+        taken_at TEXT NOT NULL,
+        cells INTEGER NOT NULL,
+        data BYTEA NOT NULL
+    );
+    
+    CREATE INDEX IF NOT EXISTS idx_rollup_snapshots_year ON RollupSnapshots (fiscal_year_id, taken_at);
+    
+    CREATE INDEX IF NOT EXISTS idx_allocations_fiscal_year ON Allocations (fiscal_year_id);
+    CREATE INDEX IF NOT EXISTS idx_expenditures_allocation ON Expenditures (allocation_id);
+    
+    -- Appends an AuditLog entry for a change to the table named by the first
+    -- trigger argument, recording the columns named by the others. The actor
+    -- and correlation id are transaction settings made by register_functions.
+    CREATE OR REPLACE FUNCTION audit_change() RETURNS trigger AS $$
+    DECLARE
+        entry AuditLog%ROWTYPE;
+    BEGIN
+        entry.changed_at := to_char(statement_timestamp() AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.MS"Z"');
+        entry.actor := NULLIF(current_setting('audit.actor', true), '');
+        entry.correlation_id := NULLIF(current_setting('audit.correlation_id', true), '');
+        entry.table_name := TG_ARGV[0];
+        entry.action := TG_OP;
+        IF TG_OP <> 'INSERT' THEN
+            entry.entity_id := OLD.id;
+            SELECT json_object_agg(key, value)::text INTO entry.old_values
+            FROM json_each(row_to_json(OLD)) WHERE key = ANY (TG_ARGV[1:]);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            entry.entity_id := NEW.id;
+            SELECT json_object_agg(key, value)::text INTO entry.new_values
+            FROM json_each(row_to_json(NEW)) WHERE key = ANY (TG_ARGV[1:]);
+        END IF;
+        -- The same fields, separator and digest as audit_hash
+        entry.hash := encode(sha256(convert_to(concat_ws(chr(31),
+            COALESCE((SELECT hash FROM AuditLog ORDER BY id DESC LIMIT 1), ''), entry.changed_at,
+            COALESCE(entry.actor, ''), COALESCE(entry.correlation_id, ''), entry.table_name,
+            entry.entity_id::text, entry.action, COALESCE(entry.old_values, ''),
+            COALESCE(entry.new_values, '')), 'UTF8')), 'hex');
+        INSERT INTO AuditLog
+        (changed_at, actor, correlation_id, table_name, entity_id, action, old_values, new_values, hash)
+        VALUES (entry.changed_at, entry.actor, entry.correlation_id, entry.table_name, entry.entity_id,
+                entry.action, entry.old_values, entry.new_values, entry.hash);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+'''
+
+# The user on whose behalf writes are made; write jobs run in the submitter's context
+_actor = contextvars.ContextVar('actor', default=None)
+
+# Connections kept open only to read PRAGMA data_version, one per database file
+_version_conns = {}
+_version_lock = threading.Lock()
+
+# Top-level department of every department, rebuilt when the main database changes
+_shard_map = {"version": None, "shards": {}}
+_shard_lock = threading.Lock()
+
+# Shard files whose schema has been created in this process
+_ready_shards = set()
+
+# Threads reading shards in parallel, started on first use
+_shard_pool = None
+
+def get_db_connection(shard=0):
+    """
+    Get a connection to the SQLite database, or to a shard of it. A shard
+    connection attaches the main database as "directory", so queries can
+    join departments, categories and fiscal years. With DB_BACKEND=postgres
+    this is a pooled PostgreSQL connection instead.
+    """
+    if storage.DB_BACKEND == 'postgres':
+        return storage.connect()
+
+    conn = query_stats.connect(shard_path(shard))
+    conn.row_factory = sqlite3.Row
+    register_functions(conn)
+    if shard:
+        conn.execute('ATTACH DATABASE ? AS directory', (DB_PATH,))
+    return db_writer.configure_connection(conn)
+
+def set_actor(username):
+    """Set the user recorded in the audit log for writes made from this context"""
+    _actor.set(username)
+
+def audit_hash(*fields):
+    """
+    Hash an audit entry together with the previous entry's hash, which is the
+    first field, so that changing or removing any entry breaks the chain
+    """
+    payload = '\x1f'.join('' if field is None else str(field) for field in fields)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def register_functions(conn):
+    """Register the SQL functions the schema's triggers rely on"""
+    if storage.DB_BACKEND == 'postgres':
+        # The PostgreSQL triggers read these settings, which last until the transaction ends
+        conn.execute("SELECT set_config('audit.actor', ?, true), set_config('audit.correlation_id', ?, true)",
+                     (_actor.get() or '', logs.get_correlation_id() or ''))
+        return
+
+    # Used by the audit triggers to record who made a change and to chain entries
+    conn.create_function('audit_actor', 0, lambda: _actor.get())
+    conn.create_function('audit_correlation_id', 0, logs.get_correlation_id)
+    conn.create_function('audit_hash', -1, audit_hash, deterministic=True)
+
+def run_write(job, shard=0):
+    """
+    Run job(conn) on the database's or shard's writer thread, which commits
+    it together with other pending writes. Returns the job's result or raises
+    its error. Shard writers do not attach the main database, since a write
+    transaction would lock every attached file. On PostgreSQL the job runs
+    in its own serializable transaction on the calling thread.
+    """
+    if storage.DB_BACKEND == 'postgres':
+        return storage.run_transaction(job, setup=register_functions)
+    return db_writer.submit_write(shard_path(shard), job, setup=register_functions)
+
+def shard_path(shard):
+    """Get the file of a shard, creating its schema the first time it is used"""
+    if not shard:
+        return DB_PATH
+
+    path = os.path.join(SHARD_DIR, f'budgeting-{shard}.db')
+    if path not in _ready_shards:
+        with _shard_lock:
+            if path not in _ready_shards:
+                init_shard(path, shard)
+                _ready_shards.add(path)
+    return path
+
+def init_shard(path, shard):
+    """Create a shard's tables and start its IDs at the shard's own range"""
+    check_shard(shard)
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    conn = query_stats.connect(path)
+    register_functions(conn)
+    db_writer.enable_wal(conn)
+    conn.executescript(DEPARTMENT_SCHEMA)
+    conn.executescript(''.join(audit_trigger_sql(table, AUDITED_TABLES[table]) for table in SHARDED_TABLES))
+    conn.executemany('''
+        INSERT INTO sqlite_sequence (name, seq)
+        SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+    ''', [(table, shard * SHARD_ID_SPAN, table) for table in SHARDED_TABLES])
+    conn.commit()
+    conn.close()
+    logger.info("Shard initialized", extra={"shard": shard, "db_path": path})
+
+def get_shard_map():
+    """
+    Map every department to its shard, the id of its top-level department.
+    Returns an empty map when sharding is off.
+    """
+    if DB_SHARDING != 'department':
+        return {}
+
+    version = file_version(DB_PATH)
+    if _shard_map["version"] == version:
+        return _shard_map["shards"]
+
+    with _shard_lock:
+        if _shard_map["version"] != version:
+            conn = query_stats.connect(DB_PATH)
+            # UNION rather than UNION ALL stops at a cycle in the hierarchy
+            rows = conn.execute('''
+                WITH RECURSIVE subtree(id, top_id) AS (
+                    SELECT id, id FROM Departments WHERE parent_id IS NULL
+                    UNION
+                    SELECT d.id, s.top_id FROM Departments d JOIN subtree s ON d.parent_id = s.id
+                )
+                SELECT id, top_id FROM subtree
+            ''').fetchall()
+            conn.close()
+            _shard_map.update(version=version, shards=dict(rows))
+        return _shard_map["shards"]
+
+def get_shards():
+    """Every shard that can hold rows: the main database and one per top-level department"""
+    return [0] + sorted(set(get_shard_map().values()))
+
+def shard_for_department(department_id):
+    """The shard new rows for a department go to"""
+    return check_shard(get_shard_map().get(department_id, 0))
+
+def check_shard(shard):
+    """Return a shard, raising ValueError if its ID range would pass 2**53"""
+    if shard > MAX_SHARD:
+        raise ValueError(f"Top-level department {shard} is above {MAX_SHARD}, the highest that can have a shard")
+    return shard
+
+def shard_for_id(row_id):
+    """
+    The shard holding an allocation or expenditure, from the range its id
+    falls in. IDs outside every shard's range are looked up in the main database.
+    """
+    shard = int(row_id) // SHARD_ID_SPAN
+    return shard if shard in get_shards() else 0
+
+def map_shards(fn, shards=None):
+    """
+    Call fn(shard) for every shard, in parallel, and return the results in
+    shard order. Each call runs in a copy of the caller's context.
+    """
+    global _shard_pool
+    shards = get_shards() if shards is None else list(shards)
+    if not shards:
+        return []
+    if len(shards) == 1:
+        return [fn(shards[0])]
+
+    if _shard_pool is None:
+        with _shard_lock:
+            if _shard_pool is None:
+                _shard_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=SHARD_WORKERS, thread_name_prefix='db-shard'
+                )
+    futures = [_shard_pool.submit(contextvars.copy_context().run, fn, shard) for shard in shards]
+    return [future.result() for future in futures]
+
+def fan_out(query, shards=None):
+    """Run query(conn) on a connection to every shard in parallel and return the results in shard order"""
+    def run(shard):
+        conn = get_db_connection(shard)
+        try:
+            return query(conn)
+        finally:
+            conn.close()
+
+    return map_shards(run, shards)
+
+def find_allocation(department_id, category_id, fiscal_year_id):
+    """Get the id of a department's allocation for a category and year, in whichever shard holds it"""
+    ids = fan_out(lambda conn: conn.execute('''
+        SELECT id FROM Allocations WHERE department_id = ? AND category_id = ? AND fiscal_year_id = ?
+    ''', (department_id, category_id, fiscal_year_id)).fetchone())
+    return next((row['id'] for row in ids if row is not None), None)
+
+def audit_trigger_sql(table, columns):
+    """
+    Build the insert, update and delete triggers that append to AuditLog in
+    the same transaction as the change. Updates that change nothing, such as
+    clearing is_active on every fiscal year, are not recorded.
+    """
+    def row_json(ref):
+        return 'json_object(' + ', '.join(f"'{column}', {ref}.{column}" for column in columns) + ')'
+
+    changed = ' OR '.join(f'OLD.{column} IS NOT NEW.{column}' for column in columns)
+    statements = []
+    for action, when, ref, old_values, new_values in (
+        ('INSERT', '', 'NEW', 'NULL', row_json('NEW')),
+        ('UPDATE', f'WHEN {changed}', 'NEW', row_json('OLD'), row_json('NEW')),
+        ('DELETE', '', 'OLD', row_json('OLD'), 'NULL')
+    ):
+        statements.append(f'''
+            CREATE TRIGGER IF NOT EXISTS audit_{table.lower()}_{action.lower()} AFTER {action} ON {table} {when}
+            BEGIN
+                INSERT INTO AuditLog
+                (changed_at, actor, correlation_id, table_name, entity_id, action, old_values, new_values, hash)
+                SELECT changed_at, actor, correlation_id, '{table}', {ref}.id, '{action}', old_values, new_values,
+                       audit_hash((SELECT hash FROM AuditLog ORDER BY id DESC LIMIT 1), changed_at, actor,
+                                  correlation_id, '{table}', {ref}.id, '{action}', old_values, new_values)
+                FROM (SELECT strftime('%Y-%m-%dT%H:%M:%fZ', 'now') AS changed_at, audit_actor() AS actor,
+                             audit_correlation_id() AS correlation_id,
+                             {old_values} AS old_values, {new_values} AS new_values);
+            END;
+        ''')
+    return ''.join(statements)
+
+def postgres_audit_trigger_sql(table, columns):
+    """Build the PostgreSQL versions of the audit triggers, which call audit_change"""
+    arguments = ', '.join(f"'{name}'" for name in (table,) + columns)
+    changed = ' OR '.join(f'OLD.{column} IS DISTINCT FROM NEW.{column}' for column in columns)
+    return f'''
+        CREATE OR REPLACE TRIGGER audit_{table.lower()}_insert AFTER INSERT ON {table}
+        FOR EACH ROW EXECUTE FUNCTION audit_change({arguments});
+
+        CREATE OR REPLACE TRIGGER audit_{table.lower()}_update AFTER UPDATE ON {table}
+        FOR EACH ROW WHEN ({changed}) EXECUTE FUNCTION audit_change({arguments});
+
+        CREATE OR REPLACE TRIGGER audit_{table.lower()}_delete AFTER DELETE ON {table}
+        FOR EACH ROW EXECUTE FUNCTION audit_change({arguments});
+    '''
+
+def file_version(path):
+    """
+    Get a number that changes whenever another connection commits to a
+    database file. All writes go through a writer thread's connection, so a
+    long-lived reader connection sees every one of them.
+    """
+    with _version_lock:
+        conn = _version_conns.get(path)
+        if conn is None:
+            conn = _version_conns[path] = sqlite3.connect(path, check_same_thread=False)
+        return conn.execute('PRAGMA data_version').fetchone()[0]
+
+def get_data_version():
+    """
+    Get a value that changes whenever the database changes: a number, or
+    with sharding a tuple of every shard's number
+    """
+    if storage.DB_BACKEND == 'postgres':
+        return storage.data_version()
+    if DB_SHARDING != 'department':
+        return file_version(DB_PATH)
+    return tuple(file_version(shard_path(shard)) for shard in get_shards())
+
+def create_schema(conn):
+    """Create the SQLite tables and triggers"""
+    # Write-ahead logging lets the UI and API read while a write is in progress
+    db_writer.enable_wal(conn)
     
     # Create tables
     conn.executescript('''
@@ -49,35 +641,45 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL UNIQUE
         );
-        
-        CREATE TABLE IF NOT EXISTS Allocations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            department_id INTEGER NOT NULL,
-            category_id INTEGER NOT NULL,
-            fiscal_year_id INTEGER NOT NULL,
-            amount DECIMAL(15, 2) NOT NULL,
-            FOREIGN KEY (department_id) REFERENCES Departments (id),
-            FOREIGN KEY (category_id) REFERENCES BudgetCategories (id),
-            FOREIGN KEY (fiscal_year_id) REFERENCES FiscalYears (id),
-            UNIQUE(department_id, category_id, fiscal_year_id)
-        );
-        
-        CREATE TABLE IF NOT EXISTS Expenditures (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            allocation_id INTEGER NOT NULL,
-            amount DECIMAL(15, 2) NOT NULL,
-            description TEXT NOT NULL,
-            date DATE NOT NULL,
-            FOREIGN KEY (allocation_id) REFERENCES Allocations (id)
-        );
     ''')
     
+    conn.executescript(DEPARTMENT_SCHEMA)
+    conn.executescript(''.join(audit_trigger_sql(table, columns) for table, columns in AUDITED_TABLES.items()))
+
+def create_postgres_schema(conn):
+    """Create the PostgreSQL tables and triggers"""
+    # Processes starting together would otherwise race to create the same objects
+    storage.lock(conn, 'schema')
+    conn.executescript(POSTGRES_SCHEMA)
+    conn.executescript(''.join(postgres_audit_trigger_sql(table, columns) for table, columns in AUDITED_TABLES.items()))
+
+def init_db():
+    """Initialize the database with required tables"""
+    # Check if database exists
+    db_exists = pathlib.Path(DB_PATH).exists()
+    
+    conn = get_db_connection()
+    
+    if storage.DB_BACKEND == 'postgres':
+        create_postgres_schema(conn)
+    else:
+        create_schema(conn)
+    
+    # Give allocations written before versioning began their first version
+    conn.execute('''
+        INSERT INTO AllocationVersions
+        (allocation_id, department_id, category_id, fiscal_year_id, amount, valid_from)
+        SELECT a.id, a.department_id, a.category_id, a.fiscal_year_id, a.amount, ?
+        FROM Allocations a
+        WHERE NOT EXISTS (SELECT 1 FROM AllocationVersions v WHERE v.allocation_id = a.id)
+    ''', (VERSIONS_EPOCH,))
+    
     # Checking if departments table is empty
     dept_count = conn.execute("SELECT COUNT(*) FROM Departments").fetchone()[0]
     
     # Seed initial data if departments table is empty
     if dept_count == 0:
-        print("Initializing database with sample data...")
+        logger.info("Initializing database with sample data")
         try:
             # Create initial department structure
             conn.executescript('''
@@ -137,14 +739,14 @@ def init_db():
             for category in categories:
                 conn.execute('INSERT INTO BudgetCategories (name) VALUES (?)', (category,))
                 
-            print("Sample data created successfully!")
+            logger.info("Sample data created")
         except Exception as e:
-            print(f"Error creating sample data: {e}")
+            logger.error("Error creating sample data: %s", e)
     
     # Checking if users table is empty even if departments exist
     user_count = conn.execute("SELECT COUNT(*) FROM Users").fetchone()[0]
     if user_count == 0:
-        print("No users found. Creating default users...")
+        logger.info("No users found, creating default users")
         try:
             # Create a default admin user if departments exist
             admin_hash = pbkdf2_sha256.hash("admin123")
@@ -157,24 +759,23 @@ def init_db():
                     INSERT INTO Users (username, hashed_password, department_id)
                     VALUES (?, ?, ?)
                 ''', ('admin', admin_hash, admin_dept_id))
-                print("Default admin user created!")
+                logger.info("Default admin user created")
             else:
                 # If Administration department doesn't exist, create it first
-                conn.execute("INSERT INTO Departments (name, parent_id) VALUES ('Administration', NULL)")
-                dept_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                dept_id = conn.execute(
+                    "INSERT INTO Departments (name, parent_id) VALUES ('Administration', NULL) RETURNING id"
+                ).fetchone()[0]
                 conn.execute('''
                     INSERT INTO Users (username, hashed_password, department_id)
                     VALUES (?, ?, ?)
                 ''', ('admin', admin_hash, dept_id))
-                print("Created Administration department and default admin user!")
+                logger.info("Created Administration department and default admin user")
         except Exception as e:
-            print(f"Error creating default user: {e}")
+            logger.error("Error creating default user: %s", e)
     
     conn.commit()
     conn.close()
-    print(f"Database initialized at {DB_PATH}")
+    logger.info("Database initialized", extra={"db_path": DB_PATH})
 
-print("About to initialize database...")
 # Initialize the database when this module is imported
-init_db()
-print("Database initialization complete!") 
\ No newline at end of file
+init_db() 
\ No newline at end of file
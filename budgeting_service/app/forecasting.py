@@ -0,0 +1,188 @@
+import datetime
+import os
+import re
+import threading
+import numpy as np
+import pandas as pd
+import analytics
+import db
+
+# Month and day each fiscal year starts on; a year named "2024-2025" starts in 2024
+FISCAL_YEAR_START = os.environ.get('FISCAL_YEAR_START', '04-01')
+
+# Forecasts per (fiscal year, as-of date), recomputed when the database changes
+_forecast_cache = {}
+_cache_lock = threading.Lock()
+
+def fiscal_year_bounds(year_name):
+    """Get the first and last day of a fiscal year from its name, or None if it names no year"""
+    match = re.search(r'\d{4}', year_name or '')
+    if not match:
+        return None
+
+    month, day = (int(part) for part in FISCAL_YEAR_START.split('-'))
+    start = datetime.date(int(match.group()), month, day)
+    end = datetime.date(start.year + 1, month, day) - datetime.timedelta(days=1)
+    return start, end
+
+def get_fiscal_years():
+    """Get all fiscal years with their bounds, oldest first"""
+    conn = db.get_db_connection()
+    rows = conn.execute('SELECT id, year_name, is_active FROM FiscalYears').fetchall()
+    conn.close()
+
+    years = []
+    for row in rows:
+        bounds = fiscal_year_bounds(row['year_name'])
+        years.append({
+            'id': row['id'],
+            'year_name': row['year_name'],
+            'is_active': bool(row['is_active']),
+            'start': bounds[0] if bounds else None,
+            'end': bounds[1] if bounds else None
+        })
+    return sorted(years, key=lambda year: (year['start'] or datetime.date.max, year['id']))
+
+def day_offsets(dates, start):
+    """Days from the start of the fiscal year for an array of dates"""
+    return (dates - np.datetime64(start, 'D')).astype(np.int64)
+
+def linear_projection(allocation, amount, offset, observed_days, year_days, spent):
+    """
+    Fit cumulative spend C(t) = a + b*t over days 0..observed_days-1 for
+    every allocation at once, then carry spend so far on at the fitted daily
+    rate b to the end of the year. The least-squares sums over each
+    cumulative series are computed from the expenditures directly, so no
+    allocation x day matrix is built: sum C(t) = sum x*(T - d) and
+    sum t*C(t) = sum x*(T - 1 + d)*(T - d)/2 for an expenditure of x on day d.
+    """
+    n = float(observed_days)
+    sum_t = n * (n - 1) / 2
+    sum_tt = (n - 1) * n * (2 * n - 1) / 6
+    sum_c = np.bincount(allocation, weights=amount * (n - offset), minlength=len(spent))
+    sum_tc = np.bincount(allocation, weights=amount * (n - 1 + offset) * (n - offset) / 2, minlength=len(spent))
+
+    denominator = n * sum_tt - sum_t ** 2
+    if denominator > 0:
+        rate = np.maximum((n * sum_tc - sum_t * sum_c) / denominator, 0)
+    else:
+        # A single observed day: carry that day's spend on at the same rate
+        rate = spent
+    return spent + rate * (year_days - observed_days)
+
+def seasonal_projection(data, previous, observed_days, spent):
+    """
+    Seasonal-naive forecast: assume each category's spending follows the same
+    course through the year as it did in the previous fiscal year, so spend so
+    far is the same share of the year-end total. Category profiles are used
+    rather than per-allocation ones, which are too sparse to be stable.
+    Returns the projection per allocation and whether its category has a
+    previous-year profile.
+    """
+    if previous is None:
+        return np.zeros(len(spent)), np.zeros(len(spent), dtype=bool)
+
+    previous_data, previous_start = previous
+    offset = day_offsets(previous_data["expenditure_date"], previous_start)
+    category = previous_data["category_id"][previous_data["expenditure_allocation"]]
+    amount = previous_data["expenditure_amount"]
+
+    width = int(max(data["category_id"].max(initial=0), category.max(initial=0))) + 1
+    total = np.bincount(category, weights=amount, minlength=width)
+    so_far = np.bincount(category[offset < observed_days], weights=amount[offset < observed_days], minlength=width)
+
+    share = np.divide(so_far, total, out=np.zeros(width), where=total > 0)[data["category_id"]]
+    has_history = share > 0
+    projected = np.divide(spent, share, out=np.zeros(len(spent)), where=has_history)
+    return projected, has_history
+
+def build_forecast(fiscal_year_id, as_of):
+    """
+    Project year-end spend for every allocation in a fiscal year from the
+    expenditures recorded up to as_of
+    Returns a dict with year_start, year_end, as_of and a frame of one row per
+    allocation: allocation_id, department_id, category_id, allocated, spent,
+    linear, seasonal (NaN without a previous-year profile), forecast,
+    model and overrun (forecast minus allocated)
+    """
+    years = get_fiscal_years()
+    position = next((i for i, year in enumerate(years) if year['id'] == fiscal_year_id), None)
+    if position is None:
+        return None
+
+    data = analytics.get_fiscal_year_data(fiscal_year_id)
+    year = years[position]
+    if year['start'] is not None:
+        start, end = year['start'], year['end']
+    elif len(data["expenditure_date"]):
+        start = data["expenditure_date"].min().item()
+        end = start + datetime.timedelta(days=364)
+    else:
+        start = end = as_of
+
+    as_of = min(max(as_of, start), end)
+    year_days = (end - start).days + 1
+    observed_days = (as_of - start).days + 1
+
+    # Expenditures dated after as_of are left out, earlier ones count from day 0
+    count = len(data["allocation_id"])
+    offset = day_offsets(data["expenditure_date"], start)
+    observed = offset < observed_days
+    allocation = data["expenditure_allocation"][observed]
+    amount = data["expenditure_amount"][observed]
+    offset = np.maximum(offset[observed], 0)
+
+    spent = np.bincount(allocation, weights=amount, minlength=count)
+    linear = linear_projection(allocation, amount, offset, observed_days, year_days, spent)
+
+    previous = None
+    if position > 0 and years[position - 1]['start'] is not None:
+        previous = (analytics.get_fiscal_year_data(years[position - 1]['id']), years[position - 1]['start'])
+    seasonal, has_history = seasonal_projection(data, previous, observed_days, spent)
+    seasonal = np.where(has_history, seasonal, np.nan)
+
+    forecast = np.where(has_history, seasonal, linear)
+    frame = pd.DataFrame({
+        'allocation_id': data["allocation_id"],
+        'department_id': data["department_id"],
+        'category_id': data["category_id"],
+        'allocated': data["allocated"],
+        'spent': np.round(spent, 2),
+        'linear': np.round(linear, 2),
+        'seasonal': np.round(seasonal, 2),
+        'forecast': np.round(forecast, 2),
+        'model': np.where(has_history, 'seasonal_naive', 'linear'),
+        'overrun': np.round(forecast - data["allocated"], 2)
+    })
+
+    return {"year_start": start, "year_end": end, "as_of": as_of, "frame": frame}
+
+def get_forecast(fiscal_year_id, as_of=None):
+    """Get a fiscal year's forecast as of a date (default today), recomputing it only after the database changed"""
+    as_of = as_of or datetime.date.today()
+    version = db.get_data_version()
+    key = (fiscal_year_id, as_of)
+
+    entry = _forecast_cache.get(key)
+    if entry is not None and entry["version"] == version:
+        analytics.CACHE_REQUESTS.inc(cache='forecast', result='hit')
+        return entry["forecast"]
+
+    analytics.CACHE_REQUESTS.inc(cache='forecast', result='miss')
+    with _cache_lock:
+        entry = _forecast_cache.get(key)
+        if entry is None or entry["version"] != version:
+            # Forecasts from before the last change will never be hit again
+            for stale in [k for k, v in _forecast_cache.items() if v["version"] != version]:
+                del _forecast_cache[stale]
+            entry = {"version": version, "forecast": build_forecast(fiscal_year_id, as_of)}
+            _forecast_cache[key] = entry
+        return entry["forecast"]
+
+def projected_overruns(forecast, department_ids=None):
+    """Allocations projected to spend more than allocated, largest overrun first"""
+    frame = forecast["frame"]
+    at_risk = frame['overrun'] > 0
+    if department_ids is not None:
+        at_risk &= frame['department_id'].isin(department_ids)
+    return frame[at_risk].sort_values('overrun', ascending=False).reset_index(drop=True)
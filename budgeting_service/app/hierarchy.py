@@ -0,0 +1,84 @@
+def build_department_tree(departments):
+    """
+    Build a department tree index from a flat list of department rows
+    Returns:
+    - department_names: dict mapping dept_id to name
+    - parent_mapping: dict mapping dept_id to parent_id
+    - children_mapping: dict mapping parent_id to list of child dept_ids
+    - preorder: list of (dept_id, depth) tuples in display order
+    - position: dict mapping dept_id to its index in preorder
+    - subtree_size: dict mapping dept_id to the number of departments in its subtree
+    """
+    department_names = {}
+    parent_mapping = {}
+    children_mapping = {}
+
+    # Build basic mappings in a single pass
+    for dept in departments:
+        dept_id = dept['id']
+        parent_id = dept['parent_id']
+
+        department_names[dept_id] = dept['name']
+        parent_mapping[dept_id] = parent_id
+        children_mapping.setdefault(parent_id, []).append(dept_id)
+
+    # Iterative preorder walk from the top-level departments.
+    # The visited set protects against cycles in parent_id.
+    preorder = []
+    position = {}
+    stack = [(dept_id, 0) for dept_id in reversed(children_mapping.get(None, []))]
+
+    while stack:
+        dept_id, depth = stack.pop()
+        if dept_id in position:
+            continue
+
+        position[dept_id] = len(preorder)
+        preorder.append((dept_id, depth))
+
+        for child_id in reversed(children_mapping.get(dept_id, [])):
+            stack.append((child_id, depth + 1))
+
+    # A subtree occupies a contiguous run of the preorder, so its size is the
+    # distance to the next department at the same or a shallower depth
+    subtree_size = {}
+    open_nodes = []
+    for index, (dept_id, depth) in enumerate(preorder):
+        while open_nodes and preorder[open_nodes[-1]][1] >= depth:
+            closed = open_nodes.pop()
+            subtree_size[preorder[closed][0]] = index - closed
+        open_nodes.append(index)
+    for closed in open_nodes:
+        subtree_size[preorder[closed][0]] = len(preorder) - closed
+
+    return {
+        "department_names": department_names,
+        "parent_mapping": parent_mapping,
+        "children_mapping": children_mapping,
+        "preorder": preorder,
+        "position": position,
+        "subtree_size": subtree_size
+    }
+
+def get_department_name(tree, dept_id):
+    """Look up a department name by ID"""
+    return tree["department_names"].get(dept_id, f"Department {dept_id}")
+
+def get_subtree_ids(tree, dept_id):
+    """Get the IDs of a department and all of its descendants"""
+    start = tree["position"].get(dept_id)
+    if start is None:
+        return [dept_id] if dept_id in tree["department_names"] else []
+
+    end = start + tree["subtree_size"][dept_id]
+    return [node_id for node_id, _ in tree["preorder"][start:end]]
+
+def format_department_label(tree, dept_id):
+    """Format a department name indented by its depth in the tree"""
+    position = tree["position"].get(dept_id)
+    depth = tree["preorder"][position][1] if position is not None else 0
+    return ('  ' * depth) + get_department_name(tree, dept_id)
+
+def department_options(tree):
+    """Get department IDs in display order, for use as selectbox options"""
+    return [dept_id for dept_id, _ in tree["preorder"]]
@@ -0,0 +1,186 @@
+import argparse
+import json
+import db
+import logs
+import storage
+
+logger = logs.get_logger(__name__)
+
+# The source year's allocations with each category's percentage adjustment applied.
+# :adjustments is a JSON object mapping category_id to a percentage.
+ROLLOVER_SELECT = f'''
+    SELECT a.department_id, a.category_id, a.amount AS source_amount,
+           ROUND(a.amount * (1 + COALESCE(CAST(adjustment.value AS NUMERIC), 0) / 100.0), 2) AS amount
+    FROM Allocations a
+    LEFT JOIN {storage.json_each(':adjustments')} adjustment ON CAST(adjustment.key AS INTEGER) = a.category_id
+    WHERE a.fiscal_year_id = :source_fiscal_year_id
+'''
+
+SUMMARY_SQL = f'''
+    SELECT r.category_id, c.name, COUNT(*) AS allocations,
+           SUM(r.source_amount) AS source_amount, SUM(r.amount) AS amount
+    FROM ({ROLLOVER_SELECT}) r
+    LEFT JOIN BudgetCategories c ON c.id = r.category_id
+    GROUP BY r.category_id, c.name
+    ORDER BY c.name
+'''
+
+def set_active_fiscal_year(conn, fiscal_year_id):
+    """Make a fiscal year the only active one with a single UPDATE inside a write job"""
+    conn.execute('''
+        UPDATE FiscalYears SET is_active = CASE WHEN id = ? THEN 1 ELSE 0 END WHERE is_active = 1 OR id = ?
+    ''', (fiscal_year_id, fiscal_year_id))
+
+def validate_adjustments(adjustments):
+    """Normalise {category_id: percent} adjustments, rejecting cuts of more than 100%"""
+    normalised = {}
+    for category_id, percent in (adjustments or {}).items():
+        percent = float(percent)
+        if percent < -100:
+            raise ValueError(f"Adjustment for category {category_id} cannot cut more than 100%")
+        normalised[int(category_id)] = percent
+    return normalised
+
+def summarise(conn, params, adjustments):
+    """Per-category counts and totals of a rollover, before and after adjustment"""
+    return summary_from_rows(conn.execute(SUMMARY_SQL, params).fetchall(), adjustments)
+
+def summary_from_rows(rows, adjustments):
+    """Build a rollover summary from SUMMARY_SQL rows, adding up categories that repeat across shards"""
+    categories = {}
+    for row in rows:
+        category = categories.setdefault(row['category_id'], {
+            "category_id": row['category_id'],
+            "category": row['name'],
+            "allocations": 0,
+            "adjustment_percent": adjustments.get(row['category_id'], 0.0),
+            "source_amount": 0.0,
+            "amount": 0.0
+        })
+        category["allocations"] += row['allocations']
+        category["source_amount"] += row['source_amount']
+        category["amount"] += row['amount']
+
+    categories = sorted(categories.values(), key=lambda category: category["category"] or '')
+    for category in categories:
+        category["source_amount"] = round(category["source_amount"], 2)
+        category["amount"] = round(category["amount"], 2)
+
+    return {
+        "allocations": sum(category["allocations"] for category in categories),
+        "source_total": round(sum(category["source_amount"] for category in categories), 2),
+        "new_total": round(sum(category["amount"] for category in categories), 2),
+        "categories": categories
+    }
+
+def check_rollover(conn, source_fiscal_year_id, year_name):
+    if conn.execute('SELECT 1 FROM FiscalYears WHERE id = ?', (source_fiscal_year_id,)).fetchone() is None:
+        raise ValueError(f"Fiscal year {source_fiscal_year_id} does not exist")
+    if conn.execute('SELECT 1 FROM FiscalYears WHERE year_name = ?', (year_name,)).fetchone() is not None:
+        raise ValueError(f"Fiscal year '{year_name}' already exists")
+
+def roll_over(source_fiscal_year_id, year_name, adjustments=None, activate=True, dry_run=False):
+    """
+    Open a new fiscal year with a copy of every allocation of a source year,
+    adjusted by an optional percentage per category ({category_id: percent}).
+    The year is created, its allocations copied with one INSERT ... SELECT and,
+    with activate, made the active year, all in one write transaction, or one
+    per shard when the database is sharded. With dry_run nothing is written. Raises ValueError if the source year does not
+    exist or the new year's name is taken.
+    Returns a dict with fiscal_year_id (None for a dry run), year_name, the
+    number of allocations, source and new totals and a per-category breakdown
+    """
+    adjustments = validate_adjustments(adjustments)
+    params = {"adjustments": json.dumps(adjustments), "source_fiscal_year_id": source_fiscal_year_id}
+
+    if dry_run:
+        conn = db.get_db_connection()
+        try:
+            check_rollover(conn, source_fiscal_year_id, year_name)
+        finally:
+            conn.close()
+        summary = summary_from_rows(
+            [row for rows in db.fan_out(lambda conn: conn.execute(SUMMARY_SQL, params).fetchall()) for row in rows],
+            adjustments
+        )
+        fiscal_year_id = None
+    elif db.DB_SHARDING == 'department':
+        fiscal_year_id, summary = roll_over_shards(params, year_name, adjustments, activate)
+    else:
+        def create_year(conn):
+            check_rollover(conn, source_fiscal_year_id, year_name)
+            fiscal_year_id = conn.execute(
+                'INSERT INTO FiscalYears (year_name, is_active) VALUES (?, 0) RETURNING id', (year_name,)
+            ).fetchone()[0]
+            conn.execute(f'''
+                INSERT INTO Allocations (department_id, category_id, fiscal_year_id, amount)
+                SELECT department_id, category_id, :fiscal_year_id, amount FROM ({ROLLOVER_SELECT})
+            ''', dict(params, fiscal_year_id=fiscal_year_id))
+            if activate:
+                set_active_fiscal_year(conn, fiscal_year_id)
+            return fiscal_year_id, summarise(conn, params, adjustments)
+
+        fiscal_year_id, summary = db.run_write(create_year)
+
+    if not dry_run:
+        logger.info("Rolled over fiscal year", extra={
+            "source_fiscal_year_id": source_fiscal_year_id, "fiscal_year_id": fiscal_year_id,
+            "allocations": summary["allocations"], "activated": activate
+        })
+
+    summary.update({"fiscal_year_id": fiscal_year_id, "year_name": year_name, "dry_run": dry_run})
+    return summary
+
+def roll_over_shards(params, year_name, adjustments, activate):
+    """
+    Roll a year over when the database is sharded. The adjusted allocations
+    are read from every shard and written to their departments' shards in
+    parallel, one transaction per shard. The new year is created inactive
+    first and only activated once every shard has its allocations, so a
+    failure part way leaves an inactive year to finish or delete by hand.
+    """
+    def read_shard(conn):
+        check_rollover(conn, params["source_fiscal_year_id"], year_name)
+        return conn.execute(ROLLOVER_SELECT, params).fetchall(), conn.execute(SUMMARY_SQL, params).fetchall()
+
+    results = db.fan_out(read_shard)
+    targets = {}
+    for rows, _ in results:
+        for row in rows:
+            targets.setdefault(db.shard_for_department(row['department_id']), []).append(row)
+
+    def create_year(conn):
+        check_rollover(conn, params["source_fiscal_year_id"], year_name)
+        return conn.execute(
+            'INSERT INTO FiscalYears (year_name, is_active) VALUES (?, 0) RETURNING id', (year_name,)
+        ).fetchone()[0]
+
+    fiscal_year_id = db.run_write(create_year)
+
+    def copy_allocations(shard):
+        rows = [(row['department_id'], row['category_id'], fiscal_year_id, row['amount']) for row in targets[shard]]
+        return db.run_write(lambda conn: conn.executemany('''
+            INSERT INTO Allocations (department_id, category_id, fiscal_year_id, amount) VALUES (?, ?, ?, ?)
+        ''', rows).rowcount, shard=shard)
+
+    db.map_shards(copy_allocations, sorted(targets))
+    if activate:
+        db.run_write(lambda conn: set_active_fiscal_year(conn, fiscal_year_id))
+
+    return fiscal_year_id, summary_from_rows([row for _, rows in results for row in rows], adjustments)
+
+def parse_adjustment(value):
+    category_id, _, percent = value.partition('=')
+    return int(category_id), float(percent)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Open a new fiscal year with a copy of another year's allocations")
+    parser.add_argument('--source', type=int, required=True, help="fiscal year id to copy allocations from")
+    parser.add_argument('--name', required=True, help="name of the new fiscal year, e.g. 2025-2026")
+    parser.add_argument('--adjust', type=parse_adjustment, action='append', default=[], metavar='CATEGORY_ID=PERCENT',
+                        help="change a category's allocations by a percentage (repeatable)")
+    parser.add_argument('--no-activate', action='store_true', help="leave the current active year active")
+    parser.add_argument('--dry-run', action='store_true', help="preview the rollover without writing it")
+    args = parser.parse_args()
+
+    print(json.dumps(roll_over(args.source, args.name, dict(args.adjust), not args.no_activate, args.dry_run), indent=2))
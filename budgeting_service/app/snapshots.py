@@ -0,0 +1,284 @@
+import argparse
+import datetime
+import io
+import os
+import time
+import numpy as np
+import analytics
+import db
+import forecasting
+import logs
+import storage
+
+logger = logs.get_logger(__name__)
+
+# Audit entries written since a fiscal year's latest snapshot before the periodic job takes another
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', '1000'))
+
+# Entries are timestamped when their statement runs but numbered in commit order, so an
+# entry committed after a snapshot can carry a slightly earlier timestamp (seconds)
+COMMIT_SKEW = 60
+
+STATE_COLUMNS = ('department_id', 'category_id', 'allocated', 'spent')
+
+# Signed changes to (department, category) totals from a window of AuditLog entries.
+# Entries after the snapshot are added; entries the snapshot holds but that fall after
+# the requested time are taken away. Expenditures are placed by their allocation.
+REPLAY_SQL = f'''
+    WITH deltas AS (
+        SELECT 1 AS sign, table_name, old_values, new_values
+        FROM AuditLog
+        WHERE changed_at >= :window_start AND changed_at <= :at AND id > :audit_id
+          AND table_name IN ('Allocations', 'Expenditures')
+        UNION ALL
+        SELECT -1, table_name, old_values, new_values
+        FROM AuditLog
+        WHERE changed_at > :at AND changed_at <= :taken_at AND id <= :audit_id
+          AND table_name IN ('Allocations', 'Expenditures')
+    ),
+    expenditure_deltas AS (
+        SELECT sign, COALESCE(new_values, old_values) AS row_values,
+               sign * (COALESCE({storage.json_value('new_values', 'amount')}, 0)
+                       - COALESCE({storage.json_value('old_values', 'amount')}, 0)) AS spent
+        FROM deltas
+        WHERE table_name = 'Expenditures'
+    ),
+    changes AS (
+        SELECT {storage.json_value('new_values', 'fiscal_year_id')} AS fiscal_year_id,
+               {storage.json_value('new_values', 'department_id')} AS department_id,
+               {storage.json_value('new_values', 'category_id')} AS category_id,
+               sign * {storage.json_value('new_values', 'amount')} AS allocated, 0 AS spent
+        FROM deltas
+        WHERE table_name = 'Allocations' AND new_values IS NOT NULL
+        UNION ALL
+        SELECT {storage.json_value('old_values', 'fiscal_year_id')},
+               {storage.json_value('old_values', 'department_id')},
+               {storage.json_value('old_values', 'category_id')},
+               -sign * {storage.json_value('old_values', 'amount')}, 0
+        FROM deltas
+        WHERE table_name = 'Allocations' AND old_values IS NOT NULL
+        UNION ALL
+        SELECT v.fiscal_year_id, v.department_id, v.category_id, 0, e.spent
+        FROM expenditure_deltas e
+        JOIN AllocationVersions v ON v.id = (
+            SELECT id FROM AllocationVersions
+            WHERE allocation_id = {storage.json_value('e.row_values', 'allocation_id')}
+            ORDER BY valid_from DESC, id DESC
+            LIMIT 1
+        )
+    )
+    SELECT department_id, category_id, SUM(allocated), SUM(spent)
+    FROM changes
+    WHERE fiscal_year_id = :fiscal_year_id
+    GROUP BY department_id, category_id
+'''
+
+def as_of_timestamp(value):
+    """The last moment of a date, or an ISO timestamp, in the AuditLog timestamp format"""
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%S.') + f"{value.microsecond // 1000:03d}Z"
+    if isinstance(value, datetime.date):
+        return f"{value.isoformat()}T23:59:59.999Z"
+    return value
+
+def parse_timestamp(value):
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def shift_timestamp(value, seconds):
+    return as_of_timestamp(parse_timestamp(value) + datetime.timedelta(seconds=seconds))
+
+def encode_state(columns):
+    """Compress state columns into a snapshot blob"""
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **columns)
+    return buffer.getvalue()
+
+def decode_state(data):
+    """Read state columns back from a snapshot blob"""
+    with np.load(io.BytesIO(data)) as arrays:
+        return {column: arrays[column] for column in STATE_COLUMNS}
+
+def capture_state(conn, fiscal_year_id):
+    """
+    Read a fiscal year's department x category totals and the last AuditLog id
+    in one read transaction, so the totals are exactly the state after that entry
+    """
+    conn.row_factory = None
+    storage.begin_read(conn)
+    try:
+        audit_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM AuditLog').fetchone()[0]
+        # Taken after the read starts, so every entry in the snapshot is at or before it
+        taken_at = as_of_timestamp(datetime.datetime.utcnow())
+        rows = conn.execute('''
+            SELECT a.department_id, a.category_id, a.amount,
+                   (SELECT COALESCE(SUM(e.amount), 0) FROM Expenditures e WHERE e.allocation_id = a.id)
+            FROM Allocations a
+            WHERE a.fiscal_year_id = ?
+        ''', (fiscal_year_id,)).fetchall()
+    finally:
+        conn.commit()
+
+    return audit_id, taken_at, columns_from_rows(rows)
+
+def columns_from_rows(rows):
+    """Turn (department_id, category_id, allocated, spent) rows into state columns"""
+    columns = list(zip(*rows)) or [(), (), (), ()]
+    return {
+        "department_id": np.array(columns[0], dtype=np.int64),
+        "category_id": np.array(columns[1], dtype=np.int64),
+        "allocated": np.array(columns[2], dtype=np.float64),
+        "spent": np.array(columns[3], dtype=np.float64)
+    }
+
+def snapshot_shard(fiscal_year_id, shard=0):
+    """Store a compressed snapshot of a fiscal year's current totals in one shard. Returns its id."""
+    conn = db.get_db_connection(shard)
+    audit_id, taken_at, columns = capture_state(conn, fiscal_year_id)
+    conn.close()
+
+    snapshot_id = db.run_write(lambda conn: conn.execute('''
+        INSERT INTO RollupSnapshots (fiscal_year_id, audit_id, taken_at, cells, data)
+        VALUES (?, ?, ?, ?, ?)
+        RETURNING id
+    ''', (fiscal_year_id, audit_id, taken_at, len(columns["department_id"]), encode_state(columns))).fetchone()[0],
+        shard=shard)
+
+    logger.info("Took rollup snapshot", extra={"fiscal_year_id": fiscal_year_id, "audit_id": audit_id,
+                                               "cells": len(columns["department_id"]), "shard": shard})
+    return snapshot_id
+
+def take_snapshot(fiscal_year_id):
+    """
+    Snapshot a fiscal year in every shard, since each shard's audit log
+    numbers its own entries. Returns the snapshot ids in shard order.
+    """
+    return db.map_shards(lambda shard: snapshot_shard(fiscal_year_id, shard))
+
+def nearest_snapshot(conn, fiscal_year_id, at):
+    """Get the snapshot of a fiscal year taken closest to a timestamp, before or after it"""
+    candidates = [row for row in (
+        conn.execute('''
+            SELECT * FROM RollupSnapshots WHERE fiscal_year_id = ? AND taken_at <= ?
+            ORDER BY taken_at DESC LIMIT 1
+        ''', (fiscal_year_id, at)).fetchone(),
+        conn.execute('''
+            SELECT * FROM RollupSnapshots WHERE fiscal_year_id = ? AND taken_at > ?
+            ORDER BY taken_at LIMIT 1
+        ''', (fiscal_year_id, at)).fetchone()
+    ) if row is not None]
+
+    if not candidates:
+        return None
+    target = parse_timestamp(at)
+    return min(candidates, key=lambda row: abs(parse_timestamp(row['taken_at']) - target))
+
+def shard_state_as_of(fiscal_year_id, at, shard=0):
+    """Reconstruct one shard's totals at a timestamp from its nearest snapshot and audit log"""
+    conn = db.get_db_connection(shard)
+    snapshot = nearest_snapshot(conn, fiscal_year_id, at)
+    if snapshot is None:
+        conn.close()
+        snapshot_shard(fiscal_year_id, shard)
+        conn = db.get_db_connection(shard)
+        snapshot = nearest_snapshot(conn, fiscal_year_id, at)
+
+    conn.row_factory = None
+    deltas = conn.execute(REPLAY_SQL, {
+        "fiscal_year_id": fiscal_year_id,
+        "audit_id": snapshot['audit_id'],
+        "taken_at": snapshot['taken_at'],
+        "window_start": shift_timestamp(snapshot['taken_at'], -COMMIT_SKEW),
+        "at": at
+    }).fetchall()
+    conn.close()
+
+    return {
+        "state": decode_state(snapshot['data']),
+        "changes": columns_from_rows(deltas),
+        "snapshot": {"shard": shard, "snapshot_id": snapshot['id'], "taken_at": snapshot['taken_at']}
+    }
+
+def state_as_of(fiscal_year_id, at):
+    """
+    Reconstruct a fiscal year's department x category totals as they were at a
+    date or timestamp, from the nearest snapshot plus the changes between the
+    two, in every shard. A snapshot is taken first if a shard has none.
+    Returns a dict with the state columns, the snapshots used and the number
+    of replayed cells
+    """
+    at = as_of_timestamp(at)
+    shards = db.map_shards(lambda shard: shard_state_as_of(fiscal_year_id, at, shard))
+
+    # Add the deltas to the snapshots' cells and merge cells that now repeat
+    parts = [part for shard in shards for part in (shard["state"], shard["changes"])]
+    merged = {column: np.concatenate([part[column] for part in parts]) for column in STATE_COLUMNS}
+    width = int(merged["category_id"].max(initial=0)) + 1
+    cells, inverse = np.unique(merged["department_id"] * width + merged["category_id"], return_inverse=True)
+
+    return {
+        "department_id": cells // width,
+        "category_id": cells % width,
+        "allocated": np.bincount(inverse, weights=merged["allocated"], minlength=len(cells)),
+        "spent": np.bincount(inverse, weights=merged["spent"], minlength=len(cells)),
+        "snapshots": [shard["snapshot"] for shard in shards],
+        "replayed_cells": sum(len(shard["changes"]["department_id"]) for shard in shards)
+    }
+
+def rollup_as_of(fiscal_year_id, as_of, tree):
+    """Build an analytics rollup of a fiscal year as it was on a date"""
+    state = state_as_of(fiscal_year_id, as_of)
+
+    conn = db.get_db_connection()
+    categories = dict(conn.execute('SELECT id, name FROM BudgetCategories').fetchall())
+    year = conn.execute('SELECT year_name FROM FiscalYears WHERE id = ?', (fiscal_year_id,)).fetchone()
+    conn.close()
+
+    # Burn rates run from the start of the fiscal year to the as-of date
+    bounds = forecasting.fiscal_year_bounds(year['year_name']) if year else None
+    elapsed_days = 0
+    if bounds:
+        elapsed_days = min(max((as_of - bounds[0]).days + 1, 0), (bounds[1] - bounds[0]).days + 1)
+
+    return analytics.rollup_from_columns(state, categories, tree, elapsed_days)
+
+def get_allocation_versions(allocation_id):
+    """Get every version of an allocation, oldest first"""
+    conn = db.get_db_connection(db.shard_for_id(allocation_id))
+    rows = conn.execute('''
+        SELECT * FROM AllocationVersions WHERE allocation_id = ? ORDER BY valid_from, id
+    ''', (allocation_id,)).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def snapshot_due_years(shard=0):
+    """Fiscal years whose latest snapshot in a shard is more than SNAPSHOT_INTERVAL audit entries old"""
+    conn = db.get_db_connection(shard)
+    rows = conn.execute('''
+        SELECT f.id
+        FROM FiscalYears f
+        LEFT JOIN RollupSnapshots s ON s.id = (
+            SELECT id FROM RollupSnapshots WHERE fiscal_year_id = f.id ORDER BY audit_id DESC LIMIT 1
+        )
+        WHERE COALESCE(s.audit_id, -1) < (SELECT COALESCE(MAX(id), 0) FROM AuditLog) - ?
+    ''', (SNAPSHOT_INTERVAL,)).fetchall()
+    conn.close()
+    return [row['id'] for row in rows]
+
+def take_due_snapshots():
+    """Snapshot every fiscal year with enough changes since its last snapshot, shard by shard"""
+    taken = [snapshot_shard(fiscal_year_id, shard)
+             for shard in db.get_shards() for fiscal_year_id in snapshot_due_years(shard)]
+    logger.info("Snapshot run finished", extra={"snapshots": len(taken)})
+    return taken
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Take point-in-time snapshots of budget rollups")
+    parser.add_argument('--every', type=int, default=0,
+                        help="repeat every N seconds instead of running once")
+    args = parser.parse_args()
+
+    while True:
+        take_due_snapshots()
+        if not args.every:
+            break
+        time.sleep(args.every)
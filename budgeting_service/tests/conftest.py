@@ -0,0 +1,9 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'common', 'tests'))
+
+from service_tests import database_fixtures, load_service
+
+db, storage = load_service('budgeting_service')
+database, service_database = database_fixtures('budgeting_service', db, storage)
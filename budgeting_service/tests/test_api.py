@@ -0,0 +1,18 @@
+import pytest
+import api
+
+
+@pytest.fixture
+def client():
+    return api.app.test_client()
+
+@pytest.mark.parametrize('limit', ['-1', '0', 'ten'])
+def test_audit_rejects_invalid_limits(client, limit):
+    response = client.get(f'/api/audit?limit={limit}')
+    assert response.status_code == 400
+
+def test_audit_caps_the_limit(client):
+    response = client.get('/api/audit?limit=5000')
+    assert response.status_code == 200
+    assert len(response.get_json()) <= 1000
+    assert len(client.get('/api/audit?limit=1').get_json()) == 1
@@ -0,0 +1,105 @@
+import datetime
+import itertools
+import time
+import pytest
+import audit
+import balances
+import comparison
+import db
+import rollover
+import snapshots
+
+_years = itertools.count(2100)
+
+
+def create_year(allocations):
+    """
+    Create an inactive fiscal year with (department_id, category_id, amount)
+    allocations, each in its department's shard
+    Returns the fiscal year's id and the allocation ids
+    """
+    start = next(_years)
+    fiscal_year_id = db.run_write(lambda conn: conn.execute(
+        'INSERT INTO FiscalYears (year_name, is_active) VALUES (?, 0) RETURNING id', (f'{start}-{start + 1}',)
+    ).fetchone()[0])
+
+    allocation_ids = []
+    for department_id, category_id, amount in allocations:
+        allocation_ids.append(db.run_write(lambda conn: conn.execute('''
+            INSERT INTO Allocations (department_id, category_id, fiscal_year_id, amount)
+            VALUES (?, ?, ?, ?)
+            RETURNING id
+        ''', (department_id, category_id, fiscal_year_id, amount)).fetchone()[0], shard=db.shard_for_department(department_id)))
+    return fiscal_year_id, allocation_ids
+
+def test_record_expenditure_updates_balance():
+    _, (allocation_id,) = create_year([(4, 1, 1000)])
+
+    result = balances.record_expenditure(allocation_id, 250, 'Laptops', '2100-05-01')
+    assert result["remaining"] == 750
+    assert not result["overspent"]
+    assert balances.get_balance(allocation_id) == {"allocated": 1000, "spent": 250, "remaining": 750}
+
+def test_hard_policy_rejects_overspend():
+    _, (allocation_id,) = create_year([(4, 1, 100)])
+
+    with pytest.raises(balances.OverspendError):
+        balances.record_expenditure(allocation_id, 150, 'Servers', '2100-05-01', policy='hard')
+    assert balances.get_balance(allocation_id)["spent"] == 0
+
+    result = balances.record_expenditure(allocation_id, 150, 'Servers', '2100-05-01', policy='soft')
+    assert result["overspent"]
+    assert balances.get_balance(allocation_id)["remaining"] == -50
+
+def test_roll_over_copies_adjusted_allocations():
+    source_id, _ = create_year([(4, 1, 100), (6, 2, 200)])
+    start = next(_years)
+    year_name = f'{start}-{start + 1}'
+
+    preview = rollover.roll_over(source_id, year_name, adjustments={1: 10}, activate=False, dry_run=True)
+    assert preview["fiscal_year_id"] is None
+    assert preview["allocations"] == 2
+
+    result = rollover.roll_over(source_id, year_name, adjustments={1: 10}, activate=False)
+    amounts = db.fan_out(lambda conn: conn.execute('''
+        SELECT department_id, amount FROM Allocations WHERE fiscal_year_id = ? ORDER BY department_id
+    ''', (result["fiscal_year_id"],)).fetchall())
+    assert sorted((row['department_id'], float(row['amount'])) for rows in amounts for row in rows) == \
+        [(4, 110.0), (6, 200.0)]
+
+    with pytest.raises(ValueError):
+        rollover.roll_over(source_id, year_name)
+
+def test_writes_are_audited_with_their_actor():
+    db.set_actor('tester')
+    try:
+        _, (allocation_id,) = create_year([(5, 3, 500)])
+        balances.record_expenditure(allocation_id, 20, 'Cables', '2100-06-01')
+    finally:
+        db.set_actor(None)
+
+    history = audit.get_entity_history('Allocations', allocation_id)
+    assert [(entry['action'], entry['actor']) for entry in history] == [('INSERT', 'tester')]
+    assert audit.verify_chain()["first_invalid_id"] is None
+
+def test_closed_year_totals_follow_writes():
+    fiscal_year_id, (allocation_id,) = create_year([(7, 4, 300)])
+    year = {"id": fiscal_year_id, "is_active": False}
+
+    assert comparison.get_year_columns([year])[fiscal_year_id]["spent"].sum() == 0
+    balances.record_expenditure(allocation_id, 30, 'Sensors', '2100-07-01')
+    assert comparison.get_year_columns([year])[fiscal_year_id]["spent"].sum() == 30
+
+def test_state_as_of_reverts_changes_after_a_snapshot():
+    fiscal_year_id, (allocation_id,) = create_year([(4, 5, 800)])
+    before = datetime.datetime.utcnow()
+    time.sleep(0.01)
+    balances.record_expenditure(allocation_id, 25, 'Chairs', '2100-08-01')
+    snapshots.take_snapshot(fiscal_year_id)
+
+    def spent(at):
+        state = snapshots.state_as_of(fiscal_year_id, at)
+        return state["spent"][(state["department_id"] == 4) & (state["category_id"] == 5)].sum()
+
+    assert spent(datetime.datetime.utcnow()) == 25
+    assert spent(before) == 0
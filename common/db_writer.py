@@ -0,0 +1,226 @@
+import concurrent.futures
+import contextvars
+import queue
+import sqlite3
+import threading
+import time
+import query_stats
+
+# Most jobs grouped into one transaction (group commit), and how long the
+# writer lingers for more jobs once it has one (seconds)
+MAX_BATCH = 64
+GROUP_COMMIT_WINDOW = 0.002
+
+# Lock conflicts are retried in Python with backoff so waits can be counted.
+# SQLite itself only waits LOCK_POLL seconds before reporting busy.
+LOCK_POLL = 0.05
+RETRY_BASE_DELAY = 0.01
+RETRY_MAX_DELAY = 0.5
+WRITE_TIMEOUT = 10.0
+
+# How long submit_write waits for the writer to start a job before giving up
+# on it, and how often it then checks that the writer is still alive (seconds)
+SUBMIT_TIMEOUT = 60.0
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+# Per-statement counters: executions, retries and seconds spent waiting on locks
+_stats = {}
+_stats_lock = threading.Lock()
+
+def configure_connection(conn):
+    """Apply the concurrency settings shared by readers and writers"""
+    conn.execute('PRAGMA busy_timeout = 5000')
+    return conn
+
+def enable_wal(conn):
+    """Switch a database to write-ahead logging so reads don't block on writes"""
+    return conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+
+def record_statement(sql, retries, lock_wait):
+    """Add one execution to the per-statement counters"""
+    shape = query_stats.statement_shape(sql)
+    with _stats_lock:
+        stats = _stats.setdefault(shape, {"executions": 0, "retries": 0, "lock_wait_seconds": 0.0})
+        stats["executions"] += 1
+        stats["retries"] += retries
+        stats["lock_wait_seconds"] += lock_wait
+
+def get_write_stats():
+    """Get a copy of the per-statement lock wait and retry counters"""
+    with _stats_lock:
+        return {shape: dict(stats) for shape, stats in _stats.items()}
+
+def is_busy_error(error):
+    """Check whether a database error is a transient lock conflict"""
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+def run_with_retry(sql, operation):
+    """Run a statement, retrying lock conflicts with backoff and counting them"""
+    retries = 0
+    lock_wait = 0.0
+    deadline = time.time() + WRITE_TIMEOUT
+
+    while True:
+        started = time.time()
+        try:
+            result = operation()
+            record_statement(sql, retries, lock_wait)
+            return result
+        except sqlite3.OperationalError as e:
+            lock_wait += time.time() - started
+            if not is_busy_error(e) or time.time() >= deadline:
+                record_statement(sql, retries, lock_wait)
+                raise
+
+            delay = min(RETRY_BASE_DELAY * (2 ** retries), RETRY_MAX_DELAY)
+            time.sleep(delay)
+            lock_wait += delay
+            retries += 1
+
+class WriteConnection:
+    """Connection handed to write jobs; statements retry on lock conflicts"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=()):
+        return run_with_retry(sql, lambda: self.conn.execute(sql, params))
+
+    def executemany(self, sql, seq_of_params):
+        return run_with_retry(sql, lambda: self.conn.executemany(sql, seq_of_params))
+
+class Writer:
+    """A single writer thread for one database file, committing jobs in batches"""
+
+    def __init__(self, db_path, setup=None):
+        self.db_path = db_path
+        self.setup = setup
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name=f"db-writer-{db_path}", daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        conn = query_stats.connect(self.db_path, timeout=LOCK_POLL, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA synchronous = NORMAL')
+        if self.setup:
+            self.setup(conn)
+        return conn
+
+    def next_batch(self):
+        batch = [self.jobs.get()]
+        deadline = time.time() + GROUP_COMMIT_WINDOW
+
+        while len(batch) < MAX_BATCH:
+            try:
+                batch.append(self.jobs.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        conn = None
+
+        while True:
+            # Jobs whose submitter gave up waiting were cancelled and are dropped
+            batch = [item for item in self.next_batch() if item[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                if conn is None:
+                    conn = self.connect()
+                self.write_batch(conn, batch)
+            except Exception as e:
+                # The transaction could not be finished or undone, e.g. SQLite already
+                # rolled it back after SQLITE_FULL. Every job still waiting fails, and
+                # the next batch starts on a new connection.
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                conn = self.discard(conn)
+
+    def write_batch(self, conn, batch):
+        """Run a batch of jobs in one transaction and resolve their futures"""
+        writer = WriteConnection(conn)
+        try:
+            writer.execute('BEGIN IMMEDIATE')
+        except Exception as e:
+            for job, context, future in batch:
+                future.set_exception(e)
+            return
+
+        # Each job runs in its own savepoint so one failure doesn't undo the others
+        results = []
+        for job, context, future in batch:
+            try:
+                conn.execute('SAVEPOINT job')
+                # Run in the submitter's context so its correlation id reaches the logs
+                result = context.run(job, writer)
+                conn.execute('RELEASE job')
+                results.append((future, result))
+            except Exception as e:
+                future.set_exception(e)
+                # Raises when the transaction is already gone, failing the rest of the batch
+                conn.execute('ROLLBACK TO job')
+                conn.execute('RELEASE job')
+
+        try:
+            writer.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for future, _ in results:
+                future.set_exception(e)
+            return
+
+        for future, result in results:
+            future.set_result(result)
+
+    def discard(self, conn):
+        """Close a connection left in an unknown state; the next batch opens a new one"""
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        return None
+
+    def submit(self, job):
+        future = concurrent.futures.Future()
+        self.jobs.put((job, contextvars.copy_context(), future))
+        return future
+
+def get_writer(db_path, setup=None):
+    """
+    Get the writer thread for a database file, starting it on first use or
+    again if it has died.
+    setup(conn) is called on the writer's connection, e.g. to register SQL functions.
+    """
+    with _writers_lock:
+        writer = _writers.get(db_path)
+        if writer is None or not writer.thread.is_alive():
+            writer = _writers[db_path] = Writer(db_path, setup)
+        return writer
+
+def submit_write(db_path, job, setup=None):
+    """
+    Run job(conn) on the database's single writer thread and wait for its
+    transaction to commit. Returns the job's result or raises its error.
+    Raises TimeoutError if the writer has not started the job within
+    SUBMIT_TIMEOUT, in which case the job never runs.
+    """
+    writer = get_writer(db_path, setup)
+    future = writer.submit(job)
+    while True:
+        try:
+            return future.result(timeout=SUBMIT_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            if future.cancel():
+                raise TimeoutError(f"Writer for {db_path} did not start the job within {SUBMIT_TIMEOUT} seconds")
+            # The job is running; keep waiting unless the thread running it is gone
+            if not writer.thread.is_alive():
+                raise RuntimeError(f"Writer for {db_path} stopped while running the job")
@@ -0,0 +1,168 @@
+import atexit
+import contextvars
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+
+# Default level, and per-module overrides such as "auth=WARNING,db=DEBUG"
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')
+
+# Each distinct message is logged at most LOG_RATE_LIMIT times per
+# LOG_RATE_WINDOW seconds; the rest are counted and reported with the next
+# one let through. 0 disables the limit.
+LOG_RATE_LIMIT = int(os.environ.get('LOG_RATE_LIMIT', '20'))
+LOG_RATE_WINDOW = float(os.environ.get('LOG_RATE_WINDOW', '60'))
+
+# HTTP header carrying the correlation id between services
+CORRELATION_HEADER = 'X-Correlation-ID'
+
+_correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+_configured = False
+_configure_lock = threading.Lock()
+
+# Attributes every LogRecord has; anything else was passed through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'correlation_id'}
+
+def new_correlation_id():
+    """Generate a fresh correlation id"""
+    return uuid.uuid4().hex[:16]
+
+def get_correlation_id():
+    """Get the correlation id of the current request, if any"""
+    return _correlation_id.get()
+
+def set_correlation_id(value=None):
+    """Set the correlation id for the current context, generating one when value is None"""
+    value = value or new_correlation_id()
+    _correlation_id.set(value)
+    return value
+
+class CorrelationFilter(logging.Filter):
+    """Stamp records with the correlation id while still on the calling thread"""
+
+    def filter(self, record):
+        record.correlation_id = _correlation_id.get()
+        return True
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let each message template through at most `limit` times per `window`
+    seconds. The number dropped is attached as `suppressed` to the next
+    record let through.
+    """
+
+    def __init__(self, limit=LOG_RATE_LIMIT, window=LOG_RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.lock = threading.Lock()
+        self.windows = {}
+
+    def filter(self, record):
+        if not self.limit:
+            return True
+
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            started, count, suppressed = self.windows.get(key, (now, 0, 0))
+            if now - started >= self.window:
+                started, count = now, 0
+
+            if count >= self.limit:
+                self.windows[key] = (started, count, suppressed + 1)
+                return False
+
+            self.windows[key] = (started, count + 1, 0)
+
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "timestamp": datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if getattr(record, 'correlation_id', None):
+            entry["correlation_id"] = record.correlation_id
+
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that only resolves the message and traceback on the
+    calling thread; JSON formatting and output happen on the listener thread
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def apply_levels(levels=LOG_LEVELS):
+    """Apply per-module levels from a "module=LEVEL,..." string"""
+    for item in levels.split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+def configure():
+    """
+    Route all logging through a queue to a JSON stdout handler on a
+    background thread. Safe to call repeatedly; only the first call
+    installs the handlers.
+    """
+    global _configured
+
+    with _configure_lock:
+        if _configured:
+            return
+
+        log_queue = queue.SimpleQueue()
+        handler = AsyncQueueHandler(log_queue)
+        handler.addFilter(CorrelationFilter())
+        handler.addFilter(RateLimitFilter())
+
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter())
+        listener = logging.handlers.QueueListener(log_queue, output)
+        listener.start()
+        atexit.register(listener.stop)
+
+        root = logging.getLogger()
+        root.handlers = [handler]
+        root.setLevel(LOG_LEVEL)
+        apply_levels()
+
+        _configured = True
+
+def get_logger(name):
+    """Get a logger, configuring structured logging on first use"""
+    configure()
+    return logging.getLogger(name)
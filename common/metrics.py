@@ -0,0 +1,272 @@
+import http.server
+import threading
+import time
+import db_writer
+import logs
+import query_stats
+
+logger = logs.get_logger(__name__)
+
+# Default histogram buckets for latencies (seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape_label(value):
+    """Escape a label value for the text exposition format"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(value):
+    """Format a sample value, spelling infinities the Prometheus way"""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metric:
+    """A named metric family with an optional fixed set of label names"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, dict(zip(self.labelnames, key)), value)
+                    for key, value in self.values.items()]
+
+    def collect(self):
+        return self.name, self.kind, self.documentation, self.samples()
+
+class Counter(Metric):
+    """A value that only goes up, such as a number of requests"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+class Gauge(Metric):
+    """A value that can go up and down, such as a queue depth"""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    """Observations counted into cumulative buckets, with their sum and count"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def time(self, **labels):
+        """Context manager that observes the duration of its block"""
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            states = [(dict(zip(self.labelnames, key)), dict(state, buckets=list(state["buckets"])))
+                      for key, state in self.values.items()]
+
+        result = []
+        for labels, state in states:
+            for bound, count in zip(self.buckets, state["buckets"]):
+                result.append((f"{self.name}_bucket", dict(labels, le=format_value(float(bound))), count))
+            result.append((f"{self.name}_bucket", dict(labels, le='+Inf'), state["count"]))
+            result.append((f"{self.name}_sum", labels, state["sum"]))
+            result.append((f"{self.name}_count", labels, state["count"]))
+        return result
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+class Registry:
+    """
+    The metrics of one process. Collectors are functions called at scrape
+    time that return (name, kind, documentation, samples) families, for
+    values that already live elsewhere.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.collectors = {}
+
+    def get_or_create(self, cls, name, documentation, labelnames=(), **kwargs):
+        # Streamlit re-runs page scripts, so registering twice returns the existing metric
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            return self.metrics[name]
+
+    def register_collector(self, name, collector):
+        with self.lock:
+            self.collectors[name] = collector
+
+    def collect(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+            collectors = list(self.collectors.values())
+
+        families = [metric.collect() for metric in metrics]
+        for collector in collectors:
+            try:
+                families.extend(collector())
+            except Exception as e:
+                logger.error("Metrics collector failed: %s", e)
+        return families
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        lines = []
+        for name, kind, documentation, samples in self.collect():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                if labels:
+                    label_text = ','.join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+                    lines.append(f"{sample_name}{{{label_text}}} {format_value(value)}")
+                else:
+                    lines.append(f"{sample_name} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name, documentation, labelnames=()):
+    """Get or create a counter in the process registry"""
+    return REGISTRY.get_or_create(Counter, name, documentation, labelnames)
+
+def gauge(name, documentation, labelnames=()):
+    """Get or create a gauge in the process registry"""
+    return REGISTRY.get_or_create(Gauge, name, documentation, labelnames)
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Get or create a histogram in the process registry"""
+    return REGISTRY.get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+def register_collector(name, collector):
+    """Add a scrape-time collector to the process registry, replacing one with the same name"""
+    REGISTRY.register_collector(name, collector)
+
+def render():
+    """Render the process registry in the Prometheus text exposition format"""
+    return REGISTRY.render()
+
+def collect_db_metrics():
+    """Expose the query instrumentation and writer lock stats as metric families"""
+    queries = query_stats.get_query_stats()
+    writes = db_writer.get_write_stats()
+
+    duration = []
+    rows = []
+    slow = []
+    for shape, stats in queries.items():
+        labels = {"statement": shape}
+        for bucket in stats["buckets"]:
+            le = '+Inf' if bucket["le"] == '+Inf' else format_value(bucket["le"] / 1000)
+            duration.append(("db_query_duration_seconds_bucket", dict(labels, le=le), bucket["count"]))
+        duration.append(("db_query_duration_seconds_sum", labels, stats["total_ms"] / 1000))
+        duration.append(("db_query_duration_seconds_count", labels, stats["count"]))
+        rows.append(("db_query_rows_total", labels, stats["rows"]))
+        slow.append(("db_slow_queries_total", labels, stats["slow"]))
+
+    retries = [("db_write_retries_total", {"statement": shape}, stats["retries"])
+               for shape, stats in writes.items()]
+    lock_wait = [("db_write_lock_wait_seconds_total", {"statement": shape}, stats["lock_wait_seconds"])
+                 for shape, stats in writes.items()]
+
+    return [
+        ("db_query_duration_seconds", "histogram", "Time spent executing and fetching each statement", duration),
+        ("db_query_rows_total", "counter", "Rows returned or changed by each statement", rows),
+        ("db_slow_queries_total", "counter", "Executions slower than the slow query threshold", slow),
+        ("db_write_retries_total", "counter", "Retries of write statements after lock conflicts", retries),
+        ("db_write_lock_wait_seconds_total", "counter", "Time write statements spent waiting on locks", lock_wait)
+    ]
+
+register_collector('db', collect_db_metrics)
+gauge('process_start_time_seconds', 'Start time of the process since the Unix epoch').set(time.time())
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent; keep them out of the service log
+        pass
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+def serve(port):
+    """
+    Serve /metrics on a background thread, for processes without their own
+    HTTP server. Only one server is started per port.
+    """
+    with _servers_lock:
+        if port not in _servers:
+            server = http.server.ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+            thread = threading.Thread(target=server.serve_forever, name=f"metrics-{port}", daemon=True)
+            thread.start()
+            _servers[port] = server
+            logger.info("Serving metrics", extra={"port": port})
+        return _servers[port]
@@ -0,0 +1,219 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+import logs
+
+# Statements slower than this (milliseconds) are logged with their query plan
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+
+# Upper bounds of the latency histogram buckets (milliseconds)
+LATENCY_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Only these statements have a query plan worth logging
+PLANNED_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+logger = logs.get_logger(__name__)
+
+_stats = {}
+_plans = {}
+_stats_lock = threading.Lock()
+
+def statement_shape(sql):
+    """
+    Normalise a statement so executions with different parameters share a
+    stats key: whitespace is collapsed and placeholder lists are folded
+    """
+    shape = re.sub(r'\s+', ' ', sql).strip()
+    return re.sub(r'\?(?:\s*,\s*\?)+', '?, ...', shape)
+
+def record_query(sql, elapsed_ms, rows):
+    """Add one execution to the per-statement latency histogram and row count"""
+    shape = statement_shape(sql)
+    with _stats_lock:
+        stats = _stats.get(shape)
+        if stats is None:
+            stats = _stats[shape] = {
+                "count": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "rows": 0,
+                "slow": 0,
+                "buckets": [0] * (len(LATENCY_BUCKETS) + 1)
+            }
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        stats["rows"] += max(rows, 0)
+        if elapsed_ms > SLOW_QUERY_MS:
+            stats["slow"] += 1
+
+        bucket = len(LATENCY_BUCKETS)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed_ms <= bound:
+                bucket = i
+                break
+        stats["buckets"][bucket] += 1
+
+def get_query_stats():
+    """
+    Get the per-statement aggregates: count, total/max/avg latency, rows and
+    slow executions, with the histogram as cumulative {"le": bound, "count": n}
+    buckets ending at "+Inf"
+    """
+    with _stats_lock:
+        snapshot = {shape: dict(stats, buckets=list(stats["buckets"]))
+                    for shape, stats in _stats.items()}
+
+    result = {}
+    for shape, stats in snapshot.items():
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), stats["buckets"]):
+            cumulative += count
+            buckets.append({"le": bound, "count": cumulative})
+
+        result[shape] = {
+            "count": stats["count"],
+            "total_ms": stats["total_ms"],
+            "avg_ms": stats["total_ms"] / stats["count"],
+            "max_ms": stats["max_ms"],
+            "rows": stats["rows"],
+            "slow": stats["slow"],
+            "buckets": buckets
+        }
+    return result
+
+def sqlite_plan(conn, sql, parameters):
+    """The EXPLAIN QUERY PLAN lines of a statement on an SQLite connection"""
+    try:
+        cursor = sqlite3.Cursor(conn)
+        plan = [row[3] for row in cursor.execute(f'EXPLAIN QUERY PLAN {sql}', parameters)]
+        cursor.close()
+        return plan
+    except sqlite3.Error as e:
+        return [f"(plan unavailable: {e})"]
+
+def log_slow_query(conn, sql, parameters, elapsed_ms, rows, explain=sqlite_plan):
+    """
+    Log a slow statement with its query plan, cached per statement shape.
+    explain(conn, sql, parameters) returns the plan's lines.
+    """
+    shape = statement_shape(sql)
+
+    plan = _plans.get(shape)
+    if plan is None and parameters is not None and shape.upper().startswith(PLANNED_STATEMENTS):
+        plan = _plans[shape] = explain(conn, sql, parameters)
+
+    logger.warning("Slow query", extra={
+        "statement": shape,
+        "elapsed_ms": round(elapsed_ms, 3),
+        "rows": rows,
+        "plan": plan or []
+    })
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor that times each statement. Statements returning rows are timed
+    up to their first fetch (or the end of iteration) so the row count and
+    the cost of stepping through the results are included.
+    """
+
+    def __init__(self, conn):
+        super().__init__(conn)
+        self._pending = None
+
+    def _finish(self, extra_ms=0.0, rows=0):
+        sql, parameters, elapsed_ms, fetched = self._pending
+        self._pending = None
+        elapsed_ms += extra_ms
+        rows += fetched
+
+        record_query(sql, elapsed_ms, rows)
+        if elapsed_ms > SLOW_QUERY_MS:
+            log_slow_query(self.connection, sql, parameters, elapsed_ms, rows)
+
+    def execute(self, sql, parameters=()):
+        if self._pending:
+            self._finish()
+
+        started = time.perf_counter()
+        super().execute(sql, parameters)
+        self._pending = (sql, parameters, (time.perf_counter() - started) * 1000, 0)
+
+        # Statements without a result set are complete once executed
+        if self.description is None:
+            self._finish(rows=self.rowcount)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        if self._pending:
+            self._finish()
+
+        started = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        # No single parameter set to plan with
+        self._pending = (sql, None, (time.perf_counter() - started) * 1000, 0)
+        self._finish(rows=self.rowcount)
+        return self
+
+    def _timed_fetch(self, fetch):
+        started = time.perf_counter()
+        result = fetch()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        return result, elapsed_ms
+
+    def fetchone(self):
+        row, elapsed_ms = self._timed_fetch(super().fetchone)
+        if self._pending:
+            self._finish(elapsed_ms, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows, elapsed_ms = self._timed_fetch(lambda: super(InstrumentedCursor, self).fetchmany(size))
+        if self._pending:
+            self._finish(elapsed_ms, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows, elapsed_ms = self._timed_fetch(super().fetchall)
+        if self._pending:
+            self._finish(elapsed_ms, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            if self._pending:
+                self._finish((time.perf_counter() - started) * 1000)
+            raise
+
+        if self._pending:
+            sql, parameters, elapsed_ms, fetched = self._pending
+            self._pending = (sql, parameters, elapsed_ms + (time.perf_counter() - started) * 1000, fetched + 1)
+        return row
+
+    def close(self):
+        if self._pending:
+            self._finish()
+        super().close()
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors record per-statement latency and row counts"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def connect(database, **kwargs):
+    """Open an instrumented SQLite connection"""
+    return sqlite3.connect(database, factory=InstrumentedConnection, **kwargs)
@@ -0,0 +1,398 @@
+import datetime
+import functools
+import itertools
+import os
+import re
+import sqlite3
+import threading
+import time
+import logs
+import query_stats
+
+try:
+    import psycopg
+    import psycopg_pool
+except ImportError:
+    psycopg = None
+    psycopg_pool = None
+
+logger = logs.get_logger(__name__)
+
+# Where the tables live: "sqlite" (local database files, the default) or
+# "postgres" (the server at DATABASE_URL). PostgreSQL needs the psycopg and
+# psycopg_pool packages, and takes concurrent writers without a writer thread.
+DB_BACKEND = os.environ.get('DB_BACKEND', 'sqlite')
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+
+# Connections each process keeps open to the PostgreSQL server
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+
+# Rows fetched per round trip by stream(), from a server-side cursor on PostgreSQL
+DB_FETCH_SIZE = int(os.environ.get('DB_FETCH_SIZE', '2000'))
+
+# PostgreSQL write transactions that conflict with a concurrent one are
+# retried from the start with backoff, for up to WRITE_TIMEOUT (seconds)
+RETRY_BASE_DELAY = 0.01
+RETRY_MAX_DELAY = 0.5
+WRITE_TIMEOUT = 10.0
+
+# Constraint violations raised by either backend
+INTEGRITY_ERRORS = (sqlite3.IntegrityError,) + ((psycopg.IntegrityError,) if psycopg else ())
+
+# String literals, quoted identifiers and comments are copied as they are;
+# ? and :name placeholders outside them are rewritten
+_SQL_TOKENS = re.compile(r"""
+    (?P<quoted>'(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*)
+  | (?P<positional>\?)
+  | (?<![:\w]):(?P<named>[A-Za-z_]\w*)
+  | (?P<percent>%)
+""", re.VERBOSE)
+
+_pool = None
+_pool_lock = threading.Lock()
+_cursor_ids = itertools.count(1)
+
+@functools.lru_cache(maxsize=1024)
+def postgres_sql(sql):
+    """Rewrite a statement written with sqlite3's ? and :name placeholders into psycopg's %s and %(name)s"""
+    def replace(match):
+        if match.group('quoted'):
+            # psycopg reads % as a placeholder even inside literals
+            return match.group('quoted').replace('%', '%%')
+        if match.group('positional'):
+            return '%s'
+        if match.group('named'):
+            return f"%({match.group('named')})s"
+        return '%%'
+
+    return _SQL_TOKENS.sub(replace, sql)
+
+def upsert(table, columns, key, update=None, select=None):
+    """
+    Build an INSERT that updates the row already holding the same key instead
+    of failing, in the ON CONFLICT form both backends understand.
+    update maps columns to their new value expressions (the existing row is
+    the table name, the new one "excluded"); by default every column outside
+    the key takes the inserted value, and an empty update keeps the existing
+    row. The values are ? placeholders, or the rows of a select query.
+    """
+    if update is None:
+        update = {column: f'excluded.{column}' for column in columns if column not in key}
+
+    if select is None:
+        source = f"VALUES ({', '.join(['?'] * len(columns))})"
+    else:
+        # WHERE true stops SQLite reading ON CONFLICT as a join constraint
+        source = f'SELECT * FROM ({select}) AS source WHERE true'
+
+    if update:
+        assignments = ', '.join(f'{column} = {value}' for column, value in update.items())
+        action = f"({', '.join(key)}) DO UPDATE SET {assignments}"
+    else:
+        action = 'DO NOTHING'
+    return f"INSERT INTO {table} ({', '.join(columns)}) {source} ON CONFLICT {action}"
+
+def json_value(column, key):
+    """SQL expression for a number stored under a key of a JSON object column"""
+    if DB_BACKEND == 'postgres':
+        return f"CAST(CAST({column} AS json) ->> '{key}' AS NUMERIC)"
+    return f"json_extract({column}, '$.{key}')"
+
+def json_each(expression):
+    """SQL table of the key and value columns of a JSON object"""
+    if DB_BACKEND == 'postgres':
+        return f'json_each_text(CAST({expression} AS json))'
+    return f'json_each({expression})'
+
+def seconds_between(end, start):
+    """SQL expression for the seconds between two ISO timestamp columns"""
+    if DB_BACKEND == 'postgres':
+        return f'EXTRACT(EPOCH FROM CAST({end} AS timestamp) - CAST({start} AS timestamp))'
+    return f'(julianday({end}) - julianday({start})) * 86400'
+
+def lock(conn, name):
+    """
+    Hold a named lock until the end of the write transaction. Only needed on
+    PostgreSQL; SQLite writes already run one at a time.
+    """
+    if DB_BACKEND == 'postgres':
+        conn.execute('SELECT pg_advisory_xact_lock(hashtext(?))', (name,))
+
+def begin_read(conn):
+    """Start a transaction whose reads all see the same data; end it with conn.commit()"""
+    if isinstance(conn, PostgresConnection):
+        conn.begin(psycopg.IsolationLevel.REPEATABLE_READ)
+    else:
+        conn.execute('BEGIN')
+
+def stream(conn, sql, parameters=(), size=None):
+    """
+    Iterate over a query's rows, fetching size rows per round trip. On
+    PostgreSQL the rows come from a server-side cursor, so a large result is
+    never held in memory all at once.
+    """
+    size = size or DB_FETCH_SIZE
+    if isinstance(conn, PostgresConnection):
+        yield from conn.stream(sql, parameters, size)
+        return
+
+    cursor = conn.execute(sql, parameters)
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield from rows
+
+class Row(tuple):
+    """A PostgreSQL result row, readable by position or by case-insensitive column name like sqlite3.Row"""
+
+    def __new__(cls, values, names, index):
+        row = super().__new__(cls, values)
+        row._names = names
+        row._index = index
+        return row
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                key = self._index[key.lower()]
+            except KeyError:
+                raise IndexError("No item with that key") from None
+        return super().__getitem__(key)
+
+    def keys(self):
+        return list(self._names)
+
+def row_factory(cursor):
+    names = tuple(column.name for column in cursor.description or ())
+    # The first of several columns with the same name wins, as in sqlite3
+    index = {name.lower(): i for i, name in reversed(list(enumerate(names)))}
+    return lambda values: Row(values, names, index)
+
+if psycopg is not None:
+    class NumericLoader(psycopg.adapt.Loader):
+        """Load NUMERIC values as the int or float sqlite3 would return, not Decimal"""
+
+        def load(self, data):
+            text = bytes(data)
+            try:
+                return int(text)
+            except ValueError:
+                return float(text)
+
+    class IsoDumper(psycopg.adapt.Dumper):
+        """Send dates and times as ISO text, the way sqlite3 stores them"""
+
+        oid = psycopg.postgres.types['text'].oid
+
+        def dump(self, obj):
+            text = obj.isoformat(' ') if isinstance(obj, datetime.datetime) else obj.isoformat()
+            return text.encode('utf-8')
+
+    class BoolDumper(psycopg.adapt.Dumper):
+        """Send booleans as the 1 and 0 flag columns hold"""
+
+        oid = psycopg.postgres.types['int4'].oid
+
+        def dump(self, obj):
+            return b'1' if obj else b'0'
+
+def configure_postgres(pg):
+    """Give a new pooled connection sqlite3's value types"""
+    pg.adapters.register_loader('numeric', NumericLoader)
+    pg.adapters.register_dumper(datetime.date, IsoDumper)
+    pg.adapters.register_dumper(datetime.datetime, IsoDumper)
+    pg.adapters.register_dumper(bool, BoolDumper)
+
+def get_pool():
+    """Get the PostgreSQL connection pool, opening it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if psycopg is None or psycopg_pool is None:
+                    raise RuntimeError("psycopg and psycopg_pool are required for DB_BACKEND=postgres")
+                _pool = psycopg_pool.ConnectionPool(
+                    DATABASE_URL, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX,
+                    configure=configure_postgres, name='db', open=True
+                )
+    return _pool
+
+def connect():
+    """Borrow a connection from the PostgreSQL pool; closing it hands it back"""
+    pool = get_pool()
+    return PostgresConnection(pool, pool.getconn())
+
+def run_transaction(job, setup=None):
+    """
+    Run job(conn) in a serializable PostgreSQL transaction and commit it.
+    A transaction that conflicts with a concurrent one is rolled back and run
+    again, calling setup(conn) first each time. Returns the job's result or
+    raises its error.
+    """
+    retries = 0
+    deadline = time.time() + WRITE_TIMEOUT
+
+    while True:
+        conn = connect()
+        try:
+            conn.begin(psycopg.IsolationLevel.SERIALIZABLE)
+            if setup:
+                setup(conn)
+            result = job(conn)
+            conn.commit()
+            return result
+        except (psycopg.errors.SerializationFailure, psycopg.errors.DeadlockDetected) as e:
+            if time.time() >= deadline:
+                raise
+            logger.debug("Retrying conflicting write transaction: %s", e)
+        finally:
+            conn.close()
+
+        time.sleep(min(RETRY_BASE_DELAY * (2 ** retries), RETRY_MAX_DELAY))
+        retries += 1
+
+class PostgresCursor:
+    """
+    A psycopg cursor taking sqlite3-style statements, whose executions are
+    recorded by query_stats
+    """
+
+    def __init__(self, conn):
+        self.connection = conn
+        self.cursor = conn.pg.cursor(row_factory=row_factory)
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def _record(self, sql, parameters, started):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        rows = self.cursor.rowcount
+        query_stats.record_query(sql, elapsed_ms, rows)
+        if elapsed_ms > query_stats.SLOW_QUERY_MS:
+            query_stats.log_slow_query(self.connection, sql, parameters, elapsed_ms, rows,
+                                       explain=postgres_plan)
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        self.cursor.execute(postgres_sql(sql), parameters)
+        self._record(sql, parameters, started)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        self.cursor.executemany(postgres_sql(sql), seq_of_parameters)
+        # No single parameter set to plan with
+        self._record(sql, None, started)
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self.cursor.fetchmany(size or self.cursor.arraysize)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        self.cursor.close()
+
+class PostgresConnection:
+    """
+    A pooled psycopg connection with the parts of the sqlite3 connection API
+    the services use. Rows can always be read by name or position, so
+    row_factory is accepted and ignored. close() hands it back to the pool.
+    """
+
+    row_factory = None
+
+    def __init__(self, pool, pg):
+        self.pool = pool
+        self.pg = pg
+
+    def begin(self, isolation_level):
+        """Start the next transaction at an isolation level; close() restores the default"""
+        self.pg.rollback()
+        self.pg.isolation_level = isolation_level
+
+    def cursor(self):
+        return PostgresCursor(self)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, script):
+        # Without parameters psycopg sends the script as it is, several statements at once
+        self.pg.execute(script)
+
+    def stream(self, sql, parameters, size):
+        started = time.perf_counter()
+        rows = 0
+        with self.pg.cursor(name=f'stream_{next(_cursor_ids)}', row_factory=row_factory) as cursor:
+            cursor.itersize = size
+            cursor.execute(postgres_sql(sql), parameters)
+            for row in cursor:
+                rows += 1
+                yield row
+        query_stats.record_query(sql, (time.perf_counter() - started) * 1000, rows)
+
+    def commit(self):
+        self.pg.commit()
+
+    def rollback(self):
+        self.pg.rollback()
+
+    def close(self):
+        if self.pg is None:
+            return
+        try:
+            self.pg.rollback()
+            self.pg.isolation_level = None
+        finally:
+            # The pool replaces a connection that broke
+            self.pool.putconn(self.pg)
+            self.pg = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+def postgres_plan(conn, sql, parameters):
+    """The EXPLAIN lines of a statement on a PostgreSQL connection"""
+    try:
+        # In a savepoint, so a failed EXPLAIN leaves the caller's transaction usable
+        with conn.pg.transaction():
+            rows = conn.pg.execute(f'EXPLAIN {postgres_sql(sql)}', parameters).fetchall()
+        return [row[0] for row in rows]
+    except psycopg.Error as e:
+        return [f"(plan unavailable: {e})"]
+
+def data_version():
+    """
+    A value that changes whenever a transaction commits anywhere on the
+    PostgreSQL server: its write-ahead log position
+    """
+    conn = connect()
+    try:
+        return conn.execute('SELECT pg_current_wal_lsn()').fetchone()[0]
+    finally:
+        conn.close()
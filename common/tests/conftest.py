@@ -0,0 +1,52 @@
+import os
+import sqlite3
+import sys
+import pytest
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import storage
+
+# A PostgreSQL database the tests may create and drop tables in; without it
+# only the SQLite cases run
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL', '')
+
+@pytest.fixture
+def postgres(monkeypatch):
+    """Point the storage layer at the test PostgreSQL database for one test"""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    if storage.psycopg is None:
+        pytest.skip("psycopg is not installed")
+
+    monkeypatch.setattr(storage, 'DB_BACKEND', 'postgres')
+    monkeypatch.setattr(storage, 'DATABASE_URL', TEST_DATABASE_URL)
+    monkeypatch.setattr(storage, '_pool', None)
+    yield
+    if storage._pool is not None:
+        storage._pool.close()
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def conn(request, monkeypatch):
+    """A connection to an empty Totals table, on each backend"""
+    if request.param == 'postgres':
+        request.getfixturevalue('postgres')
+        conn = storage.connect()
+    else:
+        monkeypatch.setattr(storage, 'DB_BACKEND', 'sqlite')
+        conn = sqlite3.connect(':memory:')
+        conn.row_factory = sqlite3.Row
+
+    conn.execute('DROP TABLE IF EXISTS Totals')
+    conn.execute('''
+        CREATE TABLE Totals (
+            name TEXT PRIMARY KEY,
+            amount INTEGER NOT NULL,
+            updates INTEGER NOT NULL DEFAULT 0,
+            data TEXT
+        )
+    ''')
+    conn.commit()
+    yield conn
+    conn.close()
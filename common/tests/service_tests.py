@@ -0,0 +1,83 @@
+"""Setup shared by the budgeting and communication test suites"""
+import importlib
+import os
+import sys
+import tempfile
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+SERVICES = ('budgeting_service', 'communication_service')
+
+# Tests run on SQLite files in a temporary directory, or on the PostgreSQL
+# database at TEST_DATABASE_URL. There each service gets a schema named after
+# it, which its suite empties first, so one suite never touches the other's tables.
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL', '')
+
+def schema_url(service):
+    """The test database's connection string with the service's schema as its search path"""
+    from psycopg.conninfo import make_conninfo
+    return make_conninfo(TEST_DATABASE_URL, options=f'-c search_path={service}')
+
+def reset_schema(service):
+    """Drop the service's schema with everything in it and create it empty"""
+    import psycopg
+    with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as conn:
+        conn.execute(f'DROP SCHEMA IF EXISTS {service} CASCADE')
+        conn.execute(f'CREATE SCHEMA {service}')
+
+def load_service(service):
+    """
+    Choose the settings for a service's tests and import its db and storage
+    modules. Settings are read when the app modules are imported, so this runs
+    before any of them are.
+    """
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ['DATA_DIR'] = tempfile.mkdtemp(prefix=f"{service.split('_')[0]}-tests-")
+    if TEST_DATABASE_URL:
+        os.environ['DB_BACKEND'] = 'postgres'
+        os.environ['DATABASE_URL'] = schema_url(service)
+        reset_schema(service)
+
+    # Both services name their modules db, api and so on. When both suites run in
+    # one process, the other service's modules are dropped so the tests import this one's.
+    app_dir = os.path.join(ROOT, service, 'app')
+    other_app_dirs = {os.path.join(ROOT, other, 'app') for other in SERVICES} - {app_dir}
+    for name, module in list(sys.modules.items()):
+        if os.path.dirname(getattr(module, '__file__', None) or '') in other_app_dirs:
+            del sys.modules[name]
+    sys.path[:] = [path for path in sys.path if path not in other_app_dirs]
+
+    sys.path.insert(0, os.path.join(ROOT, 'common'))
+    sys.path.insert(0, app_dir)
+    storage = importlib.import_module('storage')
+    if TEST_DATABASE_URL:
+        # db creates its tables on import, through storage as the first suite left it
+        use_schema(storage, schema_url(service))
+    return importlib.import_module('db'), storage
+
+def use_schema(storage, url):
+    """Point the shared storage module, which both suites import once, at a service's schema"""
+    if storage.DATABASE_URL != url:
+        if storage._pool is not None:
+            storage._pool.close()
+        storage._pool = None
+        storage.DATABASE_URL = url
+
+def database_fixtures(service, db, storage):
+    """The fixtures giving a service's tests its database, for its conftest to expose"""
+    url = schema_url(service) if TEST_DATABASE_URL else ''
+
+    @pytest.fixture(scope='session')
+    def database():
+        """Create the tables and sample data once for the whole run"""
+        if storage.DB_BACKEND == 'postgres':
+            use_schema(storage, url)
+        db.init_db()
+
+    @pytest.fixture(autouse=True)
+    def service_database(database):
+        """Keep each test on its own service's schema when both suites run together"""
+        if storage.DB_BACKEND == 'postgres':
+            use_schema(storage, url)
+
+    return database, service_database
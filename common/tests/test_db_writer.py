@@ -0,0 +1,76 @@
+import sqlite3
+import threading
+import pytest
+import db_writer
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'writer.db')
+    conn = sqlite3.connect(path)
+    db_writer.enable_wal(conn)
+    conn.execute('CREATE TABLE Notes (id INTEGER PRIMARY KEY, text TEXT NOT NULL)')
+    conn.commit()
+    conn.close()
+    return path
+
+def note_count(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM Notes').fetchone()[0]
+    finally:
+        conn.close()
+
+def insert_note(text):
+    return lambda conn: conn.execute('INSERT INTO Notes (text) VALUES (?) RETURNING id', (text,)).fetchone()[0]
+
+def test_failed_job_leaves_the_rest_of_the_batch(db_path):
+    writer = db_writer.get_writer(db_path)
+    futures = [writer.submit(insert_note('a')), writer.submit(insert_note(None)), writer.submit(insert_note('c'))]
+
+    assert futures[0].result() and futures[2].result()
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[1].result()
+    assert note_count(db_path) == 2
+
+def test_writer_survives_a_job_that_ends_the_transaction(db_path):
+    def commit_early(conn):
+        insert_note('early')(conn)
+        conn.execute('COMMIT')
+
+    with pytest.raises(sqlite3.OperationalError):
+        db_writer.submit_write(db_path, commit_early)
+    assert db_writer.submit_write(db_path, insert_note('after'))
+    assert note_count(db_path) == 2
+
+def test_writer_survives_a_full_database(db_path):
+    def fill(conn):
+        conn.execute('PRAGMA max_page_count = 3')
+        conn.execute("INSERT INTO Notes (text) VALUES (?)", ('x' * 100000,))
+
+    with pytest.raises(sqlite3.OperationalError):
+        db_writer.submit_write(db_path, fill)
+    db_writer.submit_write(db_path, lambda conn: conn.execute('PRAGMA max_page_count = 1000000'))
+    assert db_writer.submit_write(db_path, insert_note('after'))
+
+def test_submit_write_gives_up_on_a_job_that_never_starts(db_path, monkeypatch):
+    monkeypatch.setattr(db_writer, 'SUBMIT_TIMEOUT', 0.1)
+    started, release = threading.Event(), threading.Event()
+    blocking = db_writer.get_writer(db_path).submit(lambda conn: started.set() or release.wait(5))
+    started.wait(5)
+
+    with pytest.raises(TimeoutError):
+        db_writer.submit_write(db_path, insert_note('never'))
+    release.set()
+    blocking.result()
+    assert db_writer.submit_write(db_path, insert_note('later'))
+    assert note_count(db_path) == 1
+
+def test_get_writer_replaces_a_dead_writer(db_path):
+    writer = db_writer.get_writer(db_path)
+    writer.thread = threading.Thread(target=lambda: None)
+    writer.thread.start()
+    writer.thread.join()
+
+    assert db_writer.get_writer(db_path) is not writer
+    assert db_writer.submit_write(db_path, insert_note('again'))
@@ -0,0 +1,113 @@
+import pytest
+import storage
+
+
+def test_postgres_sql_rewrites_placeholders():
+    assert storage.postgres_sql('SELECT * FROM t WHERE a = ? AND b = ?') == 'SELECT * FROM t WHERE a = %s AND b = %s'
+    assert storage.postgres_sql('SELECT * FROM t WHERE a = :a AND b > :b_2') == \
+        'SELECT * FROM t WHERE a = %(a)s AND b > %(b_2)s'
+
+def test_postgres_sql_leaves_literals_comments_and_casts():
+    sql = '''SELECT 'a ? :b', "col?", x::text -- why ? :c
+    FROM t WHERE y = ?'''
+    assert storage.postgres_sql(sql) == '''SELECT 'a ? :b', "col?", x::text -- why ? :c
+    FROM t WHERE y = %s'''
+
+def test_postgres_sql_escapes_percent():
+    assert storage.postgres_sql("SELECT '50%', a % 2 FROM t WHERE b LIKE ?") == \
+        "SELECT '50%%', a %% 2 FROM t WHERE b LIKE %s"
+
+def test_upsert_sql():
+    assert storage.upsert('Totals', ('name', 'amount'), ('name',)) == \
+        'INSERT INTO Totals (name, amount) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET amount = excluded.amount'
+    assert storage.upsert('Totals', ('name', 'amount'), ('name',), update={}) == \
+        'INSERT INTO Totals (name, amount) VALUES (?, ?) ON CONFLICT DO NOTHING'
+    assert storage.upsert('Totals', ('name', 'amount'), ('name',), select='SELECT ?, ?') == (
+        'INSERT INTO Totals (name, amount) SELECT * FROM (SELECT ?, ?) AS source WHERE true '
+        'ON CONFLICT (name) DO UPDATE SET amount = excluded.amount'
+    )
+
+def test_upsert_inserts_then_updates(conn):
+    sql = storage.upsert('Totals', ('name', 'amount'), ('name',),
+                         update={'amount': 'Totals.amount + excluded.amount', 'updates': 'Totals.updates + 1'})
+    conn.execute(sql, ('travel', 10))
+    conn.execute(sql, ('travel', 5))
+    conn.execute(sql, ('books', 3))
+    rows = conn.execute('SELECT name, amount, updates FROM Totals ORDER BY name').fetchall()
+    assert [tuple(row) for row in rows] == [('books', 3, 0), ('travel', 15, 1)]
+
+def test_upsert_without_update_keeps_existing_row(conn):
+    sql = storage.upsert('Totals', ('name', 'amount'), ('name',), update={})
+    conn.execute(sql, ('travel', 10))
+    conn.execute(sql, ('travel', 99))
+    assert conn.execute('SELECT amount FROM Totals').fetchone()['amount'] == 10
+
+def test_upsert_from_select(conn):
+    conn.execute('INSERT INTO Totals (name, amount) VALUES (?, ?)', ('travel', 1))
+    conn.execute(storage.upsert('Totals', ('name', 'amount'), ('name',), select='''
+        SELECT name || '-copy', amount * 2 FROM Totals
+        UNION ALL
+        SELECT 'travel', 7
+    '''))
+    rows = conn.execute('SELECT name, amount FROM Totals ORDER BY name').fetchall()
+    assert [tuple(row) for row in rows] == [('travel', 7), ('travel-copy', 2)]
+
+def test_json_value_and_each(conn):
+    conn.execute('INSERT INTO Totals (name, amount, data) VALUES (?, ?, ?)', ('travel', 1, '{"a": 2.5, "b": 4}'))
+    row = conn.execute(f"SELECT {storage.json_value('data', 'a')} AS a FROM Totals").fetchone()
+    assert row['a'] == 2.5
+    pairs = conn.execute(f"SELECT key, value FROM Totals, {storage.json_each('data')} ORDER BY key").fetchall()
+    assert [(pair[0], float(pair[1])) for pair in pairs] == [('a', 2.5), ('b', 4.0)]
+
+def test_stream_returns_every_row_in_batches(conn):
+    conn.executemany('INSERT INTO Totals (name, amount) VALUES (?, ?)', [(f'n{i:02d}', i) for i in range(25)])
+    conn.commit()
+    rows = list(storage.stream(conn, 'SELECT amount FROM Totals WHERE amount >= ? ORDER BY amount', (5,), size=4))
+    assert [row['amount'] for row in rows] == list(range(5, 25))
+
+def test_run_transaction_retries_serialization_failures(postgres, monkeypatch):
+    monkeypatch.setattr(storage, 'RETRY_BASE_DELAY', 0)
+    calls = {"setup": 0, "job": 0}
+
+    def setup(conn):
+        calls["setup"] += 1
+
+    def job(conn):
+        calls["job"] += 1
+        if calls["job"] < 3:
+            raise storage.psycopg.errors.SerializationFailure("could not serialize access")
+        return conn.execute('SELECT 42 AS answer').fetchone()['answer']
+
+    assert storage.run_transaction(job, setup=setup) == 42
+    assert calls == {"setup": 3, "job": 3}
+
+def test_run_transaction_gives_up_after_timeout(postgres, monkeypatch):
+    monkeypatch.setattr(storage, 'WRITE_TIMEOUT', 0)
+    calls = []
+
+    def job(conn):
+        calls.append(conn)
+        raise storage.psycopg.errors.DeadlockDetected("deadlock detected")
+
+    with pytest.raises(storage.psycopg.errors.DeadlockDetected):
+        storage.run_transaction(job)
+    assert len(calls) == 1
+
+def test_run_transaction_rolls_back_other_errors(postgres):
+    conn = storage.connect()
+    conn.execute('DROP TABLE IF EXISTS Totals')
+    conn.execute('CREATE TABLE Totals (name TEXT PRIMARY KEY, amount INTEGER NOT NULL)')
+    conn.commit()
+    conn.close()
+
+    def job(conn):
+        conn.execute('INSERT INTO Totals (name, amount) VALUES (?, ?)', ('travel', 1))
+        raise ValueError("no")
+
+    with pytest.raises(ValueError):
+        storage.run_transaction(job)
+    storage.run_transaction(lambda conn: conn.execute('INSERT INTO Totals (name, amount) VALUES (?, ?)', ('books', 2)))
+
+    conn = storage.connect()
+    assert [row['name'] for row in conn.execute('SELECT name FROM Totals').fetchall()] == ['books']
+    conn.close()
@@ -1,13 +1,43 @@
 import streamlit as st
 import pandas as pd
 from datetime import datetime
+import time
 import db
 import auth
+import hierarchy
+import attachments as blob_store
+import outbox
+import metrics
+import logs
 import os
 
 # Set page config
 st.set_page_config(page_title="University Communication System", layout="wide")
 
+# Every script run gets its own correlation id, which is passed on to the
+# budgeting API so both services' logs for one interaction can be joined
+logger = logs.get_logger('app')
+logs.set_correlation_id()
+
+# Queued sends are delivered by background workers in this process
+if db.MESSAGE_DELIVERY == 'outbox':
+    outbox.start_workers()
+
+# Streamlit has no endpoint of its own for metrics, so a small sidecar
+# server in this process serves /metrics for scraping
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9102'))
+try:
+    metrics.serve(METRICS_PORT)
+except OSError as e:
+    logger.warning("Could not serve metrics on port %d: %s", METRICS_PORT, e)
+
+PAGE_RENDER_LATENCY = metrics.histogram(
+    'page_render_seconds', 'Time to render a page of the communication UI', ['page']
+)
+CACHE_REQUESTS = metrics.counter(
+    'cache_requests_total', 'Cache lookups by cache and result', ['cache', 'result']
+)
+
 # Initialize session state variables if they don't exist
 if 'authenticated' not in st.session_state:
     st.session_state.authenticated = False
@@ -25,6 +55,19 @@ if 'selected_message' not in st.session_state:
     st.session_state.selected_message = None
 if 'current_view' not in st.session_state:
     st.session_state.current_view = "inbox"
+if 'search_params' not in st.session_state:
+    st.session_state.search_params = None
+if 'inbox_cache' not in st.session_state:
+    st.session_state.inbox_cache = None
+if 'live_updates' not in st.session_state:
+    st.session_state.live_updates = True
+if 'live_paused' not in st.session_state:
+    st.session_state.live_paused = False
+
+# How often an open inbox checks for new mail, and for how long it keeps
+# checking before it pauses until the user asks to check again
+LIVE_POLL_INTERVAL = 1.0
+LIVE_POLL_TIMEOUT = 30
 
 # Login page
 def login_page():
@@ -59,8 +102,9 @@ def login_page():
                 
                 st.session_state.departments = departments
                 
-                # Build department hierarchy
+                # Build department hierarchy (shared across sessions)
                 st.session_state.department_hierarchy = auth.build_department_hierarchy(departments)
+                db.sync_department_intervals(st.session_state.department_hierarchy)
                 
                 st.success("Logged in successfully!")
                 st.experimental_rerun()
@@ -136,6 +180,7 @@ def compose_message():
         
         subject = st.text_input("Subject")
         message_body = st.text_area("Message", height=200)
+        uploaded_files = st.file_uploader("Attachments", accept_multiple_files=True)
         
         submit = st.form_submit_button("Send Message")
         
@@ -150,8 +195,13 @@ def compose_message():
                 # Get recipient department IDs
                 recipient_dept_ids = [recipient_options[name] for name in selected_recipients]
                 
+                # Attachments are streamed to the shared blob store
+                message_attachments = [(f.name, f, f.type) for f in uploaded_files or []]
+                
                 # Create message
-                success = db.create_message(sender_dept_id, recipient_dept_ids, subject, message_body)
+                success = db.create_message(
+                    sender_dept_id, recipient_dept_ids, subject, message_body, message_attachments
+                )
                 
                 if success:
                     st.success("Message sent successfully!")
@@ -170,6 +220,10 @@ def view_message(message_id):
         st.experimental_rerun()
         return
     
+    # Opening a message from the inbox marks it as read
+    if st.session_state.current_view == "inbox":
+        db.mark_message_read(message_id, st.session_state.department_id, st.session_state.user_id)
+    
     # Display message details
     st.subheader(message['subject'])
     
@@ -197,11 +251,95 @@ def view_message(message_id):
     st.markdown("---")
     st.write(message['body'])
     
+    # Attachments
+    message_attachments = db.get_message_attachments(message_id)
+    if message_attachments:
+        st.markdown("**Attachments:**")
+        for attachment in message_attachments:
+            # Handed over as a file, so the blob is not copied into a bytes object first
+            with blob_store.open_blob(attachment['sha256']) as blob:
+                st.download_button(
+                    f"{attachment['filename']} ({attachment['size']:,} bytes)",
+                    data=blob,
+                    file_name=attachment['filename'],
+                    mime=attachment['content_type'] or "application/octet-stream",
+                    key=f"attachment_{attachment['id']}"
+                )
+    
     # Back button
-    if st.button("Back to " + ("Inbox" if st.session_state.current_view == "inbox" else "Sent Messages")):
+    view_names = {"inbox": "Inbox", "sent": "Sent Messages", "search": "Search"}
+    if st.button("Back to " + view_names.get(st.session_state.current_view, "Inbox")):
         st.session_state.selected_message = None
         st.experimental_rerun()
 
+# Helper function to query the inbox, using the synced interval ranges when the department is indexed
+def fetch_inbox_messages(dept_id, after_id=None):
+    index = st.session_state.department_hierarchy
+    if dept_id in index["tin"]:
+        messages = db.get_inbox_messages(dept_id, after_id=after_id)
+    else:
+        messages = db.get_inbox_messages(dept_id, hierarchy.get_ancestors(index, dept_id), after_id=after_id)
+    return [dict(msg) for msg in messages]
+
+# Helper function to keep the session's inbox current by fetching only messages
+# newer than its high-water mark
+def load_inbox(dept_id):
+    cache = st.session_state.inbox_cache
+    
+    if cache is None or cache["department_id"] != dept_id:
+        CACHE_REQUESTS.inc(cache='inbox', result='miss')
+        sequence = db.get_message_sequence()
+        messages = fetch_inbox_messages(dept_id)
+        
+        # Sends commit in ID order within each shard, so everything up to the newest loaded message is included
+        high_water_mark = db.advance_sequence(sequence, [msg['id'] for msg in messages])
+        st.session_state.inbox_cache = {
+            "department_id": dept_id,
+            "high_water_mark": high_water_mark,
+            "messages": messages
+        }
+        return messages
+    
+    # Topping up with newer messages still reuses the cached ones
+    CACHE_REQUESTS.inc(cache='inbox', result='hit')
+    sequence = db.get_message_sequence()
+    if db.sequence_advanced(sequence, cache["high_water_mark"]):
+        new_messages = fetch_inbox_messages(dept_id, after_id=cache["high_water_mark"])
+        cache["messages"] = new_messages + cache["messages"]
+        # A message committed after the sequence was read is already loaded, so the mark covers it
+        cache["high_water_mark"] = db.advance_sequence(sequence, [msg['id'] for msg in new_messages])
+    
+    return cache["messages"]
+
+def resume_live_updates():
+    st.session_state.live_paused = False
+
+# Helper function to wait for new mail, rerunning as soon as some has arrived.
+# A wait that ends without mail pauses live updates, so an idle inbox stops
+# rerunning the script; the button starts another wait.
+def wait_for_new_messages():
+    if st.session_state.live_paused:
+        st.caption("Live updates paused")
+        st.button("Check for new mail", on_click=resume_live_updates)
+        return
+    
+    status = st.empty()
+    high_water_mark = st.session_state.inbox_cache["high_water_mark"]
+    deadline = time.time() + LIVE_POLL_TIMEOUT
+    
+    while time.time() < deadline:
+        # Updating the placeholder also lets Streamlit stop this loop when
+        # the user interacts or the session closes
+        status.caption(f"Live updates on · checked {datetime.now().strftime('%H:%M:%S')}")
+        
+        if db.sequence_advanced(db.get_message_sequence(), high_water_mark):
+            st.experimental_rerun()
+        time.sleep(LIVE_POLL_INTERVAL)
+    
+    st.session_state.live_paused = True
+    status.caption(f"Live updates paused · no new mail since {datetime.now().strftime('%H:%M:%S')}")
+    st.button("Check for new mail", on_click=resume_live_updates)
+
 # Inbox page
 def inbox_page():
     st.subheader("Inbox")
@@ -209,16 +347,16 @@ def inbox_page():
     # Get user's department
     dept_id = st.session_state.department_id
     
-    # Get parent departments
-    parent_depts = st.session_state.department_hierarchy["all_parents"].get(dept_id, [])
-    
     # Get messages
-    messages = db.get_inbox_messages(dept_id, parent_depts)
+    messages = load_inbox(dept_id)
     
     if not messages:
         st.info("Your inbox is empty.")
         return
     
+    # Messages this user has already opened
+    read_ids = db.get_read_message_ids(dept_id, st.session_state.user_id)
+    
     # Display messages as a table
     data = []
     for msg in messages:
@@ -231,6 +369,7 @@ def inbox_page():
         # Add to data
         data.append({
             "ID": msg['id'],
+            "New": "" if msg['id'] in read_ids else "●",
             "From": sender_name,
             "Subject": msg['subject'],
             "Date": formatted_time,
@@ -245,6 +384,7 @@ def inbox_page():
         df,
         column_config={
             "ID": None,  # Hide ID column
+            "New": st.column_config.TextColumn(""),
             "From": st.column_config.TextColumn("From"),
             "Subject": st.column_config.TextColumn("Subject"),
             "Date": st.column_config.TextColumn("Date"),
@@ -315,6 +455,54 @@ def sent_page():
             st.session_state.selected_message = row['ID']
             st.experimental_rerun()
 
+# Search messages page
+def search_page():
+    st.subheader("Search Messages")
+    
+    with st.form("search_form"):
+        query = st.text_input("Search subject and message text")
+        filter_dates = st.checkbox("Filter by date")
+        col1, col2 = st.columns(2)
+        with col1:
+            start_date = st.date_input("From", value=datetime.now().date().replace(month=1, day=1))
+        with col2:
+            end_date = st.date_input("To", value=datetime.now().date())
+        
+        submit = st.form_submit_button("Search")
+        
+        if submit:
+            st.session_state.search_params = {
+                "query": query,
+                "start_date": start_date if filter_dates else None,
+                "end_date": end_date if filter_dates else None
+            }
+    
+    params = st.session_state.search_params
+    if not params or not params["query"].strip():
+        return
+    
+    # Only search messages visible to the user's department
+    messages = db.search_messages(
+        params["query"],
+        department_id=st.session_state.department_id,
+        start_date=params["start_date"],
+        end_date=params["end_date"]
+    )
+    
+    if not messages:
+        st.info("No messages match your search.")
+        return
+    
+    for msg in messages:
+        timestamp = datetime.fromisoformat(msg['timestamp'])
+        sender_name = get_department_name(msg['sender_department_id'])
+        
+        st.markdown(f"**{msg['subject']}** — {sender_name}, {timestamp.strftime('%Y-%m-%d %H:%M')}")
+        st.markdown(msg['snippet'])
+        if st.button("View", key=f"view_search_{msg['id']}"):
+            st.session_state.selected_message = msg['id']
+            st.experimental_rerun()
+
 # Main application
 def main_app():
     # Sidebar
@@ -324,7 +512,11 @@ def main_app():
     # Navigation
     st.sidebar.markdown("## Navigation")
     
-    if st.sidebar.button("📥 Inbox"):
+    # Unread badge from the maintained counter, without running the inbox query
+    unread = db.get_unread_count(st.session_state.department_id, st.session_state.user_id)
+    inbox_label = f"📥 Inbox ({unread})" if unread else "📥 Inbox"
+    
+    if st.sidebar.button(inbox_label, key="nav_inbox"):
         st.session_state.current_view = "inbox"
         st.session_state.selected_message = None
         st.experimental_rerun()
@@ -334,25 +526,42 @@ def main_app():
         st.session_state.selected_message = None
         st.experimental_rerun()
     
+    if st.sidebar.button("🔍 Search"):
+        st.session_state.current_view = "search"
+        st.session_state.selected_message = None
+        st.experimental_rerun()
+    
     if st.sidebar.button("✏️ Compose New Message"):
         st.session_state.current_view = "compose"
         st.session_state.selected_message = None
         st.experimental_rerun()
     
+    st.session_state.live_updates = st.sidebar.checkbox(
+        "Live inbox updates", value=st.session_state.live_updates
+    )
+    
     # Logout button
     if st.sidebar.button("Logout"):
         logout()
         st.experimental_rerun()
     
     # Main content area
-    if st.session_state.selected_message:
-        view_message(st.session_state.selected_message)
-    elif st.session_state.current_view == "inbox":
-        inbox_page()
-    elif st.session_state.current_view == "sent":
-        sent_page()
-    elif st.session_state.current_view == "compose":
-        compose_message()
+    page = "message" if st.session_state.selected_message else st.session_state.current_view
+    with PAGE_RENDER_LATENCY.time(page=page):
+        if st.session_state.selected_message:
+            view_message(st.session_state.selected_message)
+        elif st.session_state.current_view == "inbox":
+            inbox_page()
+        elif st.session_state.current_view == "sent":
+            sent_page()
+        elif st.session_state.current_view == "search":
+            search_page()
+        elif st.session_state.current_view == "compose":
+            compose_message()
+    
+    # Waiting for new mail happens after the render so it isn't timed with it
+    if page == "inbox" and st.session_state.live_updates:
+        wait_for_new_messages()
 
 # Application entry point
 if st.session_state.authenticated:
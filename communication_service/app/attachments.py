@@ -0,0 +1,83 @@
+import hashlib
+import os
+import tempfile
+import time
+
+# Attachment blobs are stored once on disk, addressed by their SHA-256 digest
+ATTACHMENTS_DIR = os.environ.get(
+    'ATTACHMENTS_DIR',
+    os.path.join(os.environ.get('DATA_DIR', os.path.join(os.path.dirname(__file__), '..', 'data')), 'attachments')
+)
+os.makedirs(ATTACHMENTS_DIR, exist_ok=True)
+
+# Size of the chunks used when streaming blobs in and out
+CHUNK_SIZE = 1024 * 1024
+
+def blob_path(sha256):
+    """Get the on-disk path of a blob, fanned out by the first two hex digits"""
+    return os.path.join(ATTACHMENTS_DIR, sha256[:2], sha256)
+
+def store_blob(fileobj):
+    """
+    Stream a file-like object into the blob store, hashing it as it is
+    written. If a blob with the same content already exists the new copy is
+    discarded and the existing one's modification time refreshed, so a sweep
+    leaves it alone until the message referencing it is written.
+    Returns (sha256, size).
+    """
+    digest = hashlib.sha256()
+    size = 0
+
+    fd, temp_path = tempfile.mkstemp(dir=ATTACHMENTS_DIR, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            while True:
+                chunk = fileobj.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+
+        sha256 = digest.hexdigest()
+        path = blob_path(sha256)
+
+        if os.path.exists(path):
+            os.remove(temp_path)
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return sha256, size
+
+def open_blob(sha256):
+    """Open a blob for reading, so it can be streamed without loading it all first"""
+    return open(blob_path(sha256), 'rb')
+
+def sweep_blobs(referenced, grace_seconds):
+    """
+    Delete blobs whose digest is not in referenced, and unfinished uploads,
+    that have not been touched for grace_seconds. The grace period covers
+    blobs stored for a message that is not written yet.
+    Returns the number of files deleted.
+    """
+    cutoff = time.time() - grace_seconds
+    deleted = 0
+    for directory, _, filenames in os.walk(ATTACHMENTS_DIR):
+        for filename in filenames:
+            if filename in referenced:
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                # Checked again just before deleting, since store_blob touches reused blobs
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    deleted += 1
+            except FileNotFoundError:
+                pass
+    return deleted
@@ -1,11 +1,26 @@
 import os
 import requests
 import json
+import hierarchy
+import metrics
+import logs
 from passlib.hash import pbkdf2_sha256
 
 # Get the budgeting API URL from environment variable or use a default for local development
 BUDGETING_API_URL = os.environ.get('BUDGETING_API_URL', 'http://localhost:5000')
-print(f"Using Budgeting API URL: {BUDGETING_API_URL}")
+
+logger = logs.get_logger(__name__)
+logger.info("Using budgeting API", extra={"api_url": BUDGETING_API_URL})
+
+API_LATENCY = metrics.histogram(
+    'budgeting_api_request_duration_seconds', 'Latency of calls to the budgeting API', ['endpoint']
+)
+AUTH_REQUESTS = metrics.counter(
+    'auth_requests_total', 'Authentication attempts by outcome', ['outcome']
+)
+FALLBACK_ACTIVATIONS = metrics.counter(
+    'fallback_activations_total', 'Times a built-in fallback replaced the budgeting API', ['fallback', 'reason']
+)
 
 # Direct authentication fallback
 # These are the same default users as in the budgeting service
@@ -17,150 +32,120 @@ DEFAULT_USERS = [
 
 def direct_authenticate(username, password):
     """Direct authentication as a fallback when the budgeting API is unavailable"""
-    print(f"Attempting direct authentication for user: {username}")
+    logger.debug("Attempting direct authentication for user %s", username)
     
     for user in DEFAULT_USERS:
         if user["username"] == username and user["password"] == password:
-            print(f"Direct authentication successful for user: {username}")
+            logger.info("Direct authentication successful for user %s", username)
+            AUTH_REQUESTS.inc(outcome='fallback_success')
             return {
                 "user_id": DEFAULT_USERS.index(user) + 1,
                 "username": user["username"],
                 "department_id": user["department_id"]
             }
     
-    print(f"Direct authentication failed for user: {username}")
+    logger.info("Direct authentication failed for user %s", username)
+    AUTH_REQUESTS.inc(outcome='fallback_rejected')
     return None
 
+def api_headers():
+    """Headers for budgeting API calls, carrying the current correlation id"""
+    headers = {"Content-Type": "application/json"}
+    correlation_id = logs.get_correlation_id()
+    if correlation_id:
+        headers[logs.CORRELATION_HEADER] = correlation_id
+    return headers
+
 def authenticate(username, password):
     """Authenticate a user by calling the Budgeting service's API"""
     endpoint = f"{BUDGETING_API_URL}/api/authenticate"
-    print(f"Authenticating user '{username}' against endpoint: {endpoint}")
+    logger.debug("Authenticating user %s against %s", username, endpoint)
     
     try:
-        response = requests.post(
-            endpoint, 
-            json={"username": username, "password": password},
-            headers={"Content-Type": "application/json"},
-            timeout=10  # Add timeout to prevent hanging
-        )
-        
-        print(f"Authentication response status: {response.status_code}")
+        with API_LATENCY.time(endpoint='/api/authenticate'):
+            response = requests.post(
+                endpoint, 
+                json={"username": username, "password": password},
+                headers=api_headers(),
+                timeout=10  # Add timeout to prevent hanging
+            )
         
         if response.status_code == 200:
             data = response.json()
-            print(f"Authentication successful for user: {username}")
+            logger.info("Authentication successful for user %s", username)
+            AUTH_REQUESTS.inc(outcome='success')
             return data
         else:
-            print(f"Authentication failed with status {response.status_code}")
             try:
-                error_data = response.json()
-                print(f"Error details: {error_data}")
+                details = response.json()
             except:
-                print(f"Response text: {response.text}")
+                details = response.text
+            logger.warning("Authentication failed with status %s", response.status_code,
+                           extra={"details": details})
             
             # Try direct authentication as fallback
-            print("Trying direct authentication as fallback...")
+            logger.warning("Trying direct authentication as fallback")
+            FALLBACK_ACTIVATIONS.inc(fallback='direct_auth', reason='status')
             return direct_authenticate(username, password)
         
         return None
     except requests.exceptions.ConnectionError as e:
-        print(f"Connection error when authenticating: {e}")
-        print(f"Could not connect to {endpoint}. Trying direct authentication...")
+        logger.warning("Could not connect to %s, trying direct authentication: %s", endpoint, e)
+        FALLBACK_ACTIVATIONS.inc(fallback='direct_auth', reason='connection')
         return direct_authenticate(username, password)
     except Exception as e:
-        print(f"Authentication error: {e}")
-        print("Trying direct authentication as fallback...")
+        logger.error("Authentication error, trying direct authentication as fallback: %s", e)
+        FALLBACK_ACTIVATIONS.inc(fallback='direct_auth', reason='error')
         return direct_authenticate(username, password)
 
 def get_departments():
     """Get the list of departments from the Budgeting service's API"""
     endpoint = f"{BUDGETING_API_URL}/api/departments"
-    print(f"Fetching departments from: {endpoint}")
+    logger.debug("Fetching departments from %s", endpoint)
     
     try:
-        response = requests.get(endpoint, timeout=10)
-        
-        print(f"Departments response status: {response.status_code}")
+        with API_LATENCY.time(endpoint='/api/departments'):
+            response = requests.get(endpoint, headers=api_headers(), timeout=10)
         
         if response.status_code == 200:
             data = response.json()
-            print(f"Received {len(data)} departments")
+            logger.debug("Received %d departments", len(data))
             return data
         else:
-            print(f"Failed to fetch departments with status {response.status_code}")
             try:
-                error_data = response.json()
-                print(f"Error details: {error_data}")
+                details = response.json()
             except:
-                print(f"Response text: {response.text}")
+                details = response.text
+            logger.warning("Failed to fetch departments with status %s", response.status_code,
+                           extra={"details": details})
             
             # Return default departments as fallback
-            print("Returning default departments as fallback")
+            logger.warning("Returning default departments as fallback")
+            FALLBACK_ACTIVATIONS.inc(fallback='default_departments', reason='status')
             return DEFAULT_DEPARTMENTS
         
         return []
     except requests.exceptions.ConnectionError as e:
-        print(f"Connection error when fetching departments: {e}")
-        print(f"Could not connect to {endpoint}. Returning default departments.")
+        logger.warning("Could not connect to %s, returning default departments: %s", endpoint, e)
+        FALLBACK_ACTIVATIONS.inc(fallback='default_departments', reason='connection')
         return DEFAULT_DEPARTMENTS
     except Exception as e:
-        print(f"Error getting departments: {e}")
-        print("Returning default departments as fallback")
+        logger.error("Error getting departments, returning default departments: %s", e)
+        FALLBACK_ACTIVATIONS.inc(fallback='default_departments', reason='error')
         return DEFAULT_DEPARTMENTS
 
 def build_department_hierarchy(departments):
     """
-    Build a department hierarchy mapping
+    Get the shared department hierarchy index
     Returns:
     - department_names: dict mapping dept_id to name
     - parent_mapping: dict mapping dept_id to parent_id
     - children_mapping: dict mapping parent_id to list of child dept_ids
-    - all_parents: dict mapping dept_id to list of all ancestor dept_ids
+    - tin / tout: Euler-tour interval numbering for ancestor and subtree queries
+    The index is built once per process and shared by all sessions; it is
+    only rebuilt when the department list changes.
     """
-    department_names = {}
-    parent_mapping = {}
-    children_mapping = {}
-    
-    # Build basic mappings
-    for dept in departments:
-        dept_id = dept.get('id')
-        parent_id = dept.get('parent_id')
-        name = dept.get('name')
-        
-        department_names[dept_id] = name
-        parent_mapping[dept_id] = parent_id
-        
-        if parent_id not in children_mapping:
-            children_mapping[parent_id] = []
-        children_mapping[parent_id].append(dept_id)
-    
-    # Build list of all parent ancestors for each department
-    all_parents = {}
-    
-    def get_all_parents(dept_id):
-        if dept_id in all_parents:
-            return all_parents[dept_id]
-        
-        result = []
-        parent_id = parent_mapping.get(dept_id)
-        
-        if parent_id:
-            result.append(parent_id)
-            result.extend(get_all_parents(parent_id))
-        
-        all_parents[dept_id] = result
-        return result
-    
-    # Calculate all parents for each department
-    for dept_id in department_names.keys():
-        all_parents[dept_id] = get_all_parents(dept_id)
-    
-    return {
-        "department_names": department_names,
-        "parent_mapping": parent_mapping,
-        "children_mapping": children_mapping,
-        "all_parents": all_parents
-    }
+    return hierarchy.get_hierarchy_index(departments)
 
 # Default departments when API is not available
 DEFAULT_DEPARTMENTS = [
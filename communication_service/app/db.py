@@ -1,19 +1,422 @@
+import concurrent.futures
+import contextvars
 import sqlite3
 import os
+import json
+import sys
+import threading
+import time
+import zlib
 import datetime
 import pathlib
+import attachments as blob_store
+import db_writer
+import logs
+import query_stats
+import storage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logs.get_logger(__name__)
 
 # Ensure data directory exists
-data_dir = os.path.join(os.path.dirname(__file__), '..', 'data')
+data_dir = os.environ.get('DATA_DIR', os.path.join(os.path.dirname(__file__), '..', 'data'))
 os.makedirs(data_dir, exist_ok=True)
 
 DB_PATH = os.path.join(data_dir, 'communication.db')
 
-def get_db_connection():
-    """Get a connection to the SQLite database"""
-    conn = sqlite3.connect(DB_PATH)
+# Optional sharding. With DB_SHARDING=department messages and outbox entries
+# are kept in a database file per top-level department of the sender, under
+# SHARD_DIR, each with its own writer, so faculties send concurrently. Inboxes
+# read every shard. The main database keeps messages written before sharding
+# was turned on, and counts as shard 0.
+DB_SHARDING = os.environ.get('DB_SHARDING', 'off')
+SHARD_DIR = os.environ.get('SHARD_DIR', os.path.join(data_dir, 'shards'))
+
+# Threads reading shards in parallel for inbox, search and counter queries
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', '8'))
+
+# Shards are files of their own, so they need the SQLite backend
+if DB_SHARDING == 'department' and storage.DB_BACKEND != 'sqlite':
+    raise ValueError("DB_SHARDING=department needs DB_BACKEND=sqlite")
+
+# Each shard hands out message, attachment and outbox IDs from its own range,
+# so an ID divided by the span is the shard holding the row. IDs stay below
+# 2**53, which allows top-level department IDs up to MAX_SHARD (9006).
+SHARD_ID_SPAN = 10 ** 12
+MAX_SHARD = 2 ** 53 // SHARD_ID_SPAN - 1
+SHARD_SEQUENCES = ('Messages', 'MessageAttachments', 'Outbox')
+
+# Message sends either write the message directly ("sync") or append it to
+# the Outbox for the background delivery workers in outbox.py ("outbox")
+MESSAGE_DELIVERY = os.environ.get('MESSAGE_DELIVERY', 'sync')
+
+# Called with no arguments after a message is queued, so in-process workers wake up
+outbox_listeners = []
+
+# Unreferenced attachment blobs are only deleted once untouched for this long
+# (seconds), so a blob stored for a send still in progress is kept
+BLOB_GRACE_SECONDS = int(os.environ.get('BLOB_GRACE_SECONDS', '3600'))
+
+# Pages returned to the file system per incremental vacuum step, and the
+# pause between steps that lets senders take the write lock (seconds)
+VACUUM_PAGES = 1000
+VACUUM_PAUSE = 0.05
+
+# Messages past the retention age are moved to per-period archive databases here
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(data_dir, 'archive'))
+
+# Inbox delivery mode:
+# - "read": work out recipients at read time by joining MessageRecipients
+# - "fanout": materialise per-department InboxDeliveries rows at send time
+INBOX_DELIVERY_MODE = os.environ.get('INBOX_DELIVERY_MODE', 'read')
+
+# Departments reached by a message: each recipient department and all of its
+# descendants, found through the DepartmentIntervals ranges. Recipients
+# missing from the interval table are delivered to directly.
+DELIVERY_TARGETS_QUERY = '''
+    SELECT DISTINCT
+        COALESCE(di.department_id, mr.recipient_department_id) AS department_id,
+        m.id AS message_id,
+        m.timestamp AS timestamp
+    FROM MessageRecipients mr
+    JOIN Messages m ON m.id = mr.message_id
+    LEFT JOIN DepartmentIntervals r ON r.department_id = mr.recipient_department_id
+    LEFT JOIN DepartmentIntervals di ON di.lo >= r.lo AND di.lo < r.hi
+'''
+
+# A department and all of its ancestors, found by the ancestors' intervals
+# containing the department's own preorder number. Takes the department ID twice.
+ANCESTOR_DEPARTMENTS_QUERY = '''
+    SELECT di.department_id
+    FROM DepartmentIntervals di, DepartmentIntervals target
+    WHERE target.department_id = ?
+      AND di.lo <= target.lo AND di.hi > target.lo
+    UNION SELECT ?
+'''
+
+# Read markers and counters with user_id 0 are department-wide
+DEPARTMENT_READER = 0
+
+# Message bodies live in MessageBodies, compressed when larger than the threshold.
+# Compression is "zlib", "zstd" (needs the zstandard package) or "none".
+BODY_COMPRESSION = os.environ.get('MESSAGE_BODY_COMPRESSION', 'zlib')
+BODY_COMPRESSION_THRESHOLD = int(os.environ.get('MESSAGE_BODY_COMPRESSION_THRESHOLD', '1024'))
+
+# The same tables for DB_BACKEND=postgres (PostgreSQL 14 or later). Timestamps
+# are TEXT, as in SQLite, and MessagesFTS is a tsvector index in place of FTS5,
+# filled in by write_message since bodies may be compressed.
+POSTGRES_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS Messages (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        sender_department_id BIGINT NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        timestamp TEXT NOT NULL
+    );
+    
+    CREATE TABLE IF NOT EXISTS MessageRecipients (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        message_id BIGINT NOT NULL REFERENCES Messages (id),
+        recipient_department_id BIGINT NOT NULL,
+        UNIQUE (message_id, recipient_department_id)
+    );
+    
+    CREATE TABLE IF NOT EXISTS DepartmentIntervals (
+        department_id BIGINT PRIMARY KEY,
+        lo BIGINT NOT NULL,
+        hi BIGINT NOT NULL
+    );
+    
+    CREATE TABLE IF NOT EXISTS Metadata (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    
+    CREATE INDEX IF NOT EXISTS idx_message_recipients_department
+        ON MessageRecipients (recipient_department_id, message_id);
+    
+    CREATE INDEX IF NOT EXISTS idx_messages_timestamp
+        ON Messages (timestamp);
+    
+    CREATE TABLE IF NOT EXISTS Outbox (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        sender_department_id BIGINT NOT NULL,
+        recipients TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        attachments TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TEXT NOT NULL,
+        claimed_at TEXT,
+        delivered_at TEXT,
+        message_id BIGINT,
+        last_error TEXT
+    );
+    
+    CREATE INDEX IF NOT EXISTS idx_outbox_status
+        ON Outbox (status, next_attempt_at);
+    
+    CREATE TABLE IF NOT EXISTS ArchivePeriods (
+        period TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        min_id BIGINT NOT NULL,
+        max_id BIGINT NOT NULL,
+        message_count INTEGER NOT NULL DEFAULT 0
+    );
+    
+    CREATE TABLE IF NOT EXISTS InboxDeliveries (
+        department_id BIGINT NOT NULL,
+        message_id BIGINT NOT NULL REFERENCES Messages (id),
+        timestamp TEXT NOT NULL,
+        PRIMARY KEY (department_id, message_id)
+    );
+    
+    CREATE INDEX IF NOT EXISTS idx_inbox_deliveries_department_time
+        ON InboxDeliveries (department_id, timestamp);
+    
+    CREATE TABLE IF NOT EXISTS MessageReads (
+        department_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL DEFAULT 0,
+        message_id BIGINT NOT NULL REFERENCES Messages (id),
+        read_at TEXT NOT NULL,
+        PRIMARY KEY (department_id, user_id, message_id)
+    );
+    
+    CREATE TABLE IF NOT EXISTS UnreadCounts (
+        department_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL DEFAULT 0,
+        unread INTEGER NOT NULL,
+        PRIMARY KEY (department_id, user_id)
+    );
+    
+    CREATE TABLE IF NOT EXISTS MessageBodies (
+        message_id BIGINT PRIMARY KEY REFERENCES Messages (id),
+        encoding TEXT NOT NULL,
+        body BYTEA NOT NULL
+    );
+    
+    CREATE TABLE IF NOT EXISTS AttachmentBlobs (
+        sha256 TEXT PRIMARY KEY,
+        size BIGINT NOT NULL,
+        ref_count INTEGER NOT NULL DEFAULT 0
+    );
+    
+    CREATE TABLE IF NOT EXISTS MessageAttachments (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        message_id BIGINT NOT NULL REFERENCES Messages (id),
+        sha256 TEXT NOT NULL REFERENCES AttachmentBlobs (sha256),
+        filename TEXT NOT NULL,
+        content_type TEXT
+    );
+    
+    CREATE INDEX IF NOT EXISTS idx_message_attachments_message
+        ON MessageAttachments (message_id);
+    
+    -- Subject terms weigh more than body terms when ranking, as with bm25 in SQLite
+    CREATE TABLE IF NOT EXISTS MessagesFTS (
+        message_id BIGINT PRIMARY KEY REFERENCES Messages (id) ON DELETE CASCADE,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        document TSVECTOR GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', subject), 'A') || setweight(to_tsvector('simple', body), 'B')
+        ) STORED
+    );
+    
+    CREATE INDEX IF NOT EXISTS idx_messages_fts_document
+        ON MessagesFTS USING GIN (document);
+'''
+
+def encode_body(body):
+    """Encode a message body for storage, returning (encoding, payload)"""
+    data = body.encode('utf-8')
+    # PostgreSQL keeps every body in a BYTEA column, so plain ones are stored as UTF-8 bytes
+    plain = data if storage.DB_BACKEND == 'postgres' else body
+    if len(data) < BODY_COMPRESSION_THRESHOLD:
+        return 'plain', plain
+    
+    if BODY_COMPRESSION == 'zstd' and zstandard is not None:
+        payload = zstandard.ZstdCompressor().compress(data)
+        encoding = 'zstd'
+    elif BODY_COMPRESSION in ('zlib', 'zstd'):
+        payload = zlib.compress(data)
+        encoding = 'zlib'
+    else:
+        return 'plain', plain
+    
+    # Keep incompressible bodies as plain text
+    if len(payload) >= len(data):
+        return 'plain', plain
+    return encoding, payload
+
+def decode_body(encoding, payload):
+    """Decode a stored message body"""
+    if payload is None:
+        return None
+    if encoding == 'zlib':
+        return zlib.decompress(payload).decode('utf-8')
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd-compressed message bodies")
+        return zstandard.ZstdDecompressor().decompress(payload).decode('utf-8')
+    if isinstance(payload, bytes):
+        return payload.decode('utf-8')
+    return payload
+
+# Connections kept open only to read PRAGMA data_version, one per database file
+_version_conns = {}
+_version_lock = threading.Lock()
+
+# Shard of every department, reloaded when the main database changes
+_shard_map = {"version": None, "shards": {}}
+_shard_lock = threading.Lock()
+
+# Shard files whose schema has been created in this process
+_ready_shards = set()
+
+# Threads reading shards in parallel, started on first use
+_shard_pool = None
+
+def get_db_connection(shard=0):
+    """
+    Get a connection to the SQLite database, or to one of its shards. With
+    DB_BACKEND=postgres this is a pooled PostgreSQL connection instead.
+    """
+    if storage.DB_BACKEND == 'postgres':
+        return storage.connect()
+    
+    conn = query_stats.connect(shard_path(shard))
     conn.row_factory = sqlite3.Row
-    return conn
+    register_functions(conn)
+    return db_writer.configure_connection(conn)
+
+def register_functions(conn):
+    """Register the SQL functions the schema's triggers rely on"""
+    # Used by the search index triggers to index compressed bodies
+    conn.create_function('decode_body', 2, decode_body, deterministic=True)
+
+def run_write(job, shard=0):
+    """
+    Run job(conn) on the database's or shard's writer thread, which commits
+    it together with other pending writes. Returns the job's result or raises
+    its error. On PostgreSQL the job runs in its own serializable transaction
+    on the calling thread.
+    """
+    if storage.DB_BACKEND == 'postgres':
+        return storage.run_transaction(job)
+    return db_writer.submit_write(shard_path(shard), job, setup=register_functions)
+
+def shard_path(shard):
+    """Get the file of a shard, creating its schema the first time it is used"""
+    if not shard:
+        return DB_PATH
+    
+    path = os.path.join(SHARD_DIR, f'communication-{shard}.db')
+    if path not in _ready_shards:
+        with _shard_lock:
+            if path not in _ready_shards:
+                init_shard(path, shard)
+                _ready_shards.add(path)
+    return path
+
+def file_version(path):
+    """Get a number that changes whenever another connection commits to a database file"""
+    with _version_lock:
+        conn = _version_conns.get(path)
+        if conn is None:
+            conn = _version_conns[path] = sqlite3.connect(path, check_same_thread=False)
+        return conn.execute('PRAGMA data_version').fetchone()[0]
+
+def get_shard_map():
+    """
+    Map every department to its shard, the id of its top-level department,
+    as stored by the last hierarchy sync. Returns an empty map when sharding is off.
+    """
+    if DB_SHARDING != 'department':
+        return {}
+    
+    version = file_version(DB_PATH)
+    if _shard_map["version"] == version:
+        return _shard_map["shards"]
+    
+    with _shard_lock:
+        if _shard_map["version"] != version:
+            conn = query_stats.connect(DB_PATH)
+            rows = conn.execute('SELECT department_id, shard FROM DepartmentShards').fetchall()
+            conn.close()
+            _shard_map.update(version=version, shards=dict(rows))
+        return _shard_map["shards"]
+
+def get_shards():
+    """Every shard that can hold rows: the main database and one per top-level department"""
+    return [0] + sorted(set(get_shard_map().values()))
+
+def shard_for_department(department_id):
+    """The shard a department's new messages go to"""
+    return check_shard(get_shard_map().get(department_id, 0))
+
+def check_shard(shard):
+    """Return a shard, raising ValueError if its ID range would pass 2**53"""
+    if shard > MAX_SHARD:
+        raise ValueError(f"Top-level department {shard} is above {MAX_SHARD}, the highest that can have a shard")
+    return shard
+
+def shard_for_id(row_id):
+    """
+    The shard holding a message, attachment or outbox entry, from the range
+    its id falls in. IDs outside every shard's range are looked up in the
+    main database.
+    """
+    shard = int(row_id) // SHARD_ID_SPAN
+    return shard if shard in get_shards() else 0
+
+def map_shards(fn, shards=None):
+    """
+    Call fn(shard) for every shard, in parallel, and return the results in
+    shard order. Each call runs in a copy of the caller's context.
+    """
+    global _shard_pool
+    shards = get_shards() if shards is None else list(shards)
+    if not shards:
+        return []
+    if len(shards) == 1:
+        return [fn(shards[0])]
+    
+    if _shard_pool is None:
+        with _shard_lock:
+            if _shard_pool is None:
+                _shard_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=SHARD_WORKERS, thread_name_prefix='db-shard'
+                )
+    futures = [_shard_pool.submit(contextvars.copy_context().run, fn, shard) for shard in shards]
+    return [future.result() for future in futures]
+
+def fan_out(query, shards=None):
+    """Run query(conn) on a connection to every shard in parallel and return the results in shard order"""
+    def run(shard):
+        conn = get_db_connection(shard)
+        try:
+            return query(conn)
+        finally:
+            conn.close()
+    
+    return map_shards(run, shards)
+
+def department_shards(index):
+    """Map every department in a hierarchy index to its top-level department"""
+    preorder = index["preorder"]
+    shards = {}
+    for dept_id in preorder:
+        if dept_id not in shards:
+            # The first unvisited department in preorder starts a new top-level subtree
+            for member in preorder[index["tin"][dept_id]:index["tout"][dept_id]]:
+                shards[member] = dept_id
+    return shards
 
 def init_db():
     """Initialize the database with required tables"""
@@ -22,7 +425,51 @@ def init_db():
     
     conn = get_db_connection()
     
-    print(f"Initializing communication database at {DB_PATH}")
+    logger.info("Initializing communication database", extra={"db_path": DB_PATH})
+    
+    if storage.DB_BACKEND == 'postgres':
+        create_postgres_schema(conn)
+    else:
+        create_schema(conn)
+    
+    # The shard of every department, its top-level department, written when
+    # the hierarchy is synced (main database only)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS DepartmentShards (
+            department_id INTEGER PRIMARY KEY,
+            shard INTEGER NOT NULL
+        )
+    ''')
+    
+    conn.commit()
+    conn.close()
+    logger.info("Communication database initialized")
+
+def init_shard(path, shard):
+    """Create a shard's tables and start its IDs at the shard's own range"""
+    check_shard(shard)
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    conn = query_stats.connect(path)
+    conn.row_factory = sqlite3.Row
+    register_functions(conn)
+    create_schema(conn)
+    conn.executemany('''
+        INSERT INTO sqlite_sequence (name, seq)
+        SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+    ''', [(table, shard * SHARD_ID_SPAN, table) for table in SHARD_SEQUENCES])
+    conn.commit()
+    conn.close()
+    logger.info("Shard initialized", extra={"shard": shard, "db_path": path})
+
+def create_schema(conn):
+    """Create the message tables, shared by the main database and every shard"""
+    # Lets freed pages be given back with incremental vacuums. Only takes
+    # effect while the database file is new, so it comes before the switch
+    # to WAL.
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    
+    # Write-ahead logging lets inboxes be read while a message is being written
+    db_writer.enable_wal(conn)
     
     # Create tables
     conn.executescript('''
@@ -41,51 +488,604 @@ def init_db():
             FOREIGN KEY (message_id) REFERENCES Messages (id),
             UNIQUE (message_id, recipient_department_id)
         );
+        
+        CREATE TABLE IF NOT EXISTS DepartmentIntervals (
+            department_id INTEGER PRIMARY KEY,
+            lo INTEGER NOT NULL,
+            hi INTEGER NOT NULL
+        );
+        
+        CREATE TABLE IF NOT EXISTS Metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        
+        CREATE INDEX IF NOT EXISTS idx_message_recipients_department
+            ON MessageRecipients (recipient_department_id, message_id);
+        
+        CREATE INDEX IF NOT EXISTS idx_messages_timestamp
+            ON Messages (timestamp);
+        
+        CREATE TABLE IF NOT EXISTS Outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_department_id INTEGER NOT NULL,
+            recipients TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            attachments TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL,
+            claimed_at TIMESTAMP,
+            delivered_at TIMESTAMP,
+            message_id INTEGER,
+            last_error TEXT
+        );
+        
+        CREATE INDEX IF NOT EXISTS idx_outbox_status
+            ON Outbox (status, next_attempt_at);
+        
+        CREATE TABLE IF NOT EXISTS ArchivePeriods (
+            period TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0
+        );
+        
+        CREATE TABLE IF NOT EXISTS InboxDeliveries (
+            department_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            PRIMARY KEY (department_id, message_id),
+            FOREIGN KEY (message_id) REFERENCES Messages (id)
+        );
+        
+        CREATE INDEX IF NOT EXISTS idx_inbox_deliveries_department_time
+            ON InboxDeliveries (department_id, timestamp);
+        
+        CREATE TABLE IF NOT EXISTS MessageReads (
+            department_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL DEFAULT 0,
+            message_id INTEGER NOT NULL,
+            read_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (department_id, user_id, message_id),
+            FOREIGN KEY (message_id) REFERENCES Messages (id)
+        );
+        
+        CREATE TABLE IF NOT EXISTS UnreadCounts (
+            department_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL DEFAULT 0,
+            unread INTEGER NOT NULL,
+            PRIMARY KEY (department_id, user_id)
+        );
     ''')
     
-    conn.commit()
-    conn.close()
-    print("Communication database initialized successfully")
+    # Bodies are kept apart from the header rows so listing queries stay compact
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS MessageBodies (
+            message_id INTEGER PRIMARY KEY,
+            encoding TEXT NOT NULL,
+            body BLOB NOT NULL,
+            FOREIGN KEY (message_id) REFERENCES Messages (id)
+        );
+        
+        CREATE TABLE IF NOT EXISTS AttachmentBlobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0
+        );
+        
+        CREATE TABLE IF NOT EXISTS MessageAttachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            content_type TEXT,
+            FOREIGN KEY (message_id) REFERENCES Messages (id),
+            FOREIGN KEY (sha256) REFERENCES AttachmentBlobs (sha256)
+        );
+        
+        CREATE INDEX IF NOT EXISTS idx_message_attachments_message
+            ON MessageAttachments (message_id);
+    ''')
+    
+    # Full-text index over subject and body, kept in sync by triggers.
+    # The index keeps its own copy of the text because bodies may be compressed.
+    fts_sql = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'MessagesFTS'"
+    ).fetchone()
+    
+    if fts_sql and 'content=' in fts_sql['sql']:
+        # Replace the earlier external-content index, which read bodies from Messages
+        conn.executescript('''
+            DROP TRIGGER IF EXISTS messages_fts_insert;
+            DROP TRIGGER IF EXISTS messages_fts_delete;
+            DROP TRIGGER IF EXISTS messages_fts_update;
+            DROP TABLE MessagesFTS;
+        ''')
+        fts_sql = None
+    
+    conn.executescript('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS MessagesFTS USING fts5(subject, body);
+        
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON Messages BEGIN
+            INSERT INTO MessagesFTS (rowid, subject, body) VALUES (new.id, new.subject, new.body);
+        END;
+        
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON Messages BEGIN
+            DELETE FROM MessagesFTS WHERE rowid = old.id;
+        END;
+        
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update_subject AFTER UPDATE OF subject ON Messages BEGIN
+            UPDATE MessagesFTS SET subject = new.subject WHERE rowid = new.id;
+        END;
+        
+        -- Clearing Messages.body means the body moved to MessageBodies
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update_body AFTER UPDATE OF body ON Messages
+        WHEN new.body <> '' BEGIN
+            UPDATE MessagesFTS SET body = new.body WHERE rowid = new.id;
+        END;
+        
+        CREATE TRIGGER IF NOT EXISTS message_bodies_fts_insert AFTER INSERT ON MessageBodies BEGIN
+            UPDATE MessagesFTS SET body = decode_body(new.encoding, new.body) WHERE rowid = new.message_id;
+        END;
+    ''')
+    
+    # Index messages that were stored before the search index existed
+    if not fts_sql:
+        conn.execute('''
+            INSERT INTO MessagesFTS (rowid, subject, body)
+            SELECT m.id, m.subject, COALESCE(decode_body(b.encoding, b.body), m.body)
+            FROM Messages m
+            LEFT JOIN MessageBodies b ON b.message_id = m.id
+        ''')
 
-def create_message(sender_dept_id, recipients_dept_ids, subject, body):
-    """Create a new message and associate it with recipients"""
-    conn = get_db_connection()
+def create_postgres_schema(conn):
+    """Create the PostgreSQL tables"""
+    # Processes starting together would otherwise race to create the same objects
+    storage.lock(conn, 'schema')
+    conn.executescript(POSTGRES_SCHEMA)
+
+def create_message(sender_dept_id, recipients_dept_ids, subject, body, attachments=None):
+    """
+    Create a new message and associate it with recipients
+    attachments: optional list of (filename, file-like object, content_type)
+    In outbox mode the message is queued with a single insert and delivered
+    by the outbox workers.
+    """
+    # Stream attachment contents to the blob store before opening the
+    # transaction; identical files are only stored once
+    stored_attachments = []
+    try:
+        for filename, fileobj, content_type in attachments or []:
+            sha256, size = blob_store.store_blob(fileobj)
+            stored_attachments.append((filename, content_type, sha256, size))
+    except Exception as e:
+        logger.error("Error storing attachment: %s", e)
+        return False
+    
+    if MESSAGE_DELIVERY == 'outbox':
+        return enqueue_message(sender_dept_id, recipients_dept_ids, subject, body, stored_attachments)
+    
     now = datetime.datetime.now().isoformat()
     
     try:
-        # Insert the message
-        cursor = conn.execute(
-            'INSERT INTO Messages (sender_department_id, subject, body, timestamp) VALUES (?, ?, ?, ?)',
-            (sender_dept_id, subject, body, now)
+        run_write(lambda conn: write_message(
+            conn, sender_dept_id, recipients_dept_ids, subject, body, stored_attachments, now
+        ), shard=shard_for_department(sender_dept_id))
+        return True
+    except Exception as e:
+        if db_writer.is_busy_error(e):
+            logger.error("Error creating message: database stayed locked (%s)", e)
+        else:
+            logger.error("Error creating message: %s", e)
+        return False
+
+def write_message(conn, sender_dept_id, recipients_dept_ids, subject, body, stored_attachments, timestamp):
+    """
+    Write a message, its recipients and its deliveries inside the caller's transaction
+    stored_attachments: list of (filename, content_type, sha256, size) already in the blob store
+    Returns the new message ID.
+    """
+    # Senders take turns on PostgreSQL, so message IDs become visible in
+    # order and get_message_sequence never skips one still being written
+    storage.lock(conn, 'Messages')
+    
+    # Insert the message header; the body goes to MessageBodies
+    message_id = conn.execute(
+        'INSERT INTO Messages (sender_department_id, subject, body, timestamp) VALUES (?, ?, ?, ?) RETURNING id',
+        (sender_dept_id, subject, '', timestamp)
+    ).fetchone()[0]
+    
+    encoding, payload = encode_body(body)
+    conn.execute(
+        'INSERT INTO MessageBodies (message_id, encoding, body) VALUES (?, ?, ?)',
+        (message_id, encoding, payload)
+    )
+    
+    # SQLite indexes the body through a trigger on MessageBodies
+    if storage.DB_BACKEND == 'postgres':
+        conn.execute(
+            'INSERT INTO MessagesFTS (message_id, subject, body) VALUES (?, ?, ?)',
+            (message_id, subject, body)
         )
-        message_id = cursor.lastrowid
-        
-        # Associate with recipients
-        for dept_id in recipients_dept_ids:
-            conn.execute(
-                'INSERT INTO MessageRecipients (message_id, recipient_department_id) VALUES (?, ?)',
-                (message_id, dept_id)
+    
+    # Reference the stored blobs
+    for filename, content_type, sha256, size in stored_attachments:
+        conn.execute('''
+            INSERT INTO AttachmentBlobs (sha256, size, ref_count) VALUES (?, ?, 1)
+            ON CONFLICT (sha256) DO UPDATE SET ref_count = AttachmentBlobs.ref_count + 1
+        ''', (sha256, size))
+        conn.execute('''
+            INSERT INTO MessageAttachments (message_id, sha256, filename, content_type)
+            VALUES (?, ?, ?, ?)
+        ''', (message_id, sha256, filename, content_type))
+    
+    # Associate with recipients
+    conn.executemany(
+        'INSERT INTO MessageRecipients (message_id, recipient_department_id) VALUES (?, ?)',
+        [(message_id, dept_id) for dept_id in recipients_dept_ids]
+    )
+    
+    # Deliver to each recipient and its sub-departments in the same transaction
+    if INBOX_DELIVERY_MODE == 'fanout':
+        materialise_deliveries(conn, message_id)
+    
+    # Bump the unread counters that are already being maintained
+    conn.execute(f'''
+        UPDATE UnreadCounts SET unread = unread + 1
+        WHERE department_id IN (
+            SELECT department_id FROM ({DELIVERY_TARGETS_QUERY} WHERE mr.message_id = ?) AS targets
+        )
+    ''', (message_id,))
+    
+    return message_id
+
+def enqueue_message(sender_dept_id, recipients_dept_ids, subject, body, stored_attachments):
+    """Append a message to the Outbox for background delivery"""
+    now = datetime.datetime.now().isoformat()
+    
+    try:
+        run_write(lambda conn: conn.execute('''
+            INSERT INTO Outbox 
+            (sender_department_id, recipients, subject, body, attachments, created_at, next_attempt_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (sender_dept_id, json.dumps(list(recipients_dept_ids)), subject, body,
+              json.dumps(stored_attachments), now, now)), shard=shard_for_department(sender_dept_id))
+    except Exception as e:
+        logger.error("Error queuing message: %s", e)
+        return False
+    
+    for listener in outbox_listeners:
+        listener()
+    return True
+
+def claim_outbox_entry(stale_after=60):
+    """
+    Claim the next due Outbox entry for delivery, or None if there is none.
+    Entries claimed by a worker that died are reclaimed after stale_after seconds.
+    With sharding each shard's Outbox is tried in turn.
+    """
+    now = datetime.datetime.now()
+    stale = (now - datetime.timedelta(seconds=stale_after)).isoformat()
+    
+    def claim(conn):
+        rows = conn.execute('''
+            UPDATE Outbox
+            SET status = 'processing', claimed_at = ?, attempts = attempts + 1
+            WHERE id = (
+                SELECT id FROM Outbox
+                WHERE (status = 'pending' AND next_attempt_at <= ?)
+                   OR (status = 'processing' AND claimed_at < ?)
+                ORDER BY id
+                LIMIT 1
             )
+            RETURNING *
+        ''', (now.isoformat(), now.isoformat(), stale)).fetchall()
+        return rows[0] if rows else None
+    
+    for shard in get_shards():
+        entry = run_write(claim, shard=shard)
+        if entry:
+            return entry
+    return None
+
+def deliver_outbox_entry(entry):
+    """
+    Write a claimed Outbox entry as a message and mark it delivered in the
+    same transaction, so an entry is never delivered twice. Returns the
+    message ID, or None when the claim went stale and another worker
+    reclaimed the entry.
+    """
+    def deliver(conn):
+        if not holds_claim(conn, entry):
+            return None
+        message_id = write_message(
+            conn,
+            entry['sender_department_id'],
+            json.loads(entry['recipients']),
+            entry['subject'],
+            entry['body'],
+            [tuple(a) for a in json.loads(entry['attachments'])],
+            entry['created_at']
+        )
+        conn.execute('''
+            UPDATE Outbox
+            SET status = 'delivered', delivered_at = ?, message_id = ?, body = '', last_error = NULL
+            WHERE id = ?
+        ''', (datetime.datetime.now().isoformat(), message_id, entry['id']))
+        return message_id
+    
+    # The entry and its message live in the sender's shard
+    return run_write(deliver, shard=shard_for_id(entry['id']))
+
+def holds_claim(conn, entry):
+    """Check that a claimed Outbox entry has not been reclaimed by another worker since"""
+    return conn.execute(
+        "SELECT 1 FROM Outbox WHERE id = ? AND status = 'processing' AND claimed_at = ?",
+        (entry['id'], entry['claimed_at'])
+    ).fetchone() is not None
+
+def reschedule_outbox_entry(entry, error, delay=None):
+    """
+    Put a claimed Outbox entry back in the queue after delay seconds, or mark
+    it failed when delay is None. Entries reclaimed by another worker are left alone.
+    """
+    shard = shard_for_id(entry['id'])
+    if delay is None:
+        run_write(lambda conn: conn.execute('''
+            UPDATE Outbox SET status = 'failed', last_error = ?
+            WHERE id = ? AND status = 'processing' AND claimed_at = ?
+        ''', (error, entry['id'], entry['claimed_at'])), shard=shard)
+    else:
+        next_attempt = (datetime.datetime.now() + datetime.timedelta(seconds=delay)).isoformat()
+        run_write(lambda conn: conn.execute('''
+            UPDATE Outbox SET status = 'pending', next_attempt_at = ?, last_error = ?
+            WHERE id = ? AND status = 'processing' AND claimed_at = ?
+        ''', (next_attempt, error, entry['id'], entry['claimed_at'])), shard=shard)
+
+def get_outbox_stats(window_seconds=300):
+    """
+    Get Outbox queue metrics:
+    - depth: entries waiting or being delivered
+    - failed: entries that gave up after repeated errors
+    - oldest_pending_seconds: age of the oldest undelivered entry
+    - avg_delivery_lag_seconds / max_delivery_lag_seconds: send-to-delivery
+      time over entries delivered in the last window_seconds
+    """
+    since = (datetime.datetime.now() - datetime.timedelta(seconds=window_seconds)).isoformat()
+    
+    def shard_stats(conn):
+        queue = conn.execute('''
+            SELECT
+                SUM(CASE WHEN status IN ('pending', 'processing') THEN 1 ELSE 0 END) AS depth,
+                SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END) AS failed,
+                MIN(CASE WHEN status IN ('pending', 'processing') THEN created_at END) AS oldest_pending
+            FROM Outbox
+        ''').fetchone()
+        lag = conn.execute(f'''
+            SELECT
+                COUNT(*) AS delivered,
+                AVG({storage.seconds_between('delivered_at', 'created_at')}) AS avg_lag,
+                MAX({storage.seconds_between('delivered_at', 'created_at')}) AS max_lag
+            FROM Outbox
+            WHERE status = 'delivered' AND delivered_at >= ?
+        ''', (since,)).fetchone()
+        return queue, lag
+    
+    # Each shard has its own Outbox; averages are weighted by entries delivered
+    shards = fan_out(shard_stats)
+    queues = [queue for queue, _ in shards]
+    lags = [lag for _, lag in shards if lag['delivered']]
+    delivered = sum(lag['delivered'] for lag in lags)
+    
+    oldest_pending_seconds = 0.0
+    oldest_pending = min((queue['oldest_pending'] for queue in queues if queue['oldest_pending']), default=None)
+    if oldest_pending:
+        oldest = datetime.datetime.fromisoformat(oldest_pending)
+        oldest_pending_seconds = (datetime.datetime.now() - oldest).total_seconds()
+    
+    return {
+        "depth": sum(queue['depth'] or 0 for queue in queues),
+        "failed": sum(queue['failed'] or 0 for queue in queues),
+        "oldest_pending_seconds": oldest_pending_seconds,
+        "avg_delivery_lag_seconds": sum(lag['avg_lag'] * lag['delivered'] for lag in lags) / delivered if delivered else 0.0,
+        "max_delivery_lag_seconds": max((lag['max_lag'] for lag in lags), default=0.0)
+    }
+
+def prune_outbox(max_age_hours=24):
+    """Delete delivered Outbox entries older than max_age_hours"""
+    cutoff = (datetime.datetime.now() - datetime.timedelta(hours=max_age_hours)).isoformat()
+    map_shards(lambda shard: run_write(lambda conn: conn.execute(
+        "DELETE FROM Outbox WHERE status = 'delivered' AND delivered_at < ?", (cutoff,)
+    ), shard=shard))
+
+def materialise_deliveries(conn, message_id=None):
+    """
+    Write InboxDeliveries rows for a message, or for every message when
+    message_id is None
+    """
+    message_filter = 'WHERE mr.message_id = ?' if message_id is not None else ''
+    params = (message_id,) if message_id is not None else ()
+    
+    conn.execute(storage.upsert(
+        'InboxDeliveries', ('department_id', 'message_id', 'timestamp'), ('department_id', 'message_id'),
+        update={}, select=f'{DELIVERY_TARGETS_QUERY} {message_filter}'
+    ), params)
+
+def sync_department_intervals(index):
+    """
+    Store the Euler-tour intervals of a hierarchy index so that ancestor
+    lookups can be done with range comparisons in SQL.
+    The table is only rewritten when the hierarchy version changes. In
+    fanout mode the inbox deliveries are rebuilt to match the new hierarchy.
+    With sharding the main database's shard map is updated first, then
+    every shard gets the intervals too.
+    """
+    def sync(conn, shard=0):
+        if shard == 0:
+            sync_department_shards(conn, index)
+        
+        current = conn.execute(
+            "SELECT value FROM Metadata WHERE key = 'department_version'"
+        ).fetchone()
+        delivered = conn.execute(
+            "SELECT value FROM Metadata WHERE key = 'delivery_version'"
+        ).fetchone()
+        
+        intervals_current = current and current['value'] == index["version"]
+        deliveries_current = (INBOX_DELIVERY_MODE != 'fanout'
+                              or (delivered and delivered['value'] == index["version"]))
+        if intervals_current and deliveries_current:
+            if INBOX_DELIVERY_MODE != 'fanout' and delivered:
+                # Deliveries go stale while fanout is off
+                conn.execute("DELETE FROM Metadata WHERE key = 'delivery_version'")
+            return False
+        
+        conn.execute('DELETE FROM DepartmentIntervals')
+        conn.executemany(
+            'INSERT INTO DepartmentIntervals (department_id, lo, hi) VALUES (?, ?, ?)',
+            [(dept_id, lo, index["tout"][dept_id]) for dept_id, lo in index["tin"].items()]
+        )
+        conn.execute(storage.upsert('Metadata', ('key', 'value'), ('key',)), ('department_version', index["version"]))
+        
+        # Unread counters depend on who a message reaches, so let them be
+        # recomputed lazily against the new hierarchy
+        conn.execute('DELETE FROM UnreadCounts')
+        
+        if INBOX_DELIVERY_MODE == 'fanout':
+            conn.execute('DELETE FROM InboxDeliveries')
+            materialise_deliveries(conn)
+            conn.execute(storage.upsert('Metadata', ('key', 'value'), ('key',)), ('delivery_version', index["version"]))
+        else:
+            # Deliveries go stale while fanout is off
+            conn.execute("DELETE FROM Metadata WHERE key = 'delivery_version'")
         
-        conn.commit()
         return True
+    
+    try:
+        synced = run_write(sync)
+        shards = map_shards(lambda shard: run_write(lambda conn: sync(conn, shard), shard=shard), get_shards()[1:])
+        return synced or any(shards)
     except Exception as e:
-        conn.rollback()
-        print(f"Error creating message: {e}")
+        logger.error("Error syncing department intervals: %s", e)
         return False
-    finally:
-        conn.close()
 
-def get_inbox_messages(department_id, department_hierarchy):
+def sync_department_shards(conn, index):
+    """Rewrite the department to shard map when the hierarchy or the sharding setting changed"""
+    version = index["version"] if DB_SHARDING == 'department' else 'off'
+    current = conn.execute("SELECT value FROM Metadata WHERE key = 'shard_version'").fetchone()
+    if current and current['value'] == version:
+        return False
+    
+    conn.execute('DELETE FROM DepartmentShards')
+    if DB_SHARDING == 'department':
+        conn.executemany(
+            'INSERT INTO DepartmentShards (department_id, shard) VALUES (?, ?)',
+            list(department_shards(index).items())
+        )
+    conn.execute(storage.upsert('Metadata', ('key', 'value'), ('key',)), ('shard_version', version))
+    return True
+
+def get_message_sequence():
     """
-    Get messages received by a department or its parent departments
-    department_hierarchy: list of parent department IDs
+    Get the highest message ID handed out so far. Message IDs only grow, so
+    this is a cheap high-water mark for detecting new mail. With sharding it
+    is a dict of every shard's highest ID; compare marks with
+    sequence_advanced rather than directly.
     """
-    conn = get_db_connection()
+    def sequence(conn):
+        if storage.DB_BACKEND == 'postgres':
+            # Sends are serialised by a lock, so no lower ID can still appear
+            return conn.execute('SELECT COALESCE(MAX(id), 0) FROM Messages').fetchone()[0]
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'Messages'").fetchone()
+        return row['seq'] if row else 0
+    
+    if DB_SHARDING != 'department':
+        return fan_out(sequence, [0])[0]
+    shards = get_shards()
+    return dict(zip(shards, fan_out(sequence, shards)))
+
+def sequence_advanced(sequence, mark):
+    """Check whether a message sequence has moved past a high-water mark"""
+    if isinstance(sequence, dict):
+        return any(seq > shard_mark(mark, shard) for shard, seq in sequence.items())
+    return sequence > mark
+
+def advance_sequence(sequence, message_ids):
+    """Raise a message sequence to cover already loaded message IDs"""
+    if not isinstance(sequence, dict):
+        return max([sequence] + list(message_ids))
+    
+    mark = dict(sequence)
+    for message_id in message_ids:
+        shard = shard_for_id(message_id)
+        mark[shard] = max(mark.get(shard, 0), message_id)
+    return mark
+
+def shard_mark(mark, shard):
+    """A shard's part of a high-water mark, which is a plain ID without sharding"""
+    if isinstance(mark, dict):
+        return mark.get(shard, 0)
+    return mark
+
+def get_inbox_messages(department_id, department_hierarchy=None, after_id=None):
+    """
+    Get messages received by a department or its parent departments, newest first
+    department_hierarchy: list of parent department IDs, or None to find
+    the ancestors through the synced DepartmentIntervals ranges
+    after_id: only return messages newer than this high-water mark, from
+    get_message_sequence
+    """
+    def fetch(shard):
+        conn = get_db_connection(shard)
+        try:
+            after = shard_mark(after_id, shard) if after_id is not None else None
+            return query_inbox(conn, department_id, department_hierarchy, after)
+        finally:
+            conn.close()
+    
+    # Messages are stored in their senders' shards, so every shard is read
+    shards = map_shards(fetch)
+    if len(shards) == 1:
+        return shards[0]
+    return sorted((msg for messages in shards for msg in messages), key=lambda msg: msg['timestamp'], reverse=True)
+
+def query_inbox(conn, department_id, department_hierarchy, after_id):
+    """Query one database's messages for get_inbox_messages"""
+    newer_filter = 'AND m.id > ?' if after_id is not None else ''
+    newer_params = [after_id] if after_id is not None else []
+    
+    if department_hierarchy is None and INBOX_DELIVERY_MODE == 'fanout':
+        # Deliveries were materialised at send time, so this is a single
+        # range scan over the (department_id, timestamp) index
+        messages = conn.execute(f'''
+            SELECT 
+                m.id,
+                m.subject,
+                m.timestamp,
+                m.sender_department_id,
+                (SELECT COUNT(*) FROM MessageRecipients WHERE message_id = m.id) AS recipient_count
+            FROM InboxDeliveries d
+            JOIN Messages m ON m.id = d.message_id
+            WHERE d.department_id = ? {newer_filter.replace('m.id', 'd.message_id')}
+            ORDER BY d.timestamp DESC
+        ''', [department_id] + newer_params).fetchall()
+        
+        return messages
     
-    # Include department and all its parents in the query
-    dept_ids = [department_id] + department_hierarchy
-    placeholders = ', '.join(['?'] * len(dept_ids))
+    if department_hierarchy is None:
+        # A recipient is the department or one of its ancestors when its
+        # interval contains the department's own preorder number
+        recipient_filter = f'mr.recipient_department_id IN ({ANCESTOR_DEPARTMENTS_QUERY})'
+        params = [department_id, department_id]
+    else:
+        # Include department and all its parents in the query
+        params = [department_id] + department_hierarchy
+        placeholders = ', '.join(['?'] * len(params))
+        recipient_filter = f'mr.recipient_department_id IN ({placeholders})'
     
     query = f'''
         SELECT 
@@ -96,19 +1096,190 @@ def get_inbox_messages(department_id, department_hierarchy):
             (SELECT COUNT(*) FROM MessageRecipients WHERE message_id = m.id) AS recipient_count
         FROM Messages m
         JOIN MessageRecipients mr ON m.id = mr.message_id
-        WHERE mr.recipient_department_id IN ({placeholders})
+        WHERE {recipient_filter} {newer_filter}
         ORDER BY m.timestamp DESC
     '''
     
-    messages = conn.execute(query, dept_ids).fetchall()
-    conn.close()
+    messages = conn.execute(query, params + newer_params).fetchall()
     
     return messages
 
+def get_unread_count(department_id, user_id=None):
+    """
+    Get the number of unread inbox messages for a department, or for a user
+    within it. Counters are maintained on send and on view, so this is a
+    single primary key lookup once the counter exists; a missing counter is
+    computed from the inbox and read markers and stored. With sharding each
+    shard counts its own messages and the counts are added up.
+    """
+    reader_id = DEPARTMENT_READER if user_id is None else user_id
+    return sum(map_shards(lambda shard: shard_unread_count(shard, department_id, reader_id)))
+
+def shard_unread_count(shard, department_id, reader_id):
+    """Get or compute the unread counter of one shard"""
+    conn = get_db_connection(shard)
+    
+    try:
+        row = conn.execute(
+            'SELECT unread FROM UnreadCounts WHERE department_id = ? AND user_id = ?',
+            (department_id, reader_id)
+        ).fetchone()
+        if row:
+            return row['unread']
+    finally:
+        conn.close()
+    
+    # Compute and store the counter on the writer thread so no send can
+    # slip in between the count and the insert
+    def compute(conn):
+        unread = conn.execute(f'''
+            SELECT COUNT(DISTINCT mr.message_id) AS unread
+            FROM MessageRecipients mr
+            WHERE mr.recipient_department_id IN ({ANCESTOR_DEPARTMENTS_QUERY})
+            AND NOT EXISTS (
+                SELECT 1 FROM MessageReads r
+                WHERE r.department_id = ? AND r.user_id = ? AND r.message_id = mr.message_id
+            )
+        ''', (department_id, department_id, department_id, reader_id)).fetchone()['unread']
+        conn.execute(
+            storage.upsert('UnreadCounts', ('department_id', 'user_id', 'unread'), ('department_id', 'user_id')),
+            (department_id, reader_id, unread)
+        )
+        return unread
+    
+    try:
+        return run_write(compute, shard=shard)
+    except Exception as e:
+        logger.error("Error getting unread count: %s", e)
+        return 0
+
+def mark_message_read(message_id, department_id, user_id=None):
+    """
+    Record that a department (and optionally a user in it) has viewed a
+    message, decrementing the matching unread counters in the same
+    transaction. Messages that never reached the department are ignored.
+    """
+    now = datetime.datetime.now().isoformat()
+    readers = [DEPARTMENT_READER] if user_id is None else [DEPARTMENT_READER, user_id]
+    
+    def mark(conn):
+        reached = conn.execute(f'''
+            SELECT 1 FROM ({DELIVERY_TARGETS_QUERY} WHERE mr.message_id = ?) AS targets
+            WHERE department_id = ?
+        ''', (message_id, department_id)).fetchone()
+        if not reached:
+            return False
+        
+        for reader_id in readers:
+            cursor = conn.execute(storage.upsert(
+                'MessageReads', ('department_id', 'user_id', 'message_id', 'read_at'),
+                ('department_id', 'user_id', 'message_id'), update={}
+            ), (department_id, reader_id, message_id, now))
+            
+            if cursor.rowcount:
+                conn.execute('''
+                    UPDATE UnreadCounts SET unread = CASE WHEN unread > 0 THEN unread - 1 ELSE 0 END
+                    WHERE department_id = ? AND user_id = ?
+                ''', (department_id, reader_id))
+        
+        return True
+    
+    # Read markers are kept with the message, in its sender's shard
+    try:
+        return run_write(mark, shard=shard_for_id(message_id))
+    except Exception as e:
+        logger.error("Error marking message as read: %s", e)
+        return False
+
+def get_read_message_ids(department_id, user_id=None):
+    """Get the IDs of messages a department (or a user in it) has viewed"""
+    reader_id = DEPARTMENT_READER if user_id is None else user_id
+    
+    shards = fan_out(lambda conn: conn.execute(
+        'SELECT message_id FROM MessageReads WHERE department_id = ? AND user_id = ?',
+        (department_id, reader_id)
+    ).fetchall())
+    
+    return {r['message_id'] for rows in shards for r in rows}
+
+def search_messages(query, department_id=None, start_date=None, end_date=None, limit=50):
+    """
+    Full-text search over message subjects and bodies
+    Results are ranked by bm25, or ts_rank on PostgreSQL (subject matches
+    weigh more), and include a highlighted snippet. department_id limits results to messages the
+    department sent or received (directly or through an ancestor), and
+    start_date/end_date limit the date range (inclusive).
+    """
+    # Quote each term so user input can't break the FTS query syntax
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    if not terms:
+        return []
+    
+    if storage.DB_BACKEND == 'postgres':
+        # Subject terms carry weight A and body terms B, ranked 2:1 like bm25
+        # below and negated so the best match still sorts first
+        source = '''MessagesFTS
+                CROSS JOIN plainto_tsquery('simple', ?) AS terms
+                JOIN Messages m ON m.id = MessagesFTS.message_id'''
+        snippet = ("ts_headline('simple', MessagesFTS.subject || ' … ' || MessagesFTS.body, terms, "
+                   "'StartSel=**, StopSel=**, MaxWords=12, MinWords=4')")
+        rank = "-ts_rank('{0.1, 0.2, 0.5, 1.0}', MessagesFTS.document, terms)"
+        filters = ['MessagesFTS.document @@ terms']
+        params = [query]
+    else:
+        source = 'MessagesFTS JOIN Messages m ON m.id = MessagesFTS.rowid'
+        snippet = "snippet(MessagesFTS, -1, '**', '**', '…', 12)"
+        rank = 'bm25(MessagesFTS, 2.0, 1.0)'
+        filters = ['MessagesFTS MATCH ?']
+        params = [' '.join(terms)]
+    
+    if department_id is not None:
+        filters.append(f'''(
+            m.sender_department_id = ?
+            OR m.id IN (
+                SELECT mr.message_id FROM MessageRecipients mr
+                WHERE mr.recipient_department_id IN ({ANCESTOR_DEPARTMENTS_QUERY})
+            )
+        )''')
+        params.extend([department_id, department_id, department_id])
+    
+    if start_date:
+        filters.append('m.timestamp >= ?')
+        params.append(start_date.isoformat())
+    
+    if end_date:
+        filters.append('m.timestamp < ?')
+        params.append((end_date + datetime.timedelta(days=1)).isoformat())
+    
+    params.append(limit)
+    
+    def search(conn):
+        try:
+            return conn.execute(f'''
+                SELECT
+                    m.id,
+                    m.subject,
+                    m.timestamp,
+                    m.sender_department_id,
+                    {snippet} AS snippet,
+                    {rank} AS rank
+                FROM {source}
+                WHERE {' AND '.join(filters)}
+                ORDER BY rank
+                LIMIT ?
+            ''', params).fetchall()
+        except sqlite3.OperationalError as e:
+            logger.error("Error searching messages: %s", e)
+            return []
+    
+    # Each shard ranks its own matches; the best of every shard are merged by rank
+    shards = fan_out(search)
+    if len(shards) == 1:
+        return shards[0]
+    return sorted((msg for messages in shards for msg in messages), key=lambda msg: msg['rank'])[:limit]
+
 def get_sent_messages(department_id):
     """Get messages sent by a department"""
-    conn = get_db_connection()
-    
     query = '''
         SELECT 
             m.id,
@@ -120,44 +1291,200 @@ def get_sent_messages(department_id):
         ORDER BY m.timestamp DESC
     '''
     
-    messages = conn.execute(query, (department_id,)).fetchall()
-    conn.close()
-    
-    return messages
+    # A department's messages are in its shard, or the main database if
+    # they were sent before sharding or before it moved to another faculty
+    shards = fan_out(lambda conn: conn.execute(query, (department_id,)).fetchall())
+    if len(shards) == 1:
+        return shards[0]
+    return sorted((msg for messages in shards for msg in messages), key=lambda msg: msg['timestamp'], reverse=True)
 
-def get_message_details(message_id):
-    """Get full message details including sender, recipients, subject, body"""
-    conn = get_db_connection()
-    
-    # Get message content
-    message = conn.execute('''
+def get_archive_periods(conn, message_id):
+    """Get the archive databases whose message ID range covers a message"""
+    return conn.execute(
+        'SELECT period, path FROM ArchivePeriods WHERE ? BETWEEN min_id AND max_id ORDER BY period',
+        (message_id,)
+    ).fetchall()
+
+def load_message(conn, message_id, schema=None):
+    """Load a message and its recipient IDs from the hot database or an attached archive schema"""
+    prefix = f'{schema}.' if schema else ''
+    message = conn.execute(f'''
         SELECT 
             m.id,
             m.sender_department_id,
             m.subject,
             m.body,
-            m.timestamp
-        FROM Messages m
+            m.timestamp,
+            b.encoding AS body_encoding,
+            b.body AS stored_body
+        FROM {prefix}Messages m
+        LEFT JOIN {prefix}MessageBodies b ON b.message_id = m.id
         WHERE m.id = ?
     ''', (message_id,)).fetchone()
     
     if not message:
-        conn.close()
         return None
     
     # Get message recipients
-    recipients = conn.execute('''
+    recipients = conn.execute(f'''
         SELECT recipient_department_id
-        FROM MessageRecipients
+        FROM {prefix}MessageRecipients
         WHERE message_id = ?
     ''', (message_id,)).fetchall()
     
-    conn.close()
-    
     result = dict(message)
     result['recipient_dept_ids'] = [r['recipient_department_id'] for r in recipients]
+    return result
+
+def load_message_attachments(conn, message_id, schema=None):
+    """Load a message's attachments from the hot database or an attached archive schema"""
+    # Blobs are counted in the hot database only, which unqualified names resolve to first
+    prefix = f'{schema}.' if schema else ''
+    return conn.execute(f'''
+        SELECT ma.id, ma.filename, ma.content_type, ma.sha256, ab.size
+        FROM {prefix}MessageAttachments ma
+        JOIN AttachmentBlobs ab ON ab.sha256 = ma.sha256
+        WHERE ma.message_id = ?
+        ORDER BY ma.id
+    ''', (message_id,)).fetchall()
+
+def find_message(conn, message_id, loader):
+    """
+    Run a loader against the hot database, falling back to any archive
+    database that may hold the message. Archives are attached on demand.
+    The hot tables are left unqualified, since PostgreSQL has no "main" schema.
+    """
+    result = loader(conn, message_id)
+    if result:
+        return result
+    
+    for period in get_archive_periods(conn, message_id):
+        if not os.path.exists(period['path']):
+            continue
+        conn.execute('ATTACH DATABASE ? AS archive', (period['path'],))
+        try:
+            result = loader(conn, message_id, 'archive')
+        finally:
+            conn.execute('DETACH DATABASE archive')
+        if result:
+            return result
+    
+    return result
+
+def get_message_details(message_id):
+    """Get full message details including sender, recipients, subject, body"""
+    conn = get_db_connection(shard_for_id(message_id))
+    
+    # Archived messages are read transparently from their archive database
+    result = find_message(conn, message_id, load_message)
+    conn.close()
+    
+    if not result:
+        return None
+    
+    # Decompress the body only now that the message is being opened
+    encoding = result.pop('body_encoding')
+    stored_body = result.pop('stored_body')
+    if encoding is not None:
+        result['body'] = decode_body(encoding, stored_body)
     
     return result
 
+def get_message_attachments(message_id):
+    """Get the attachments of a message"""
+    conn = get_db_connection(shard_for_id(message_id))
+    
+    rows = find_message(conn, message_id, load_message_attachments)
+    conn.close()
+    
+    return rows
+
+def get_referenced_blobs():
+    """Digests of every blob a message or a queued Outbox entry still points at"""
+    def fetch(conn):
+        blobs = {row['sha256'] for row in conn.execute('SELECT sha256 FROM AttachmentBlobs WHERE ref_count > 0')}
+        for row in conn.execute("SELECT attachments FROM Outbox WHERE status IN ('pending', 'processing')"):
+            blobs.update(attachment[2] for attachment in json.loads(row['attachments']))
+        return blobs
+    
+    return set().union(*fan_out(fetch))
+
+def reclaim_blobs(grace_seconds=None):
+    """
+    Delete attachment blobs nothing references: those stored for a send
+    that failed or was never queued. Returns the number of files deleted.
+    """
+    grace_seconds = BLOB_GRACE_SECONDS if grace_seconds is None else grace_seconds
+    deleted = blob_store.sweep_blobs(get_referenced_blobs(), grace_seconds)
+    if deleted:
+        logger.info("Reclaimed unreferenced attachment blobs", extra={"blobs": deleted})
+    return deleted
+
+def incremental_vacuum(conn):
+    """
+    Give a SQLite database's free pages back to the file system a few at a
+    time instead of in one long VACUUM that would hold the write lock
+    throughout. Databases created before auto_vacuum was set are left as they are.
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return
+    while conn.execute('PRAGMA freelist_count').fetchone()[0] > 0:
+        conn.execute(f'PRAGMA incremental_vacuum({VACUUM_PAGES})').fetchall()
+        time.sleep(VACUUM_PAUSE)
+
+def compact_message_bodies(batch_size=500):
+    """
+    Move bodies still stored inline in Messages into MessageBodies,
+    compressing them above the threshold, then give the freed pages back a
+    few at a time. Each batch is a job on the writer thread, so sends keep
+    going in between.
+    Returns the number of messages migrated.
+    """
+    def migrate_batch(conn):
+        rows = conn.execute('''
+            SELECT m.id, m.body
+            FROM Messages m
+            LEFT JOIN MessageBodies b ON b.message_id = m.id
+            WHERE b.message_id IS NULL AND m.body <> ''
+            LIMIT ?
+        ''', (batch_size,)).fetchall()
+        
+        for row in rows:
+            encoding, payload = encode_body(row['body'])
+            conn.execute(
+                'INSERT INTO MessageBodies (message_id, encoding, body) VALUES (?, ?, ?)',
+                (row['id'], encoding, payload)
+            )
+        conn.executemany(
+            "UPDATE Messages SET body = '' WHERE id = ?",
+            [(row['id'],) for row in rows]
+        )
+        return len(rows)
+    
+    migrated = 0
+    while True:
+        count = run_write(migrate_batch)
+        if not count:
+            break
+        migrated += count
+    
+    # PostgreSQL's autovacuum reclaims the space on its own
+    if migrated and storage.DB_BACKEND == 'sqlite':
+        conn = get_db_connection()
+        try:
+            incremental_vacuum(conn)
+        finally:
+            conn.close()
+    
+    logger.info("Compacted %d message bodies", migrated)
+    return migrated
+
 # Initialize the database when this module is imported
-init_db() 
\ No newline at end of file
+init_db()
+
+if __name__ == '__main__':
+    # Usage: python db.py compact
+    if sys.argv[1:] == ['compact']:
+        compact_message_bodies()
+    else:
+        print("Usage: python db.py compact") 
\ No newline at end of file
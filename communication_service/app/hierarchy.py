@@ -0,0 +1,126 @@
+import hashlib
+import threading
+import metrics
+
+# Process-wide hierarchy index shared by every Streamlit session.
+# It is only rebuilt when the department list changes.
+_index_lock = threading.Lock()
+_shared_index = None
+
+CACHE_REQUESTS = metrics.counter(
+    'cache_requests_total', 'Cache lookups by cache and result', ['cache', 'result']
+)
+
+def department_version(departments):
+    """Compute a version fingerprint for a list of departments"""
+    rows = sorted(
+        (dept.get('id'), dept.get('parent_id'), dept.get('name')) for dept in departments
+    )
+    return hashlib.sha1(repr(rows).encode('utf-8')).hexdigest()
+
+def build_hierarchy_index(departments):
+    """
+    Build a department hierarchy index with Euler-tour interval numbering
+    Returns:
+    - department_names: dict mapping dept_id to name
+    - parent_mapping: dict mapping dept_id to parent_id
+    - children_mapping: dict mapping parent_id to list of child dept_ids
+    - preorder: list of dept_ids in preorder
+    - tin: dict mapping dept_id to its preorder number
+    - tout: dict mapping dept_id to one past the last preorder number in its subtree
+    """
+    department_names = {}
+    parent_mapping = {}
+    children_mapping = {}
+
+    # Build basic mappings
+    for dept in departments:
+        dept_id = dept.get('id')
+        parent_id = dept.get('parent_id')
+
+        department_names[dept_id] = dept.get('name')
+        parent_mapping[dept_id] = parent_id
+        children_mapping.setdefault(parent_id, []).append(dept_id)
+
+    # Departments whose parent is unknown are treated as top-level
+    roots = [dept_id for dept_id, parent_id in parent_mapping.items()
+             if parent_id is None or parent_id not in department_names]
+
+    # Iterative Euler tour. Each stack entry is (dept_id, exiting).
+    preorder = []
+    tin = {}
+    tout = {}
+    stack = [(dept_id, False) for dept_id in reversed(roots)]
+
+    while stack:
+        dept_id, exiting = stack.pop()
+        if exiting:
+            tout[dept_id] = len(preorder)
+            continue
+        if dept_id in tin:
+            continue
+
+        tin[dept_id] = len(preorder)
+        preorder.append(dept_id)
+        stack.append((dept_id, True))
+
+        for child_id in reversed(children_mapping.get(dept_id, [])):
+            stack.append((child_id, False))
+
+    return {
+        "version": department_version(departments),
+        "department_names": department_names,
+        "parent_mapping": parent_mapping,
+        "children_mapping": children_mapping,
+        "preorder": preorder,
+        "tin": tin,
+        "tout": tout
+    }
+
+def get_hierarchy_index(departments):
+    """Get the shared hierarchy index, rebuilding it only if the departments changed"""
+    global _shared_index
+
+    version = department_version(departments)
+    index = _shared_index
+    if index is not None and index["version"] == version:
+        CACHE_REQUESTS.inc(cache='hierarchy_index', result='hit')
+        return index
+
+    CACHE_REQUESTS.inc(cache='hierarchy_index', result='miss')
+    with _index_lock:
+        if _shared_index is None or _shared_index["version"] != version:
+            _shared_index = build_hierarchy_index(departments)
+        return _shared_index
+
+def is_ancestor(index, ancestor_id, dept_id):
+    """Check whether ancestor_id is dept_id or one of its ancestors in O(1)"""
+    tin = index["tin"]
+    if ancestor_id not in tin or dept_id not in tin:
+        return False
+    return tin[ancestor_id] <= tin[dept_id] < index["tout"][ancestor_id]
+
+def get_subtree(index, dept_id):
+    """Get a department and all of its descendants in preorder"""
+    if dept_id not in index["tin"]:
+        return []
+    return index["preorder"][index["tin"][dept_id]:index["tout"][dept_id]]
+
+def get_interval(index, dept_id):
+    """Get the [tin, tout) preorder interval covering a department's subtree"""
+    if dept_id not in index["tin"]:
+        return None
+    return index["tin"][dept_id], index["tout"][dept_id]
+
+def get_ancestors(index, dept_id):
+    """Get all ancestor department IDs, nearest first, in O(depth)"""
+    result = []
+    seen = {dept_id}
+    parent_id = index["parent_mapping"].get(dept_id)
+
+    while parent_id is not None and parent_id not in seen:
+        result.append(parent_id)
+        seen.add(parent_id)
+        parent_id = index["parent_mapping"].get(parent_id)
+
+    return result
@@ -0,0 +1,111 @@
+import argparse
+import os
+import threading
+import time
+import db
+import db_writer
+import logs
+import metrics
+
+logger = logs.get_logger(__name__)
+
+# Number of background delivery threads
+WORKER_COUNT = int(os.environ.get('OUTBOX_WORKERS', '2'))
+
+# Delivery attempts before an entry is marked failed
+MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '10'))
+
+# Idle workers check for due entries this often (seconds); a send in the
+# same process wakes them immediately
+POLL_INTERVAL = 0.5
+
+# Retry backoff after a locked database, doubling per attempt (seconds)
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 5.0
+
+# Delivered entries are kept this long for the delivery-lag metrics
+PRUNE_INTERVAL = 3600
+
+_wakeup = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+
+def process_next_entry():
+    """Deliver the next due Outbox entry. Returns False when the queue is idle."""
+    entry = db.claim_outbox_entry()
+    if not entry:
+        return False
+
+    try:
+        if db.deliver_outbox_entry(entry) is None:
+            logger.warning("Outbox entry %s was reclaimed by another worker before delivery", entry['id'])
+    except Exception as e:
+        if db_writer.is_busy_error(e) and entry['attempts'] < MAX_ATTEMPTS:
+            delay = min(RETRY_BASE_DELAY * (2 ** (entry['attempts'] - 1)), RETRY_MAX_DELAY)
+            logger.warning("Outbox entry %s hit a locked database, retrying in %.1fs", entry['id'], delay)
+            db.reschedule_outbox_entry(entry, str(e), delay)
+        else:
+            logger.error("Outbox entry %s failed: %s", entry['id'], e)
+            db.reschedule_outbox_entry(entry, str(e))
+
+    return True
+
+def worker_loop(stop_event):
+    """Deliver Outbox entries until stop_event is set"""
+    last_prune = 0
+
+    while not stop_event.is_set():
+        try:
+            busy = process_next_entry()
+
+            if time.time() - last_prune > PRUNE_INTERVAL:
+                db.prune_outbox()
+                last_prune = time.time()
+        except Exception as e:
+            # Claiming or rescheduling can itself hit a locked database
+            logger.error("Outbox worker error: %s", e)
+            busy = False
+
+        if not busy:
+            _wakeup.wait(POLL_INTERVAL)
+            _wakeup.clear()
+
+def collect_outbox_metrics():
+    """Expose the Outbox queue metrics as gauges at scrape time"""
+    stats = db.get_outbox_stats()
+    return [
+        (f"outbox_{name}", "gauge", f"Outbox {name.replace('_', ' ')}", [(f"outbox_{name}", {}, value)])
+        for name, value in stats.items()
+    ]
+
+def start_workers(count=WORKER_COUNT):
+    """Start the background delivery threads once per process"""
+    with _workers_lock:
+        if _workers:
+            return _workers
+
+        db.outbox_listeners.append(_wakeup.set)
+        metrics.register_collector('outbox', collect_outbox_metrics)
+        stop_event = threading.Event()
+
+        for i in range(count):
+            worker = threading.Thread(
+                target=worker_loop, args=(stop_event,), name=f"outbox-worker-{i}", daemon=True
+            )
+            worker.start()
+            _workers.append(worker)
+
+        return _workers
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Deliver queued communication messages")
+    parser.add_argument('--stats', action='store_true', help="print queue metrics and exit")
+    args = parser.parse_args()
+
+    if args.stats:
+        for name, value in db.get_outbox_stats().items():
+            print(f"{name}: {value}")
+    else:
+        logger.info("Starting %d outbox workers", WORKER_COUNT)
+        for worker in start_workers():
+            worker.join()
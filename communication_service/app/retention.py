@@ -0,0 +1,215 @@
+import argparse
+import datetime
+import os
+import time
+import db
+import logs
+import storage
+
+logger = logs.get_logger(__name__)
+
+# Messages older than this many days are moved out of the hot database
+RETENTION_DAYS = int(os.environ.get('MESSAGE_RETENTION_DAYS', '365'))
+
+# Archive databases hold one "year" or "month" of messages each
+ARCHIVE_PERIOD = os.environ.get('MESSAGE_ARCHIVE_PERIOD', 'year')
+
+# Messages moved per transaction, and the pause between transactions that
+# lets senders take the write lock
+BATCH_SIZE = 500
+BATCH_PAUSE = 0.05
+
+ARCHIVE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS archive.Messages (
+        id INTEGER PRIMARY KEY,
+        sender_department_id INTEGER NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        timestamp TIMESTAMP NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS archive.MessageRecipients (
+        message_id INTEGER NOT NULL,
+        recipient_department_id INTEGER NOT NULL,
+        PRIMARY KEY (message_id, recipient_department_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS archive.MessageBodies (
+        message_id INTEGER PRIMARY KEY,
+        encoding TEXT NOT NULL,
+        body BLOB NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS archive.MessageAttachments (
+        id INTEGER PRIMARY KEY,
+        message_id INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        content_type TEXT
+    );
+
+    CREATE INDEX IF NOT EXISTS archive.idx_message_attachments_message
+        ON MessageAttachments (message_id);
+'''
+
+def period_bounds(timestamp):
+    """Get the period key and the [start, end) timestamp bounds containing a timestamp"""
+    year = int(timestamp[:4])
+
+    if ARCHIVE_PERIOD == 'month':
+        month = int(timestamp[5:7])
+        start = f"{year:04d}-{month:02d}"
+        end = f"{year + 1:04d}-01" if month == 12 else f"{year:04d}-{month + 1:02d}"
+        return start, start, end
+
+    # Bounds like "2024" would compare as numbers against the TIMESTAMP column
+    return f"{year:04d}", f"{year:04d}-01", f"{year + 1:04d}-01"
+
+def archive_path(period):
+    """Get the path of the archive database for a period"""
+    return os.path.join(db.ARCHIVE_DIR, f"communication-{period}.db")
+
+def archive_batch(conn, period, path):
+    """Move one batch of messages from the temp.retention_batch table into the attached archive"""
+    batch = 'SELECT id FROM temp.retention_batch'
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(f'''
+            INSERT OR IGNORE INTO archive.Messages (id, sender_department_id, subject, body, timestamp)
+            SELECT id, sender_department_id, subject, body, timestamp
+            FROM main.Messages WHERE id IN ({batch})
+        ''')
+        conn.execute(f'''
+            INSERT OR IGNORE INTO archive.MessageRecipients (message_id, recipient_department_id)
+            SELECT message_id, recipient_department_id
+            FROM main.MessageRecipients WHERE message_id IN ({batch})
+        ''')
+        conn.execute(f'''
+            INSERT OR IGNORE INTO archive.MessageBodies (message_id, encoding, body)
+            SELECT message_id, encoding, body
+            FROM main.MessageBodies WHERE message_id IN ({batch})
+        ''')
+        # Attachment blobs stay referenced, since the archive still points at them
+        conn.execute(f'''
+            INSERT OR IGNORE INTO archive.MessageAttachments (id, message_id, sha256, filename, content_type)
+            SELECT id, message_id, sha256, filename, content_type
+            FROM main.MessageAttachments WHERE message_id IN ({batch})
+        ''')
+
+        for table in ('MessageAttachments', 'MessageBodies', 'MessageRecipients',
+                      'InboxDeliveries', 'MessageReads'):
+            conn.execute(f'DELETE FROM main.{table} WHERE message_id IN ({batch})')
+        conn.execute(f'DELETE FROM main.Messages WHERE id IN ({batch})')
+
+        conn.execute(f'''
+            INSERT INTO main.ArchivePeriods (period, path, min_id, max_id, message_count)
+            SELECT ?, ?, MIN(id), MAX(id), COUNT(*) FROM temp.retention_batch
+            WHERE true
+            ON CONFLICT (period) DO UPDATE SET
+                min_id = MIN(min_id, excluded.min_id),
+                max_id = MAX(max_id, excluded.max_id),
+                message_count = message_count + excluded.message_count
+        ''', (period, path))
+
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+def run_retention(retention_days=RETENTION_DAYS, batch_size=BATCH_SIZE):
+    """
+    Move messages older than the retention age into per-period archive
+    databases, in short batches so senders are never blocked for long,
+    then give the freed pages back with an incremental vacuum.
+    Returns the number of messages archived.
+    """
+    # Archives are SQLite files attached to the hot database
+    if storage.DB_BACKEND != 'sqlite':
+        logger.warning("Message retention needs DB_BACKEND=sqlite; nothing archived")
+        return 0
+
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=retention_days)).isoformat()
+    os.makedirs(db.ARCHIVE_DIR, exist_ok=True)
+
+    # Shards share the archive databases, so they are archived one at a time
+    archived = sum(archive_shard(shard, cutoff, batch_size) for shard in db.get_shards())
+
+    logger.info("Retention run archived %d messages", archived, extra={"cutoff": cutoff})
+    return archived
+
+def archive_shard(shard, cutoff, batch_size):
+    """Archive one shard's messages older than the cutoff. Returns the number archived."""
+    conn = db.get_db_connection(shard)
+    # Manage transactions explicitly, since ATTACH must happen outside one
+    conn.isolation_level = None
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS retention_batch (id INTEGER PRIMARY KEY)')
+
+    archived = 0
+    try:
+        while True:
+            oldest = conn.execute(
+                'SELECT timestamp FROM Messages WHERE timestamp < ? ORDER BY timestamp LIMIT 1',
+                (cutoff,)
+            ).fetchone()
+            if not oldest:
+                break
+
+            period, start, end = period_bounds(oldest['timestamp'])
+            upper = min(end, cutoff)
+            path = archive_path(period)
+
+            conn.execute('ATTACH DATABASE ? AS archive', (path,))
+            try:
+                conn.executescript(ARCHIVE_SCHEMA)
+
+                while True:
+                    conn.execute('DELETE FROM temp.retention_batch')
+                    conn.execute('''
+                        INSERT INTO temp.retention_batch (id)
+                        SELECT id FROM Messages
+                        WHERE timestamp >= ? AND timestamp < ?
+                        ORDER BY timestamp
+                        LIMIT ?
+                    ''', (start, upper, batch_size))
+
+                    count = conn.execute('SELECT COUNT(*) FROM temp.retention_batch').fetchone()[0]
+                    if count == 0:
+                        break
+
+                    archive_batch(conn, period, path)
+                    archived += count
+                    time.sleep(BATCH_PAUSE)
+            finally:
+                conn.execute('DETACH DATABASE archive')
+
+            logger.info("Archived messages for period %s", period, extra={"archive_path": path})
+
+        if archived:
+            # Counters may include archived messages; let them be recomputed.
+            # The reset is a writer job, ordered with the sends that bump
+            # counters instead of racing the writer for the lock.
+            db.run_write(lambda conn: conn.execute('DELETE FROM UnreadCounts'), shard=shard)
+
+            # Free pages a few at a time instead of one long VACUUM
+            db.incremental_vacuum(conn)
+    finally:
+        conn.close()
+
+    return archived
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Archive old communication messages")
+    parser.add_argument('--days', type=int, default=RETENTION_DAYS,
+                        help="archive messages older than this many days")
+    parser.add_argument('--every', type=int, default=0,
+                        help="repeat every N seconds instead of running once")
+    args = parser.parse_args()
+
+    while True:
+        run_retention(args.days)
+        # Blobs of failed or abandoned sends are reclaimed on the same schedule
+        db.reclaim_blobs()
+        if not args.every:
+            break
+        time.sleep(args.every)
@@ -0,0 +1,104 @@
+import io
+import json
+import os
+import attachments as blob_store
+import db
+
+# Every test sends between its own departments, so the shared database needs no cleanup
+
+
+def test_sent_message_reaches_recipients_and_their_subdepartments():
+    assert db.create_message(10, [11], 'Budget review', 'Please send the quarterly figures')
+
+    inbox = db.get_inbox_messages(11, [])
+    assert [msg['subject'] for msg in inbox] == ['Budget review']
+    assert [msg['subject'] for msg in db.get_inbox_messages(12, [11])] == ['Budget review']
+    assert db.get_inbox_messages(13, []) == []
+    assert [msg['id'] for msg in db.get_sent_messages(10)] == [inbox[0]['id']]
+
+    details = db.get_message_details(inbox[0]['id'])
+    assert details['body'] == 'Please send the quarterly figures'
+
+def test_unread_count_drops_once_per_message():
+    db.create_message(20, [21], 'Lab access', 'Badges are ready')
+    db.create_message(20, [21], 'Lab hours', 'Open until nine')
+    assert db.get_unread_count(21) == 2
+
+    message_id = db.get_inbox_messages(21, [])[0]['id']
+    db.mark_message_read(message_id, 21)
+    db.mark_message_read(message_id, 21)
+    assert db.get_unread_count(21) == 1
+    assert db.get_read_message_ids(21) == {message_id}
+
+def test_search_matches_body_terms_within_a_department():
+    db.create_message(30, [31], 'Travel', 'Conference in Lisbon next spring')
+    db.create_message(32, [33], 'Travel', 'Workshop in Lisbon next autumn')
+
+    assert len(db.search_messages('lisbon')) >= 2
+    results = db.search_messages('lisbon', department_id=31)
+    assert [row['subject'] for row in results] == ['Travel']
+    assert db.search_messages('"') == []
+
+def test_long_bodies_round_trip_through_compression():
+    body = 'Minutes of the committee meeting. ' * 200
+    encoding, payload = db.encode_body(body)
+    assert encoding in ('zlib', 'zstd')
+    assert db.decode_body(encoding, payload) == body
+
+    db.create_message(40, [41], 'Minutes', body)
+    message_id = db.get_inbox_messages(41, [])[0]['id']
+    assert db.get_message_details(message_id)['body'] == body
+
+def test_outbox_delivers_once_per_claim(monkeypatch):
+    monkeypatch.setattr(db, 'MESSAGE_DELIVERY', 'outbox')
+    assert db.create_message(50, [51], 'Queued', 'Delivered by a worker')
+    assert db.get_inbox_messages(51, []) == []
+
+    stale = db.claim_outbox_entry()
+    # A second worker takes the entry over, as if the first had stalled
+    fresh = db.claim_outbox_entry(stale_after=-1)
+    assert fresh['id'] == stale['id']
+
+    assert db.deliver_outbox_entry(stale) is None
+    message_id = db.deliver_outbox_entry(fresh)
+    assert [msg['id'] for msg in db.get_inbox_messages(51, [])] == [message_id]
+    assert db.claim_outbox_entry() is None
+
+def test_reclaim_blobs_keeps_referenced_and_queued_attachments(monkeypatch):
+    assert db.create_message(60, [61], 'Budget', 'Attached', [('budget.csv', io.BytesIO(b'a,b\n1,2\n'), 'text/csv')])
+    monkeypatch.setattr(db, 'MESSAGE_DELIVERY', 'outbox')
+    assert db.create_message(60, [61], 'Queued', 'Attached', [('plan.pdf', io.BytesIO(b'%PDF plan'), None)])
+    orphan, _ = blob_store.store_blob(io.BytesIO(b'from a send that failed'))
+
+    db.reclaim_blobs(grace_seconds=-1)
+    assert not os.path.exists(blob_store.blob_path(orphan))
+
+    message_id = db.get_inbox_messages(61, [])[0]['id']
+    (attachment,) = db.get_message_attachments(message_id)
+    with blob_store.open_blob(attachment['sha256']) as blob:
+        assert blob.read() == b'a,b\n1,2\n'
+
+    # The queued entry's blob is kept until the entry is delivered or fails
+    entry = db.claim_outbox_entry()
+    sha256 = json.loads(entry['attachments'])[0][2]
+    assert os.path.exists(blob_store.blob_path(sha256))
+    db.reschedule_outbox_entry(entry, 'recipient gone')
+    db.reclaim_blobs(grace_seconds=-1)
+    assert not os.path.exists(blob_store.blob_path(sha256))
+
+def test_compact_moves_inline_bodies_and_frees_their_pages():
+    db.create_message(70, [71], 'Legacy', 'placeholder')
+    message_id = db.get_inbox_messages(71, [])[0]['id']
+    body = 'Body from before MessageBodies existed. ' * 500
+
+    def make_inline(conn):
+        conn.execute('DELETE FROM MessageBodies WHERE message_id = ?', (message_id,))
+        conn.execute('UPDATE Messages SET body = ? WHERE id = ?', (body, message_id))
+    db.run_write(make_inline)
+
+    assert db.compact_message_bodies(batch_size=10) >= 1
+    assert db.get_message_details(message_id)['body'] == body
+    if db.storage.DB_BACKEND == 'sqlite':
+        conn = db.get_db_connection()
+        assert conn.execute('PRAGMA freelist_count').fetchone()[0] == 0
+        conn.close()
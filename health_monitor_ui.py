@@ -18,6 +18,7 @@ SERVICES = [
     {
         "name": "Budgeting Service API",
         "url": "http://localhost:5000/api/health",
+        "metrics_url": "http://localhost:5000/metrics",
         "description": "Handles authentication, departments, and budgeting data",
         "last_status": None,
         "last_checked": None,
@@ -27,6 +28,7 @@ SERVICES = [
     {
         "name": "Budgeting Service UI",
         "url": "http://localhost:8501",
+        "metrics_url": None,
         "description": "User interface for budgeting management",
         "last_status": None,
         "last_checked": None,
@@ -36,6 +38,7 @@ SERVICES = [
     {
         "name": "Communication Service UI",
         "url": "http://localhost:8502",
+        "metrics_url": "http://localhost:9102/metrics",
         "description": "User interface for interdepartmental communication",
         "last_status": None,
         "last_checked": None,
@@ -59,6 +62,9 @@ if 'last_check_time' not in st.session_state:
     
 if 'paused' not in st.session_state:
     st.session_state.paused = False
+
+if 'metrics_history' not in st.session_state:
+    st.session_state.metrics_history = {service['name']: [] for service in SERVICES if service['metrics_url']}
     
 # Maximum history points to keep
 MAX_HISTORY_POINTS = 100
@@ -133,12 +139,78 @@ def check_service(service):
             st.session_state.incident_log.insert(0, incident)
         return False
 
+def parse_metrics(text):
+    """Parse Prometheus text format into {sample name: [(labels, value)]}"""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        
+        name_part, _, value = line.rpartition(' ')
+        labels = {}
+        if '{' in name_part:
+            name, _, label_text = name_part.partition('{')
+            for pair in label_text.rstrip('}').split('",'):
+                if '=' in pair:
+                    key, _, label_value = pair.partition('=')
+                    labels[key] = label_value.strip('"')
+        else:
+            name = name_part
+        
+        try:
+            samples.setdefault(name, []).append((labels, float(value)))
+        except ValueError:
+            pass
+    return samples
+
+def summarise_metrics(samples):
+    """Reduce scraped samples to the headline numbers charted by the monitor"""
+    def total(name, **match):
+        return sum(value for labels, value in samples.get(name, [])
+                   if all(labels.get(k) == v for k, v in match.items()))
+    
+    request_count = total('http_request_duration_seconds_count') + total('page_render_seconds_count')
+    request_sum = total('http_request_duration_seconds_sum') + total('page_render_seconds_sum')
+    cache_hits = total('cache_requests_total', result='hit')
+    cache_lookups = cache_hits + total('cache_requests_total', result='miss')
+    
+    return {
+        "requests": request_count,
+        "avg_request_ms": request_sum / request_count * 1000 if request_count else 0.0,
+        "db_queries": total('db_query_duration_seconds_count'),
+        "db_time_seconds": total('db_query_duration_seconds_sum'),
+        "slow_queries": total('db_slow_queries_total'),
+        "auth_calls": total('auth_requests_total'),
+        "fallback_activations": total('fallback_activations_total'),
+        "cache_hit_rate": cache_hits / cache_lookups if cache_lookups else None
+    }
+
+def scrape_metrics(service):
+    """Scrape a service's /metrics endpoint and add a point to its metrics history"""
+    try:
+        response = requests.get(service["metrics_url"], timeout=2)
+        if response.status_code != 200:
+            return None
+    except requests.RequestException:
+        return None
+    
+    summary = summarise_metrics(parse_metrics(response.text))
+    history = st.session_state.metrics_history[service['name']]
+    history.append(dict(summary, timestamp=datetime.datetime.now()))
+    
+    if len(history) > MAX_HISTORY_POINTS:
+        st.session_state.metrics_history[service['name']] = history[-MAX_HISTORY_POINTS:]
+    return summary
+
 def update_service_status():
     """Update status for all services"""
     if not st.session_state.paused:
         for service in SERVICES:
             check_service(service)
             
+            if service["metrics_url"] and service["last_status"]:
+                scrape_metrics(service)
+            
             # Add current status to history
             history_point = {
                 "timestamp": datetime.datetime.now(),
@@ -245,6 +317,35 @@ for service_name, history in st.session_state.status_history.items():
         st.markdown(f"**{service_name}**")
         st.line_chart(df.set_index("timestamp")["status"], use_container_width=True, height=100)
 
+# Metrics scraped from the services' /metrics endpoints
+st.subheader("Service Metrics")
+
+for service_name, history in st.session_state.metrics_history.items():
+    if not history:
+        continue
+    
+    latest = history[-1]
+    st.markdown(f"**{service_name}**")
+    
+    metric_cols = st.columns(5)
+    metric_cols[0].metric("Avg Latency", f"{latest['avg_request_ms']:.1f} ms")
+    metric_cols[1].metric("DB Time", f"{latest['db_time_seconds']:.2f} s", f"{latest['db_queries']:.0f} queries", delta_color="off")
+    metric_cols[2].metric("Slow Queries", f"{latest['slow_queries']:.0f}")
+    metric_cols[3].metric("Auth Calls", f"{latest['auth_calls']:.0f}", f"{latest['fallback_activations']:.0f} fallbacks", delta_color="off")
+    hit_rate = latest['cache_hit_rate']
+    metric_cols[4].metric("Cache Hit Rate", f"{hit_rate:.0%}" if hit_rate is not None else "n/a")
+    
+    if len(history) > 1:
+        df = pd.DataFrame(history).set_index("timestamp")
+        # Counters are cumulative; chart the DB time spent between scrapes
+        df["db_ms_per_check"] = df["db_time_seconds"].diff().clip(lower=0) * 1000
+        
+        chart_cols = st.columns(2)
+        chart_cols[0].caption("Average request latency (ms)")
+        chart_cols[0].line_chart(df["avg_request_ms"], use_container_width=True, height=150)
+        chart_cols[1].caption("DB time per check (ms)")
+        chart_cols[1].line_chart(df["db_ms_per_check"].dropna(), use_container_width=True, height=150)
+
 # Incident log
 st.subheader("Incident Log")
 